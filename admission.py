@@ -0,0 +1,238 @@
+import asyncio
+import math
+import threading
+import time
+import zlib
+from collections import deque
+from multiprocessing import Array
+from typing import Any, Deque, Dict, MutableSequence, Optional, Tuple
+
+from sanic import Request
+from sanic.log import logger
+from sanic.response import HTTPResponse, json
+
+from config import config
+from metrics import metrics
+
+# Группы маршрутов задаются ctx_admission в @api.route; маршруты без него
+# входят в default, exempt (/, /metrics) не ограничиваются
+DEFAULT = "default"
+WEBHOOK = "webhook"
+AUTH = "auth"
+EXEMPT = "exempt"
+GROUPS = (DEFAULT, WEBHOOK, AUTH)
+
+QUEUE_FULL = "queue_full"
+TIMEOUT = "timeout"
+RATE_LIMITED = "rate_limited"
+SHED_REASONS = (QUEUE_FULL, TIMEOUT, RATE_LIMITED)
+
+
+class Permit:
+    # Разрешение освобождается один раз: в response middleware или, если
+    # клиент отключился и обработчик отменён, по завершении задачи соединения
+    def __init__(self, limiter: "ConcurrencyLimiter") -> None:
+        self.limiter = limiter
+        self.released = False
+        self.task: Optional[asyncio.Task[Any]] = None
+
+    def watch(self, task: Optional[asyncio.Task[Any]]) -> None:
+        # Задача соединения обслуживает все запросы keep-alive, поэтому
+        # обратный вызов снимается при обычном освобождении
+        self.task = task
+        if task is not None:
+            task.add_done_callback(self.release)
+
+    def release(self, *args: Any) -> None:
+        if self.released:
+            return
+        self.released = True
+        if self.task is not None:
+            self.task.remove_done_callback(self.release)
+        self.limiter.release()
+
+
+class ConcurrencyLimiter:
+    # Не больше limit одновременных запросов группы в воркере: у каждого
+    # воркера свой пул соединений. Остальные ждут в очереди до queue_size
+    # запросов и не дольше timeout, затем получают 503 сразу, а не ждут
+    # соединения из пула до истечения pool_timeout.
+    def __init__(self, group: str, limit: int, queue_size: int, timeout: float) -> None:
+        self.group = group
+        self.limit = max(1, limit)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future[None]] = deque()
+
+    async def acquire(self) -> Tuple[Optional[Permit], Optional[str]]:
+        # (разрешение, None) или (None, причина отказа)
+        if self.in_flight < self.limit and not self.waiters:
+            return self.admit(), None
+        if len(self.waiters) >= self.queue_size:
+            return None, QUEUE_FULL
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        metrics.inc("admission_queued", group=self.group)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait([future], timeout=self.timeout)
+        except BaseException:
+            # Отмена во время ожидания: переданное место отдаётся следующему
+            if future.done() and not future.cancelled():
+                self.hand_off()
+            future.cancel()
+            raise
+        finally:
+            if future in self.waiters:
+                self.waiters.remove(future)
+            metrics.inc("admission_queued", -1, group=self.group)
+            metrics.observe(
+                "admission_wait_seconds",
+                time.perf_counter() - started,
+                group=self.group,
+            )
+        if not future.done():
+            future.cancel()
+            return None, TIMEOUT
+        # release передал место без уменьшения in_flight
+        metrics.inc("admission_in_flight", group=self.group)
+        return Permit(self), None
+
+    def admit(self) -> Permit:
+        self.in_flight += 1
+        metrics.inc("admission_in_flight", group=self.group)
+        return Permit(self)
+
+    def release(self) -> None:
+        metrics.inc("admission_in_flight", -1, group=self.group)
+        self.hand_off()
+
+    def hand_off(self) -> None:
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class TokenBuckets:
+    # Корзины токенов по адресу клиента в разделяемой памяти: на слот
+    # [токены, время пополнения], поэтому предел общий для всех воркеров.
+    # Адреса, попавшие в один слот, делят корзину.
+    def __init__(self, slots: int) -> None:
+        self.values: MutableSequence[float] = [0.0] * (slots * 2)
+        self.lock: Any = threading.Lock()
+
+    @staticmethod
+    def shared_values(slots: int) -> Any:
+        return Array("d", slots * 2)
+
+    def bind(self, values: Any) -> None:
+        self.values = values
+        self.lock = values.get_lock()
+
+    def take(self, key: str, rate: float, burst: int) -> float:
+        # 0, если токен взят, иначе сколько секунд ждать следующего.
+        # crc32 одинаков во всех процессах, в отличие от hash()
+        slot = zlib.crc32(key.encode()) % (len(self.values) // 2) * 2
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.values[slot], self.values[slot + 1]
+            tokens = min(float(burst), tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self.values[slot] = tokens
+            self.values[slot + 1] = now
+        return wait
+
+
+def group_of(request: Request) -> str:
+    if request.route is None:
+        return DEFAULT
+    return getattr(request.route.ctx, "admission", DEFAULT)
+
+
+def rate_limit(group: str) -> Tuple[float, int]:
+    if group == AUTH:
+        return config.ADMISSION_AUTH_RATE, config.ADMISSION_AUTH_BURST
+    if group == WEBHOOK:
+        return config.ADMISSION_WEBHOOK_RATE, config.ADMISSION_WEBHOOK_BURST
+    return 0.0, 0
+
+
+def group_limits(pool: int) -> Dict[str, int]:
+    # Группы делят пул воркера: сумма пределов не больше pool, иначе
+    # допущенные запросы снова ждут соединения до pool_timeout. По умолчанию
+    # webhook и auth получают по четверти, default — остаток
+    limits = {
+        WEBHOOK: config.ADMISSION_WEBHOOK_CONCURRENCY or max(1, pool // 4),
+        AUTH: config.ADMISSION_AUTH_CONCURRENCY or max(1, pool // 4),
+    }
+    limits[DEFAULT] = config.ADMISSION_CONCURRENCY or max(
+        1, pool - sum(limits.values())
+    )
+    total = sum(limits.values())
+    if total > pool:
+        logger.warning(
+            "Admission limits %s exceed %d pool connections, scaling down",
+            limits,
+            pool,
+        )
+        limits = {group: limit * pool // total for group, limit in limits.items()}
+    # Пул меньше числа групп: по одному месту, чтобы группа не стояла
+    return {group: max(1, limit) for group, limit in limits.items()}
+
+
+def create_limiters() -> Dict[str, ConcurrencyLimiter]:
+    limits = group_limits(config.ADMISSION_POOL_CONNECTIONS)
+    return {
+        group: ConcurrencyLimiter(
+            group, limit, config.ADMISSION_QUEUE_SIZE, config.ADMISSION_QUEUE_TIMEOUT
+        )
+        for group, limit in limits.items()
+    }
+
+
+def shed(group: str, reason: str, retry_after: float) -> HTTPResponse:
+    metrics.inc("admission_shed_total", group=group, reason=reason)
+    headers = {"Retry-After": str(max(1, math.ceil(retry_after)))}
+    if reason == RATE_LIMITED:
+        return json({"error": "Too many requests"}, status=429, headers=headers)
+    return json({"error": "Server is busy"}, status=503, headers=headers)
+
+
+class AdmissionControl:
+    # Request middleware до проверки токена и сессии: отказ стоит дешевле
+    # любой работы с запросом
+    def __init__(self) -> None:
+        self.limiters = create_limiters()
+
+    async def admit(self, request: Request) -> Optional[HTTPResponse]:
+        group = group_of(request)
+        if group == EXEMPT:
+            return None
+        rate, burst = rate_limit(group)
+        if rate > 0:
+            source = request.remote_addr or request.ip
+            wait = token_buckets.take(f"{group}:{source}", rate, burst)
+            if wait:
+                return shed(group, RATE_LIMITED, wait)
+
+        permit, reason = await self.limiters[group].acquire()
+        if permit is None:
+            return shed(group, reason or QUEUE_FULL, config.ADMISSION_RETRY_AFTER)
+        request.ctx.admission_permit = permit
+        permit.watch(asyncio.current_task())
+        return None
+
+    async def release(self, request: Request, response: Any) -> None:
+        permit: Optional[Permit] = getattr(request.ctx, "admission_permit", None)
+        if permit is not None:
+            permit.release()
+
+
+token_buckets = TokenBuckets(config.ADMISSION_RATE_SLOTS)
@@ -0,0 +1,359 @@
+# Нагрузочный прогон живого приложения смешанным трафиком.
+#
+#   python -m benchmarks.load --duration 30 --concurrency 32 --output load.json
+#
+# Сценарии и их веса — строки benchmarks/workload.jsonl, запросы для них
+# берутся из payments.postman_collection.json по имени. Без --base-url
+# приложение запускается на --port с текущими настройками базы после
+# migrate и seed. Вебхуки подписываются так же, как их проверяет
+# verify_signature, часть пачки — повторы уже отправленных событий.
+#
+# Отчёт в JSON: пропускная способность, p50/p95/p99 и доля ошибок по каждому
+# сценарию. С --baseline в отчёт добавляется отношение к прошлому прогону.
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import IO, Any, Deque, Dict, List, Optional
+
+import httpx
+from sqlalchemy import make_url
+
+from benchmarks.webhooks import percentile
+from config import config
+from utils import sign_payload
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.errors = 0
+
+    def add(self, milliseconds: float, status: Optional[int]) -> None:
+        # Ошибка — исключение клиента или ответ 5xx; 4xx входят в statuses
+        self.latencies.append(milliseconds)
+        key = str(status) if status is not None else "exception"
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        if status is None or status >= 500:
+            self.errors += 1
+
+    def summary(self, seconds: float) -> Dict[str, Any]:
+        count = len(self.latencies)
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "error_rate": round(self.errors / count, 4) if count else 0.0,
+            "requests_per_second": round(count / seconds, 1) if seconds else 0.0,
+            "p50_ms": round(percentile(self.latencies, 0.5), 2) if count else None,
+            "p95_ms": round(percentile(self.latencies, 0.95), 2) if count else None,
+            "p99_ms": round(percentile(self.latencies, 0.99), 2) if count else None,
+            "statuses": dict(sorted(self.statuses.items())),
+        }
+
+
+def load_collection(path: Path) -> Dict[str, Dict[str, Any]]:
+    # Postman v2.1: имя запроса → метод, путь без {{baseUrl}} и тело: JSON
+    # разбирается, остальное (NDJSON) отправляется как есть
+    requests: Dict[str, Dict[str, Any]] = {}
+
+    def walk(items: List[Dict[str, Any]]) -> None:
+        for item in items:
+            if "item" in item:
+                walk(item["item"])
+                continue
+            request = item["request"]
+            url = request["url"]
+            raw = url["raw"] if isinstance(url, dict) else url
+            body = request.get("body", {}).get("raw")
+            options = request.get("body", {}).get("options", {}).get("raw", {})
+            if body and options.get("language") == "json":
+                body = json.loads(body)
+            requests[item["name"]] = {
+                "method": request["method"],
+                "path": raw.replace("{{baseUrl}}", ""),
+                "body": body or None,
+            }
+
+    walk(json.loads(path.read_text())["item"])
+    return requests
+
+
+def load_workload(path: Path) -> List[Dict[str, Any]]:
+    return [json.loads(line) for line in path.read_text().splitlines() if line.strip()]
+
+
+def start_app(args: argparse.Namespace, log: IO[bytes]) -> "subprocess.Popen[bytes]":
+    env = {
+        **os.environ,
+        "SANIC_PORT": str(args.port),
+        "SANIC_WORKERS": str(args.workers),
+        "SANIC_DEV": "",
+        "SANIC_AUTO_RELOAD": "",
+        "SANIC_DEBUG": "",
+        "SANIC_ACCESS_LOG": "",
+    }
+    for command in ("migrate", "seed"):
+        subprocess.run(
+            [sys.executable, "main.py", command],
+            cwd=ROOT,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            check=True,
+        )
+    return subprocess.Popen(
+        [sys.executable, "main.py", "serve"],
+        cwd=ROOT,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient) -> None:
+    while True:
+        try:
+            await client.get("/metrics")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.5)
+
+
+class LoadTest:
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        collection: Dict[str, Dict[str, Any]],
+        workload: List[Dict[str, Any]],
+        seed: int,
+    ) -> None:
+        self.client = client
+        self.collection = collection
+        self.workload = workload
+        self.weights = [scenario.get("weight", 1) for scenario in workload]
+        self.random = random.Random(seed)
+        self.stats: Dict[str, Stats] = {
+            scenario["name"]: Stats() for scenario in workload
+        }
+        self.headers: Dict[str, Dict[str, str]] = {}
+        self.ids: Dict[str, Any] = {}
+        self.sent: Deque[Dict[str, Any]] = deque(maxlen=1000)
+        self.recording = False
+
+    async def login(self, email: str, password: str) -> Dict[str, str]:
+        response = await self.client.post(
+            "/api/auth", json={"email": email, "password": password}
+        )
+        response.raise_for_status()
+        return {"Authorization": f"Bearer {response.json()['token']}"}
+
+    async def setup(self) -> None:
+        self.headers["admin"] = await self.login(
+            config.TEST_ADMIN_EMAIL, config.TEST_ADMIN_PASSWORD
+        )
+        self.headers["user"] = await self.login(
+            config.TEST_USER_EMAIL, config.TEST_USER_PASSWORD
+        )
+        me = await self.client.get("/api/users/me", headers=self.headers["user"])
+        self.ids["user_id"] = me.json()["user_id"]
+
+    async def timed(self, name: str, method: str, path: str, **kwargs: Any) -> None:
+        started = time.perf_counter()
+        status: Optional[int] = None
+        try:
+            response = await self.client.request(method, path, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError:
+            pass
+        if self.recording:
+            self.stats[name].add((time.perf_counter() - started) * 1000, status)
+
+    def event(
+        self, scenario: Dict[str, Any], template: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        event = {
+            **template,
+            "transaction_id": str(uuid.uuid4()),
+            "user_id": self.ids["user_id"],
+            "account_id": 1 + self.random.randrange(scenario.get("accounts", 1)),
+        }
+        event["signature"] = sign_payload(event, config.SECRET_KEY)
+        return event
+
+    async def webhook_burst(
+        self, scenario: Dict[str, Any], request: Dict[str, Any]
+    ) -> None:
+        # Пачка одновременных событий; duplicates — доля повторов прошлых
+        burst = scenario.get("burst", 1)
+        repeats = min(len(self.sent), int(burst * scenario.get("duplicates", 0)))
+        events = self.random.sample(list(self.sent), repeats)
+        fresh = [self.event(scenario, request["body"]) for _ in range(burst - repeats)]
+        self.sent.extend(fresh)
+        await asyncio.gather(
+            *(
+                self.timed(
+                    scenario["name"], request["method"], request["path"], json=event
+                )
+                for event in events + fresh
+            )
+        )
+
+    async def run_scenario(self, scenario: Dict[str, Any]) -> None:
+        request = self.collection[scenario["request"]]
+        if "burst" in scenario:
+            await self.webhook_burst(scenario, request)
+            return
+        path = scenario.get("path", request["path"]).format(**self.ids)
+        kwargs: Dict[str, Any] = {"params": scenario.get("query")}
+        if scenario.get("as"):
+            kwargs["headers"] = self.headers[scenario["as"]]
+        if isinstance(request["body"], str):
+            kwargs["content"] = request["body"]
+        elif request["body"] is not None:
+            kwargs["json"] = request["body"]
+        await self.timed(scenario["name"], request["method"], path, **kwargs)
+
+    async def worker(self, deadline: float) -> None:
+        while time.monotonic() < deadline:
+            scenario = self.random.choices(self.workload, self.weights)[0]
+            await self.run_scenario(scenario)
+
+    async def run(self, concurrency: int, warmup: float, duration: float) -> float:
+        loop_started = time.monotonic()
+        deadline = loop_started + warmup + duration
+        workers = [
+            asyncio.create_task(self.worker(deadline)) for _ in range(concurrency)
+        ]
+        await asyncio.sleep(warmup)
+        self.recording = True
+        started = time.monotonic()
+        await asyncio.gather(*workers)
+        self.recording = False
+        return time.monotonic() - started
+
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> Dict[str, Any]:
+    # Отношение текущего прогона к базовому: >1 у requests_per_second лучше,
+    # >1 у задержек хуже
+    comparison: Dict[str, Any] = {}
+    for name, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if not previous:
+            continue
+        comparison[name] = {
+            key: round(current[key] / previous[key], 3)
+            for key in ("requests_per_second", "p50_ms", "p95_ms", "p99_ms")
+            if current.get(key) and previous.get(key)
+        }
+    return {"commit": baseline.get("commit"), "ratios": comparison}
+
+
+async def main(args: argparse.Namespace) -> None:
+    collection = load_collection(args.collection)
+    workload = load_workload(args.workload)
+    base_url = args.base_url or f"http://127.0.0.1:{args.port}"
+    process = None
+    # Открытие лога и ожидание процесса — в потоке, не в цикле событий
+    log = await asyncio.to_thread(open, args.log, "wb")
+    if not args.base_url:
+        process = start_app(args, log)
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency * 2)
+        async with httpx.AsyncClient(
+            base_url=base_url, limits=limits, timeout=args.timeout
+        ) as client:
+            try:
+                async with asyncio.timeout(args.start_timeout):
+                    await wait_ready(client)
+            except TimeoutError:
+                raise SystemExit("The app did not start, see the --log file")
+            test = LoadTest(client, collection, workload, args.seed)
+            await test.setup()
+            seconds = await test.run(args.concurrency, args.warmup, args.duration)
+    finally:
+        if process is not None:
+            process.terminate()
+            await asyncio.to_thread(process.wait, 30)
+        log.close()
+
+    total = Stats()
+    for stats in test.stats.values():
+        total.latencies.extend(stats.latencies)
+        total.errors += stats.errors
+        for status, count in stats.statuses.items():
+            total.statuses[status] = total.statuses.get(status, 0) + count
+    report: Dict[str, Any] = {
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit(),
+        "base_url": base_url,
+        "database": make_url(config.DATABASE_URL).render_as_string(hide_password=True),
+        "db_async": config.DB_ASYNC,
+        "workers": args.workers if process else None,
+        "concurrency": args.concurrency,
+        "warmup_seconds": args.warmup,
+        "seconds": round(seconds, 3),
+        "seed": args.seed,
+        "total": total.summary(seconds),
+        "endpoints": {
+            name: stats.summary(seconds) for name, stats in test.stats.items()
+        },
+    }
+    if args.baseline:
+        report["baseline"] = compare(report, json.loads(args.baseline.read_text()))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=config.WORKERS)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--base-url", help="an already running app; it must be migrated and seeded"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--start-timeout", type=float, default=60)
+    parser.add_argument(
+        "--workload", type=Path, default=ROOT / "benchmarks" / "workload.jsonl"
+    )
+    parser.add_argument(
+        "--collection", type=Path, default=ROOT / "payments.postman_collection.json"
+    )
+    parser.add_argument("--baseline", type=Path, help="a previous JSON report")
+    parser.add_argument("--output", type=Path)
+    parser.add_argument(
+        "--log", type=Path, default=Path(tempfile.gettempdir()) / "payments-load.log"
+    )
+    asyncio.run(main(parser.parse_args()))
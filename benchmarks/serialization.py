@@ -0,0 +1,133 @@
+# Сравнение сериализации списка платежей: ORM-объекты, словари и json.dumps
+# против выборки колонками, схем msgspec и кодирования сразу в bytes.
+#
+#   python -m benchmarks.serialization --payments 5000 --repeat 20
+#
+# Платежи создаются у первого пользователя базы из настроек приложения и
+# удаляются после прогона. Результаты печатаются в JSON.
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List
+
+from sqlalchemy import delete, insert, select
+
+from benchmarks.webhooks import percentile
+from config import config
+from database import DbSession, create_session_factory
+from main import create_async_database_engine, create_database_engine
+from migrations import migrate
+from models import Payment, User
+from schemas import encoder, payment_row, payments_query
+
+
+async def orm_dicts(session: DbSession, user_id: int) -> bytes:
+    # Прежний путь обработчика list_payments
+    payments = await session.scalars(select(Payment).filter_by(user_id=user_id))
+    body = [
+        {
+            "transaction_id": payment.transaction_id,
+            "account_id": payment.account_id,
+            "payment": payment.amount,
+        }
+        for payment in payments.all()
+    ]
+    return json.dumps(body).encode()
+
+
+async def column_structs(session: DbSession, user_id: int) -> bytes:
+    rows = await session.execute(payments_query(user_id))
+    return encoder.encode([payment_row(row) for row in rows])
+
+
+async def measure(
+    Session: Callable[[], DbSession],
+    render: Callable[[DbSession, int], Awaitable[bytes]],
+    user_id: int,
+    repeat: int,
+) -> Dict[str, Any]:
+    latencies: List[float] = []
+    size = 0
+    for _ in range(repeat + 1):
+        session = Session()
+        try:
+            started = time.perf_counter()
+            body = await render(session, user_id)
+            elapsed = (time.perf_counter() - started) * 1000
+        finally:
+            await session.close()
+        size = len(body)
+        latencies.append(elapsed)
+    # Первый прогон прогревает пул соединений и кэш запросов
+    latencies = latencies[1:]
+    return {
+        "bytes": size,
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    sync_engine = create_database_engine()
+    migrate(sync_engine)
+    engine = create_async_database_engine() if config.DB_ASYNC else sync_engine
+    Session = create_session_factory(engine)
+
+    with sync_engine.connect() as conn:
+        user_id = conn.scalar(select(User.id).order_by(User.id).limit(1))
+    if user_id is None:
+        raise SystemExit("No users in the database, run ./main.py seed first")
+
+    prefix = f"bench-{uuid.uuid4().hex[:8]}-"
+    with sync_engine.begin() as conn:
+        conn.execute(
+            insert(Payment),
+            [
+                {
+                    "transaction_id": f"{prefix}{index}",
+                    "user_id": user_id,
+                    "account_id": 1_000_000 + index % 8,
+                    "amount": index / 100,
+                }
+                for index in range(args.payments)
+            ],
+        )
+    try:
+        session = Session()
+        try:
+            # Оба пути должны отдавать один и тот же JSON
+            body = await column_structs(session, user_id)
+            if json.loads(body) != json.loads(await orm_dicts(session, user_id)):
+                raise SystemExit("Responses differ")
+        finally:
+            await session.close()
+        count = len(json.loads(body))
+        report: Dict[str, Any] = {
+            "database": engine.url.render_as_string(hide_password=True),
+            "payments": count,
+            "repeat": args.repeat,
+        }
+        for name, render in (("orm_dicts", orm_dicts), ("columns", column_structs)):
+            result = await measure(Session, render, user_id, args.repeat)
+            result["rows_per_second"] = round(count * 1000 / result["p50_ms"])
+            report[name] = result
+        report["speedup"] = round(
+            report["orm_dicts"]["p50_ms"] / report["columns"]["p50_ms"], 2
+        )
+    finally:
+        with sync_engine.begin() as conn:
+            conn.execute(
+                delete(Payment).where(Payment.transaction_id.startswith(prefix))
+            )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payments", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
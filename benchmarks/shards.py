@@ -0,0 +1,125 @@
+# Конкурентная запись в один горячий счёт: одна строка accounts против
+# шардированного баланса.
+#
+#   python -m benchmarks.shards --events 5000 --concurrency 64 --shards 16
+#
+# --commit-latency-ms добавляет задержку перед коммитом, пока строка счёта
+# заблокирована: на локальной базе коммит почти бесплатен, и без неё замер
+# упирается в CPU клиента, а не в блокировки.
+#
+# Используются те же настройки базы, что и у приложения (SANIC_POSTGRES_*,
+# SANIC_DB_ASYNC). Результаты печатаются в JSON.
+
+import argparse
+import asyncio
+import json
+from typing import Any, Callable, Dict
+
+from sqlalchemy import select
+
+from benchmarks.webhooks import make_events, run_load
+from config import config
+from database import DbSession, create_session_factory
+from ledger import account_balance, with_current_balance
+from main import create_async_database_engine, create_database_engine
+from migrations import migrate
+from models import Account, User
+from shards import set_shards
+from webhooks import ingest_payment
+
+HOT_ACCOUNT_ID = 2_000_000
+
+
+async def balance(Session: Callable[[], DbSession], user_id: int) -> float:
+    session = Session()
+    try:
+        account = await session.scalar(
+            with_current_balance(
+                select(Account).filter_by(user_id=user_id, account_id=HOT_ACCOUNT_ID)
+            )
+        )
+        return account_balance(account) if account else 0.0
+    finally:
+        await session.close()
+
+
+async def reshard(Session: Callable[[], DbSession], user_id: int, count: int) -> None:
+    session = Session()
+    try:
+        await set_shards(session, user_id, HOT_ACCOUNT_ID, count)
+    finally:
+        await session.close()
+
+
+async def main(args: argparse.Namespace) -> None:
+    config.ledger.BALANCE_MODE = "row"
+    config.ledger.SHARDING = True
+    config.ledger.SHARD_PICK = args.pick
+
+    sync_engine = create_database_engine()
+    migrate(sync_engine)
+    engine = create_async_database_engine() if config.DB_ASYNC else sync_engine
+    Session = create_session_factory(engine)
+
+    session: DbSession = Session()
+    user_id = await session.scalar(select(User.id).order_by(User.id).limit(1))
+    await session.close()
+    if user_id is None:
+        raise SystemExit("No users in the database, run ./main.py seed first")
+
+    async def per_request(event: Dict[str, Any]) -> str:
+        session = Session()
+        if args.commit_latency_ms:
+            # Задержка перед COMMIT удерживает блокировку строки так же, как
+            # сетевая задержка и fsync на рабочей базе
+            commit = session.commit
+
+            async def slow_commit() -> None:
+                await asyncio.sleep(args.commit_latency_ms / 1000)
+                await commit()
+
+            session.commit = slow_commit  # type: ignore[method-assign]
+        try:
+            return await ingest_payment(session, event)
+        finally:
+            await session.close()
+
+    def hot_events() -> list[Dict[str, Any]]:
+        events = make_events(user_id, args.events, 1, 0)
+        for event in events:
+            event["account_id"] = HOT_ACCOUNT_ID
+        return events
+
+    # Счёт должен существовать до замеров, иначе шардировать нечего
+    await per_request(hot_events()[0])
+
+    report: Dict[str, Any] = {
+        "database": engine.url.render_as_string(hide_password=True),
+        "concurrency": args.concurrency,
+        "shards": args.shards,
+        "pick": args.pick,
+        "commit_latency_ms": args.commit_latency_ms,
+    }
+    for name, shards in (("single_row", 0), ("sharded", args.shards)):
+        await reshard(Session, user_id, shards)
+        before = await balance(Session, user_id)
+        result = await run_load(per_request, hot_events(), args.concurrency)
+        result["balance_delta"] = round(await balance(Session, user_id) - before, 2)
+        report[name] = result
+    # Понижение обратно проверяет перенос сумм шардов в строку счёта
+    before = await balance(Session, user_id)
+    await reshard(Session, user_id, 0)
+    report["demote_balance_delta"] = round(await balance(Session, user_id) - before, 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--shards", type=int, default=16)
+    parser.add_argument("--commit-latency-ms", type=float, default=0)
+    parser.add_argument(
+        "--pick", choices=["random", "round_robin"], default=config.BALANCE_SHARD_PICK
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,130 @@
+# Сравнение записи вебхуков: коммит на каждый запрос против group commit.
+#
+#   python -m benchmarks.webhooks --events 5000 --concurrency 64
+#
+# Используются те же настройки базы, что и у приложения (SANIC_POSTGRES_*,
+# SANIC_DB_ASYNC). Результаты печатаются в JSON.
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List
+
+from sqlalchemy import select
+
+from config import config
+from database import DbSession, create_session_factory
+from main import create_async_database_engine, create_database_engine
+from models import Base, User
+from webhooks import GroupCommitter, ingest_payment
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_load(
+    submit: Callable[[Dict[str, Any]], Awaitable[str]],
+    events: List[Dict[str, Any]],
+    concurrency: int,
+) -> Dict[str, Any]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    outcomes: Dict[str, int] = {}
+
+    async def one(event: Dict[str, Any]) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            result = await submit(event)
+            latencies.append((time.perf_counter() - started) * 1000)
+            outcomes[result] = outcomes.get(result, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(event) for event in events))
+    elapsed = time.perf_counter() - started
+    return {
+        "events": len(events),
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(len(events) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "outcomes": outcomes,
+    }
+
+
+def make_events(
+    user_id: int, count: int, accounts: int, duplicates: float
+) -> List[Dict[str, Any]]:
+    events = [
+        {
+            "transaction_id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "account_id": 1_000_000 + index % accounts,
+            "amount": 1.0,
+        }
+        for index in range(count)
+    ]
+    events.extend(events[: int(count * duplicates)])
+    return events
+
+
+async def main(args: argparse.Namespace) -> None:
+    sync_engine = create_database_engine()
+    Base.metadata.create_all(bind=sync_engine)
+    engine = create_async_database_engine() if config.DB_ASYNC else sync_engine
+    Session = create_session_factory(engine)
+
+    session: DbSession = Session()
+    user_id = await session.scalar(select(User.id).order_by(User.id).limit(1))
+    await session.close()
+    if user_id is None:
+        raise SystemExit("No users in the database, run the app once to seed it")
+
+    async def per_request(event: Dict[str, Any]) -> str:
+        session = Session()
+        try:
+            return await ingest_payment(session, event)
+        finally:
+            await session.close()
+
+    committer = GroupCommitter(
+        Session, window_ms=args.window_ms, max_events=args.max_events
+    )
+    committer.start()
+
+    report = {
+        "database": engine.url.render_as_string(hide_password=True),
+        "concurrency": args.concurrency,
+        "per_request_commit": await run_load(
+            per_request,
+            make_events(user_id, args.events, args.accounts, args.duplicates),
+            args.concurrency,
+        ),
+        "group_commit": await run_load(
+            committer.submit,
+            make_events(user_id, args.events, args.accounts, args.duplicates),
+            args.concurrency,
+        ),
+    }
+    await committer.stop()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--accounts", type=int, default=8)
+    parser.add_argument("--duplicates", type=float, default=0.05)
+    parser.add_argument(
+        "--window-ms", type=int, default=config.WEBHOOK_GROUP_COMMIT_WINDOW_MS
+    )
+    parser.add_argument(
+        "--max-events", type=int, default=config.WEBHOOK_GROUP_COMMIT_MAX_EVENTS
+    )
+    asyncio.run(main(parser.parse_args()))
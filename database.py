@@ -0,0 +1,125 @@
+from typing import Any, AsyncIterator, Callable, Optional, Sequence, TypeVar, Union
+
+from sqlalchemy import Connection, Engine, Result, ScalarResult
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+
+T = TypeVar("T")
+
+
+class SyncStreamResult:
+    def __init__(self, result: Result | ScalarResult) -> None:
+        self.result = result
+
+    async def partitions(
+        self, size: Optional[int] = None
+    ) -> AsyncIterator[Sequence[Any]]:
+        for partition in self.result.partitions(size):
+            yield partition
+
+
+class SyncSessionAdapter:
+    # Оборачивает синхронную Session в интерфейс AsyncSession, чтобы обработчики
+    # были одинаковыми в обоих режимах. Запросы по-прежнему блокируют event loop.
+    def __init__(self, session: Session) -> None:
+        self.sync_session = session
+
+    def add(self, instance: object) -> None:
+        self.sync_session.add(instance)
+
+    def add_all(self, instances: Sequence[object]) -> None:
+        self.sync_session.add_all(instances)
+
+    def get_bind(self) -> Engine | Connection:
+        return self.sync_session.get_bind()
+
+    async def execute(self, statement: Any, params: Optional[Any] = None) -> Result:
+        return self.sync_session.execute(statement, params)
+
+    async def scalar(self, statement: Any, params: Optional[Any] = None) -> Any:
+        return self.sync_session.scalar(statement, params)
+
+    async def scalars(
+        self, statement: Any, params: Optional[Any] = None
+    ) -> ScalarResult:
+        return self.sync_session.scalars(statement, params)
+
+    async def stream(
+        self, statement: Any, params: Optional[Any] = None
+    ) -> SyncStreamResult:
+        return SyncStreamResult(self.sync_session.execute(statement, params))
+
+    async def stream_scalars(
+        self, statement: Any, params: Optional[Any] = None
+    ) -> SyncStreamResult:
+        return SyncStreamResult(self.sync_session.scalars(statement, params))
+
+    async def get(self, entity: type[T], ident: Any) -> Optional[T]:
+        return self.sync_session.get(entity, ident)
+
+    async def delete(self, instance: object) -> None:
+        self.sync_session.delete(instance)
+
+    async def flush(self) -> None:
+        self.sync_session.flush()
+
+    async def commit(self) -> None:
+        self.sync_session.commit()
+
+    async def rollback(self) -> None:
+        self.sync_session.rollback()
+
+    async def close(self) -> None:
+        self.sync_session.close()
+
+    async def run_sync(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        return fn(self.sync_session, *args, **kwargs)
+
+
+DbSession = Union[AsyncSession, SyncSessionAdapter]
+
+
+def dialect_insert(session: DbSession) -> Callable[..., Any]:
+    name = session.get_bind().dialect.name
+    if name == "postgresql":
+        return postgresql.insert
+    if name == "sqlite":
+        return sqlite.insert
+    raise NotImplementedError(f"Upserts are not supported for {name}")
+
+
+class LazySession:
+    # Сессия запроса создаётся при первом обращении к ней: статика, отказы
+    # в доступе и ответы из кэша обходятся без сессии. Соединение из пула
+    # сессия берёт только на первом запросе к базе и отдаёт после commit,
+    # rollback или close.
+    def __init__(self, factory: Callable[[], DbSession]) -> None:
+        self.factory = factory
+        self.session: Optional[DbSession] = None
+
+    def acquire(self) -> DbSession:
+        if self.session is None:
+            self.session = self.factory()
+        return self.session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.acquire(), name)
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+
+def create_session_factory(
+    engine: Union[Engine, AsyncEngine],
+) -> Callable[[], DbSession]:
+    if isinstance(engine, AsyncEngine):
+        return async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+    def factory() -> DbSession:
+        return SyncSessionAdapter(Session())
+
+    return factory
@@ -0,0 +1,99 @@
+import secrets
+import threading
+from collections import OrderedDict
+from multiprocessing import Array
+from typing import Any, Dict, MutableSequence, NamedTuple, Optional, Tuple
+
+from config import config
+
+NOT_MODIFIED = "not_modified"
+HIT = "hit"
+MISS = "miss"
+CACHE_RESULTS = (NOT_MODIFIED, HIT, MISS)
+
+
+class DataVersions:
+    # Версии данных пользователя (профиль, счета, платежи) по слотам user_id в
+    # разделяемой памяти. Запись увеличивает версию слота после коммита, и ETag
+    # со старой версией перестаёт совпадать во всех воркерах. Совпадение слотов
+    # лишь заставляет клиента перечитать данные. Начальное значение случайное,
+    # чтобы после перезапуска старые ETag не совпадали с новыми.
+    def __init__(self, slots: int) -> None:
+        self.versions: MutableSequence[int] = [secrets.randbits(48)] * slots
+        self.lock: Any = threading.Lock()
+
+    @staticmethod
+    def shared_versions(slots: int) -> Any:
+        # С блокировкой: потерянное увеличение оставило бы старую версию у
+        # данных, прочитанных между двумя записями
+        versions = Array("q", slots)
+        versions[:] = [secrets.randbits(48)] * slots
+        return versions
+
+    def bind(self, versions: Any) -> None:
+        self.versions = versions
+        self.lock = versions.get_lock()
+
+    def version(self, user_id: int) -> int:
+        return self.versions[user_id % len(self.versions)]
+
+    def bump(self, user_id: int) -> None:
+        with self.lock:
+            self.versions[user_id % len(self.versions)] += 1
+
+
+class CachedResponse(NamedTuple):
+    version: int
+    status: int
+    body: bytes
+    headers: Dict[str, str]
+    content_type: Optional[str]
+
+
+class ResponseCache:
+    # Готовые ответы воркера по (обработчик, user_id, query string). Запись
+    # действительна, пока версия данных пользователя не изменилась.
+    def __init__(self, max_size: int, max_bytes: int) -> None:
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Tuple[str, int, str], CachedResponse] = OrderedDict()
+
+    def get(self, key: Tuple[str, int, str], version: int) -> Optional[CachedResponse]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry.version != version:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: Tuple[str, int, str], entry: CachedResponse) -> None:
+        # version нужно прочитать до запроса к базе, как и в RoleCache
+        if self.max_size <= 0 or len(entry.body) > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+def make_etag(user_id: int, version: int) -> str:
+    return f'"{user_id}-{version:x}"'
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    # If-None-Match сравнивается слабо: W/ перед значением не учитывается
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+data_versions = DataVersions(config.DATA_VERSION_SLOTS)
+response_cache = ResponseCache(
+    config.RESPONSE_CACHE_SIZE, config.RESPONSE_CACHE_MAX_BYTES
+)
@@ -0,0 +1,225 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+import zlib
+from typing import (
+    IO,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from sanic.log import logger
+from sqlalchemy import Select
+
+from config import config
+from database import DbSession
+from models import Payment
+from pagination import keyset, scan
+from schemas import encoder, export_query, export_row
+
+FORMATS = ("ndjson", "csv")
+CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+COLUMNS = ("id", "transaction_id", "user_id", "account_id", "amount", "created_at")
+
+
+class PaymentExport:
+    # Кодирует порции строк в CSV или NDJSON и при compress сразу сжимает их в
+    # gzip. В памяти только текущая порция; count и last_id показывают, докуда
+    # дошла выгрузка, если она прервалась.
+    def __init__(self, fmt: str, compress: bool, header: bool = True) -> None:
+        self.fmt = fmt
+        self.compressor: Any = (
+            zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            if compress
+            else None
+        )
+        self.header = header and fmt == "csv"
+        self.count = 0
+        self.last_id: Optional[int] = None
+
+    def encode(self, rows: Sequence[Any]) -> bytes:
+        if self.fmt == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            if self.header:
+                writer.writerow(COLUMNS)
+                self.header = False
+            writer.writerows(csv_row(row) for row in rows)
+            data = buffer.getvalue().encode()
+        else:
+            data = encoder.encode_lines([export_row(row) for row in rows])
+        if rows:
+            self.count += len(rows)
+            self.last_id = rows[-1].id
+        return self.compressor.compress(data) if self.compressor else data
+
+    def finish(self) -> bytes:
+        # Заголовок CSV нужен и пустой выгрузке; gzip завершается один раз
+        data = self.encode([]) if self.header else b""
+        if self.compressor is None:
+            return data
+        data += self.compressor.flush()
+        self.compressor = None
+        return data
+
+
+def csv_row(row: Any) -> Tuple[Any, ...]:
+    # Распаковка кортежа заметно быстрее доступа к полям Row по имени
+    *values, created_at = row
+    return (*values, created_at.isoformat() if created_at else None)
+
+
+def export_statement(
+    user_id: Optional[int], after: Optional[int], until: Optional[int]
+) -> Select:
+    # Порядок по id: по последнему полученному id выгрузку можно продолжить
+    statement = keyset(export_query(user_id, until), Payment.id, after)
+    return statement.execution_options(yield_per=config.STREAM_CHUNK_SIZE)
+
+
+async def stream_export(
+    export: PaymentExport,
+    rows: AsyncIterator[Any],
+    send: Callable[[bytes], Awaitable[Any]],
+) -> None:
+    chunk: List[Any] = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= config.STREAM_CHUNK_SIZE:
+            data = export.encode(chunk)
+            chunk = []
+            # Сжатая порция может остаться в буфере zlib целиком
+            if data:
+                await send(data)
+    data = export.encode(chunk) + export.finish()
+    if data:
+        await send(data)
+
+
+def last_exported(path: str, fmt: str, compressed: bool) -> Tuple[Optional[int], int]:
+    # id последней полной строки файла и смещение её конца. Оборванная строка
+    # в несжатом файле отрезается при дозаписи; оборванный gzip (процесс был
+    # убит) продолжить нельзя.
+    last_id: Optional[int] = None
+    end = 0
+    with gzip.open(path, "rb") if compressed else open(path, "rb") as file:
+        try:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                end += len(line)
+                if fmt == "csv":
+                    first = line.split(b",", 1)[0]
+                    if first.isdigit():
+                        last_id = int(first)
+                elif line.strip():
+                    last_id = json.loads(line)["id"]
+        except EOFError:
+            raise SystemExit(
+                f"{path} is truncated, export to a new file with --after {last_id}"
+            )
+    return last_id, end
+
+
+def accepts_gzip(header: str) -> bool:
+    # Accept-Encoding с весами: gzip;q=0 — явный отказ, * без отдельного
+    # gzip разрешает и его
+    wildcard = False
+    for item in header.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        coding = coding.lower()
+        if coding in ("gzip", "x-gzip"):
+            return weight > 0
+        if coding == "*":
+            wildcard = weight > 0
+    return wildcard
+
+
+def resume_point(
+    path: str, fmt: str, compressed: bool
+) -> Optional[Tuple[Optional[int], int]]:
+    # None, если файла ещё нет; несжатый файл обрезается до последней полной
+    # строки
+    if not os.path.exists(path):
+        return None
+    last_id, end = last_exported(path, fmt, compressed)
+    if not compressed:
+        os.truncate(path, end)
+    return last_id, end
+
+
+def open_output(path: str, mode: str) -> IO[bytes]:
+    # stdout дублируется, чтобы закрытие файла не закрыло его у процесса
+    if path == "-":
+        return os.fdopen(os.dup(1), "wb")
+    return open(path, mode)
+
+
+def close_output(file: IO[bytes], data: bytes) -> None:
+    with file:
+        file.write(data)
+
+
+async def export_to_file(
+    session_factory: Callable[[], DbSession],
+    path: str,
+    fmt: str,
+    compress: bool,
+    user_id: Optional[int] = None,
+    after: Optional[int] = None,
+    until: Optional[int] = None,
+    resume: bool = False,
+) -> None:
+    # Файл читается и пишется в потоках, чтобы диск не останавливал цикл
+    # событий между порциями из базы
+    header = True
+    mode = "wb"
+    point = None
+    if resume and path != "-":
+        point = await asyncio.to_thread(resume_point, path, fmt, compress)
+    if point is not None:
+        last_id, end = point
+        if last_id is not None:
+            after = max(after or 0, last_id)
+        header = end == 0
+        mode = "ab"
+        logger.info(f"Resuming {path} after id {after}")
+
+    export = PaymentExport(fmt, compress, header)
+    rows = scan(
+        session_factory,
+        export_statement(user_id, after, until),
+        config.STREAM_CHUNK_SIZE,
+    )
+    # Сжатые данные дописываются новым членом gzip, gzip и zcat читают их подряд
+    file = await asyncio.to_thread(open_output, path, mode)
+
+    async def write(data: bytes) -> None:
+        await asyncio.to_thread(file.write, data)
+
+    try:
+        await stream_export(export, rows, write)
+    finally:
+        await rows.aclose()
+        # При ошибке файл всё равно завершается на последней полной порции
+        await asyncio.to_thread(close_output, file, export.finish())
+        logger.info(
+            f"Exported {export.count} payments to {path}, last id {export.last_id}"
+        )
@@ -0,0 +1,142 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing import Array
+from multiprocessing.sharedctypes import RawArray
+from typing import Any, Dict, Iterator, MutableSequence, Optional
+
+from sqlalchemy import Engine, select
+
+from config import config
+from database import DbSession
+from models import Payment
+
+COUNTERS = ("lru_hits", "bloom_negatives", "bloom_hits", "bloom_false_positives")
+
+
+class BloomFilter:
+    # Битовый массив в разделяемой памяти, общий для всех воркеров. Установка
+    # бита не атомарна между процессами: потерянный бит даёт лишь ложное
+    # "новый", и такой платёж проходит обычный путь с ON CONFLICT.
+    def __init__(self, bits: int, hashes: int) -> None:
+        self.bits = bits
+        self.hashes = hashes
+        self.array: MutableSequence[int] = bytearray(bits // 8 + 1)
+
+    @staticmethod
+    def shared_array(bits: int) -> Any:
+        return RawArray("B", bits // 8 + 1)
+
+    def positions(self, key: str) -> Iterator[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for index in range(self.hashes):
+            yield (first + index * second) % self.bits
+
+    def add(self, key: str) -> None:
+        for position in self.positions(key):
+            self.array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self.array[position >> 3] & (1 << (position & 7))
+            for position in self.positions(key)
+        )
+
+
+class IdempotencyCache:
+    # Быстрый ответ на вопрос "встречался ли transaction_id" до записи в базу:
+    # LRU недавних id воркера отвечает "дубликат" без запроса, фильтр Блума —
+    # "точно новый". Положительный ответ фильтра проверяется в базе, а
+    # уникальный индекс payments остаётся окончательной проверкой.
+    def __init__(self, bits: int, hashes: int, max_size: int) -> None:
+        self.bloom = BloomFilter(bits, hashes)
+        self.max_size = max_size
+        self.recent: OrderedDict[str, None] = OrderedDict()
+        self.counters: MutableSequence[int] = [0] * len(COUNTERS)
+        self.lock: Any = threading.Lock()
+
+    @staticmethod
+    def shared_counters() -> Any:
+        # Создаётся в main_process_start: Array с блокировкой фиксирует способ
+        # запуска процессов, поэтому его нельзя создавать при импорте
+        return Array("q", len(COUNTERS))
+
+    def bind(self, bits: MutableSequence[int], counters: Any) -> None:
+        self.bloom.array = bits
+        self.counters = counters
+        self.lock = counters.get_lock()
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counters[COUNTERS.index(name)] += 1
+
+    def seen(self, transaction_id: str) -> Optional[bool]:
+        # True — точно обработан, False — точно новый, None — нужна проверка
+        if transaction_id in self.recent:
+            self.recent.move_to_end(transaction_id)
+            self.count("lru_hits")
+            return True
+        if transaction_id not in self.bloom:
+            self.count("bloom_negatives")
+            return False
+        return None
+
+    def confirm(self, transaction_id: str, exists: bool) -> None:
+        if exists:
+            self.count("bloom_hits")
+            self.remember(transaction_id)
+        else:
+            self.count("bloom_false_positives")
+
+    def add(self, transaction_id: str) -> None:
+        # Только после коммита: LRU отвечает "дубликат" без обращения к базе
+        self.bloom.add(transaction_id)
+        self.remember(transaction_id)
+
+    def remember(self, transaction_id: str) -> None:
+        if self.max_size <= 0:
+            return
+        self.recent[transaction_id] = None
+        self.recent.move_to_end(transaction_id)
+        while len(self.recent) > self.max_size:
+            self.recent.popitem(last=False)
+
+    def warm_bloom(self, engine: Engine) -> int:
+        count = 0
+        with engine.connect() as conn:
+            result = conn.execution_options(yield_per=10000).scalars(
+                select(Payment.transaction_id)
+            )
+            for transaction_id in result:
+                if transaction_id is not None:
+                    self.bloom.add(transaction_id)
+                    count += 1
+        return count
+
+    async def warm_recent(self, session: DbSession) -> None:
+        recent = await session.scalars(
+            select(Payment.transaction_id)
+            .order_by(Payment.id.desc())
+            .limit(self.max_size)
+        )
+        for transaction_id in reversed(list(recent)):
+            if transaction_id is not None:
+                self.remember(transaction_id)
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(zip(COUNTERS, self.counters[:]))
+        checked = stats["bloom_hits"] + stats["bloom_false_positives"]
+        stats["bloom_false_positive_rate"] = (
+            stats["bloom_false_positives"] / checked if checked else 0.0
+        )
+        stats["recent"] = len(self.recent)
+        return stats
+
+
+idempotency_cache = IdempotencyCache(
+    config.WEBHOOK_IDEMPOTENCY_BLOOM_BITS,
+    config.WEBHOOK_IDEMPOTENCY_BLOOM_HASHES,
+    config.WEBHOOK_IDEMPOTENCY_LRU_SIZE,
+)
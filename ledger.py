@@ -0,0 +1,250 @@
+import asyncio
+from datetime import date, datetime, timezone
+from decimal import ROUND_HALF_EVEN, Decimal
+from typing import Any, Callable, Dict, Optional, Tuple, cast
+
+from sanic.log import logger
+from sqlalchemy import (
+    ColumnElement,
+    Select,
+    Table,
+    and_,
+    bindparam,
+    func,
+    select,
+    update,
+)
+from sqlalchemy.orm import with_expression
+
+from config import config
+from database import DbSession, dialect_insert
+from models import Account, AccountShard, LedgerEntry, Payment, PaymentDaily
+
+# Строка дневной сводки: (user_id, день UTC, account_id, шард) -> (число
+# платежей, сумма в копейках)
+RollupKey = Tuple[int, date, int, int]
+Rollups = Dict[RollupKey, Tuple[int, int]]
+# Строк в одном upsert сводки: SQLite ограничивает число параметров запроса
+ROLLUP_CHUNK_SIZE = 1000
+
+
+def ledger_mode() -> bool:
+    # row: баланс счёта обновляется на месте при каждом платеже (запись в журнал
+    # сразу помечена compacted). ledger: платежи только дописываются в журнал,
+    # а баланс = снимок на счёте + несжатый хвост журнала.
+    return config.BALANCE_MODE == "ledger"
+
+
+def to_minor(amount: float) -> int:
+    value = Decimal(str(amount)) * config.LEDGER_MINOR_UNITS
+    return int(value.to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def from_minor(amount: int) -> float:
+    # SUM по BIGINT в PostgreSQL возвращает numeric (Decimal)
+    return int(amount) / config.LEDGER_MINOR_UNITS
+
+
+def current_balance_minor() -> ColumnElement[Any]:
+    balance = Account.balance_minor.expression
+    if config.BALANCE_SHARDING:
+        balance = balance + (
+            select(func.coalesce(func.sum(AccountShard.balance_minor), 0))
+            .where(AccountShard.account == Account.id)
+            .scalar_subquery()
+        )
+    if not ledger_mode():
+        return balance
+    tail = (
+        select(func.coalesce(func.sum(LedgerEntry.amount_minor), 0))
+        .where(
+            LedgerEntry.user_id == Account.user_id,
+            LedgerEntry.account_id == Account.account_id,
+            LedgerEntry.compacted.is_(False),
+        )
+        .scalar_subquery()
+    )
+    return balance + tail
+
+
+def with_current_balance(statement: Select) -> Select:
+    # Баланс отдаётся из копеек во всех режимах: float-колонка balance
+    # копит ошибку округления (десять платежей по 0.1 дают 0.9999999999999999)
+    return statement.options(
+        with_expression(Account.current_balance_minor, current_balance_minor())
+    )
+
+
+def account_balance(account: Account) -> float:
+    if account.current_balance_minor is None:
+        return from_minor(account.balance_minor)
+    return from_minor(account.current_balance_minor)
+
+
+def utc_day(value: datetime) -> date:
+    # SQLite отдаёт время приёма без зоны, оно записано в UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.date()
+
+
+def add_to_rollup(rollups: Rollups, key: RollupKey, amount_minor: int) -> None:
+    count, total = rollups.get(key, (0, 0))
+    rollups[key] = (count + 1, total + amount_minor)
+
+
+async def apply_rollups(session: DbSession, rollups: Rollups) -> None:
+    # Строки сводки блокируются по порядку ключа, как строки счетов
+    insert = dialect_insert(session)
+    items = sorted(rollups.items())
+    for start in range(0, len(items), ROLLUP_CHUNK_SIZE):
+        statement = insert(PaymentDaily).values(
+            [
+                {
+                    "user_id": user_id,
+                    "day": day,
+                    "account_id": account_id,
+                    "shard": shard,
+                    "amount_minor": minor,
+                    "count": count,
+                }
+                for (user_id, day, account_id, shard), (count, minor) in items[
+                    start : start + ROLLUP_CHUNK_SIZE
+                ]
+            ]
+        )
+        await session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[
+                    PaymentDaily.user_id,
+                    PaymentDaily.day,
+                    PaymentDaily.account_id,
+                    PaymentDaily.shard,
+                ],
+                set_={
+                    "amount_minor": PaymentDaily.amount_minor
+                    + statement.excluded.amount_minor,
+                    "count": PaymentDaily.count + statement.excluded.count,
+                },
+            )
+        )
+
+
+def entry_payments() -> Select:
+    # Записи журнала с временем приёма их платежа: по нему выбирается день
+    # сводки
+    return select(
+        LedgerEntry.user_id,
+        LedgerEntry.account_id,
+        LedgerEntry.amount_minor,
+        Payment.created_at,
+    ).join(
+        Payment,
+        and_(
+            Payment.transaction_id == LedgerEntry.transaction_id,
+            Payment.user_id == LedgerEntry.user_id,
+        ),
+    )
+
+
+def pending_payments_query(user_id: int) -> Select:
+    # Несжатый хвост журнала дополняет сводку в ответах, как и баланс
+    return entry_payments().where(
+        LedgerEntry.user_id == user_id, LedgerEntry.compacted.is_(False)
+    )
+
+
+async def compact_ledger(session: DbSession, limit: int) -> int:
+    # Переносит несжатые записи в снимок на счёте и помечает их compacted в одной
+    # транзакции, поэтому каждая запись учитывается ровно один раз. SKIP LOCKED
+    # позволяет нескольким воркерам сжимать журнал одновременно.
+    entries = (
+        select(LedgerEntry.id)
+        .where(LedgerEntry.compacted.is_(False))
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    ids = list(await session.scalars(entries))
+    if not ids:
+        await session.rollback()
+        return 0
+
+    deltas = await session.execute(
+        select(
+            LedgerEntry.user_id,
+            LedgerEntry.account_id,
+            func.sum(LedgerEntry.amount_minor),
+        )
+        .where(LedgerEntry.id.in_(ids))
+        .group_by(LedgerEntry.user_id, LedgerEntry.account_id)
+    )
+    accounts = cast(Table, Account.__table__)
+    snapshot = accounts.c.balance_minor + bindparam("delta")
+    await session.execute(
+        update(accounts)
+        .where(
+            accounts.c.user_id == bindparam("match_user_id"),
+            accounts.c.account_id == bindparam("match_account_id"),
+        )
+        .values(balance_minor=snapshot, balance=snapshot / config.LEDGER_MINOR_UNITS),
+        [
+            {"match_user_id": user_id, "match_account_id": account_id, "delta": delta}
+            for user_id, account_id, delta in sorted(deltas.tuples())
+        ],
+    )
+    # В режиме ledger сводка пополняется здесь, а не в транзакции вебхука:
+    # иначе каждый платёж снова ждал бы блокировку строки сводки счёта
+    rollups: Rollups = {}
+    payments = await session.execute(entry_payments().where(LedgerEntry.id.in_(ids)))
+    for user_id, account_id, amount_minor, created_at in payments.tuples():
+        add_to_rollup(
+            rollups, (user_id, utc_day(created_at), account_id, 0), amount_minor
+        )
+    await apply_rollups(session, rollups)
+    await session.execute(
+        update(LedgerEntry).where(LedgerEntry.id.in_(ids)).values(compacted=True)
+    )
+    await session.commit()
+    return len(ids)
+
+
+class LedgerCompactor:
+    def __init__(
+        self, session_factory: Callable[[], DbSession], interval: float, batch: int
+    ) -> None:
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch = batch
+        self.task: Optional[asyncio.Task[None]] = None
+
+    def start(self) -> None:
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def compact(self) -> int:
+        total = 0
+        while True:
+            session = self.session_factory()
+            try:
+                compacted = await compact_ledger(session, self.batch)
+            finally:
+                await session.close()
+            total += compacted
+            if compacted < self.batch:
+                return total
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                logger.error(f"Ledger compaction failed: {str(e)}")
@@ -10,36 +10,162 @@
 # readme = "README.md"
 # version = "0.1.0"
 # entry-points = ["main = main:main"]
-# dependencies = ["sqlalchemy[asyncio]", "sanic[ext]", "pydantic_settings", "pydantic", "psycopg2-binary", "pyjwt"]
+# dependencies = ["sqlalchemy[asyncio]", "sanic[ext]", "pydantic_settings", "pydantic", "psycopg2-binary", "asyncpg", "pyjwt", "msgspec"]
 # ///
 
-import json as json_app
+import time
+
+# Отсчёт времени загрузки воркера: импорты ниже входят в фазу imports
+BOOT_STARTED = time.perf_counter()
+
+import argparse
+import asyncio
+import logging
 from contextvars import ContextVar
 from functools import partial
-from typing import Any, Coroutine, Optional
+from typing import Any, Coroutine, Dict, List, Optional, Sequence
+from uuid import uuid4
 
-import jwt
 from dotenv import load_dotenv
 from sanic import Request, Sanic, file, json, text
 from sanic.log import logger
 from sanic.response import HTTPResponse
 from sanic.worker.loader import AppLoader
-from sqlalchemy import Engine, create_engine
+from sqlalchemy import Engine, create_engine, make_url, select
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
+from admission import EXEMPT, GROUPS, SHED_REASONS, AdmissionControl, token_buckets
 from config import config
-from models import Account, Base, User
-from routes import protected, setup_routes
-from utils import hash_password
+from database import LazySession, create_session_factory
+from etags import CACHE_RESULTS, data_versions
+from export import FORMATS, export_to_file
+from idempotency import COUNTERS, BloomFilter, IdempotencyCache, idempotency_cache
+from ledger import LedgerCompactor, ledger_mode
+from metrics import (
+    STATUS_CLASSES,
+    Sample,
+    TimedAsyncQueuePool,
+    TimedQueuePool,
+    instrument_engine,
+    metrics,
+    record_request,
+    route_names,
+    track_request,
+)
+from migrations import MIGRATIONS, applied_versions, migrate, missing_indexes
+from models import Account, User
+from passwords import make_password_hash, password_hasher
+from replicas import ReplicaRouter
+from roles import role_cache
+from routes import authenticate, protected, setup_routes
+from schemas import dumps
+from sharding import (
+    HashRing,
+    ShardRouter,
+    register_emails,
+    shard_session,
+    unregister_ids,
+)
+from tokens import DECODE_RESULTS
+from utils import BootTimer
+from webhooks import OUTCOMES, GroupCommitter, ShardedCommitter
+
+
+def engine_options(url: str, asynchronous: bool) -> Dict[str, Any]:
+    # Пул одинаковый для всех баз воркера: шардов, реплик и единственной базы
+    options: Dict[str, Any] = {
+        "pool_size": config.DB_POOL_SIZE,
+        "max_overflow": config.DB_MAX_OVERFLOW,
+        "pool_timeout": config.DB_POOL_TIMEOUT,
+        "pool_recycle": config.DB_POOL_RECYCLE,
+        "pool_pre_ping": config.DB_POOL_PRE_PING,
+    }
+    if make_url(url).get_backend_name() != "postgresql":
+        return options
+    # PgBouncer не принимает параметры сервера при подключении: там
+    # statement_timeout задаётся ролью (ALTER ROLE ... SET statement_timeout)
+    timeout = config.DB_STATEMENT_TIMEOUT and not config.DB_PGBOUNCER
+    if asynchronous:
+        connect_args: Dict[str, Any] = {"timeout": config.DB_CONNECT_TIMEOUT}
+        if timeout:
+            connect_args["server_settings"] = {
+                "statement_timeout": str(config.DB_STATEMENT_TIMEOUT)
+            }
+        if config.DB_PGBOUNCER:
+            # Соединение с сервером меняется между транзакциями, поэтому
+            # подготовленные выражения не кэшируются и имена у них уникальные
+            connect_args["statement_cache_size"] = 0
+            connect_args["prepared_statement_cache_size"] = 0
+            connect_args["prepared_statement_name_func"] = lambda: (
+                f"__asyncpg_{uuid4()}__"
+            )
+    else:
+        # psycopg2 не готовит выражения на сервере
+        connect_args = {"connect_timeout": config.DB_CONNECT_TIMEOUT}
+        if timeout:
+            connect_args["options"] = (
+                f"-c statement_timeout={config.DB_STATEMENT_TIMEOUT}"
+            )
+    options["connect_args"] = connect_args
+    return options
+
 
+def create_database_engine(url: Optional[str] = None, name: str = "primary") -> Engine:
+    # name — метка database в /metrics
+    url = url or config.DATABASE_URL
+    engine = create_engine(
+        url,
+        echo=config.DEBUG,
+        poolclass=TimedQueuePool,
+        pool_logging_name=name,
+        **engine_options(url, asynchronous=False),
+    )
+    instrument_engine(engine, name)
+    return engine
 
-def create_database_engine() -> Engine:
-    engine = create_engine(config.DATABASE_URL, echo=config.DEBUG, pool_recycle=3600)
+
+def create_async_database_engine(
+    url: Optional[str] = None, name: str = "primary"
+) -> AsyncEngine:
+    url = url or config.ASYNC_DATABASE_URL
+    engine = create_async_engine(
+        url,
+        echo=config.DEBUG,
+        poolclass=TimedAsyncQueuePool,
+        pool_logging_name=name,
+        **engine_options(url, asynchronous=True),
+    )
+    instrument_engine(engine.sync_engine, name)
     return engine
 
 
+def database_names() -> List[str]:
+    shards = [f"shard{index}" for index in range(len(config.DB_SHARD_URLS))]
+    replicas = [f"replica{index}" for index in range(len(config.DB_REPLICA_URLS))]
+    return (shards or ["primary"]) + replicas
+
+
+def create_database_engines() -> List[Engine]:
+    # Все шарды по порядку или единственная база
+    urls: Sequence[Optional[str]] = config.DB_SHARD_URLS or [None]
+    return [
+        create_database_engine(url, name) for url, name in zip(urls, database_names())
+    ]
+
+
+def create_request_engines() -> List[Engine | AsyncEngine]:
+    if not config.DB_ASYNC:
+        return list(create_database_engines())
+    urls: Sequence[Optional[str]] = config.ASYNC_DB_SHARD_URLS or [None]
+    return [
+        create_async_database_engine(url, name)
+        for url, name in zip(urls, database_names())
+    ]
+
+
 def attach_endpoints(app: Sanic) -> None:
-    @app.get("/")
+    @app.get("/", ctx_admission=EXEMPT)
     def handler(request: Request) -> Coroutine[Any, Any, HTTPResponse]:
         return file(location="static/index.html", status=200)
 
@@ -49,69 +175,384 @@ def attach_endpoints(app: Sanic) -> None:
         if not request.token:
             return text("To go fast, you must be fast.")
         else:
-            ans = json_app.dumps(
-                jwt.decode(
-                    request.token, config.SECRET_KEY, algorithms=[config.ALGORITHM]
-                )
-            )
-            ans_d = json_app.loads(ans)
-            return json(ans_d)
+            return json(request.ctx.claims)
+
+    @app.get("/metrics", ctx_admission=EXEMPT)
+    async def metrics_endpoint(request: Request) -> HTTPResponse:
+        if config.METRICS_TOKEN and request.token != config.METRICS_TOKEN:
+            return text("You are unauthorized.", 401)
+        return text(metrics.render(), content_type="text/plain; version=0.0.4")
+
+
+def idempotency_samples() -> List[Sample]:
+    # Счётчики кэша идемпотентности уже общие для воркеров
+    stats = idempotency_cache.stats()
+    return [
+        Sample(
+            "webhook_idempotency_checks_total",
+            "counter",
+            "Idempotency cache answers by kind",
+            {"result": name},
+            stats[name],
+        )
+        for name in COUNTERS
+    ]
+
+
+def replica_samples(replicas: ReplicaRouter) -> List[Sample]:
+    # Состояние реплик по последней проверке воркера, ответившего на запрос
+    return [
+        Sample(
+            "db_replica_healthy",
+            "gauge",
+            "Replica passed the last health check",
+            {"replica": f"replica{index}"},
+            float(replica["healthy"]),
+        )
+        for index, replica in enumerate(replicas.stats())
+    ]
 
 
 def create_app(app_name: str) -> Sanic:
-    app = Sanic(app_name, strict_slashes=False)
-    engine: Engine = create_database_engine()
-    Base.metadata.create_all(bind=engine)
+    # Фабрика выполняется в каждом воркере, поэтому здесь нет DDL и записи
+    # тестовых данных: они выполняются один раз командами migrate и seed.
+    timer = BootTimer(BOOT_STARTED)
+    timer.mark("imports")
+    # Ответы json() кодируются msgspec сразу в bytes, включая схемы из schemas.py
+    app = Sanic(app_name, strict_slashes=False, dumps=dumps)
+    timer.mark("app")
 
-    Session = sessionmaker(bind=engine)
+    request_engines = create_request_engines()
+    factories = [create_session_factory(engine) for engine in request_engines]
+    Session = factories[0]
+    shard_router: Optional[ShardRouter] = None
+    if config.DB_SHARD_URLS:
+        shard_router = ShardRouter(factories, config.DB_SHARD_VNODES)
+    replicas: Optional[ReplicaRouter] = None
+    # Реплики описываются для одной базы и вместе с шардами не используются
+    if config.DB_REPLICA_URLS and shard_router is None:
+        replicas = ReplicaRouter(
+            [
+                create_async_database_engine(url, f"replica{index}")
+                if config.DB_ASYNC
+                else create_database_engine(url, f"replica{index}")
+                for index, url in enumerate(
+                    config.ASYNC_DB_REPLICA_URLS
+                    if config.DB_ASYNC
+                    else config.DB_REPLICA_URLS
+                )
+            ],
+            interval=config.DB_REPLICA_CHECK_INTERVAL,
+            max_lag=config.DB_REPLICA_MAX_LAG,
+            window=config.READ_YOUR_WRITES_WINDOW,
+            slots=config.READ_YOUR_WRITES_SLOTS,
+        )
+    timer.mark("engine")
+    app.ctx.session_factory = Session
+    app.ctx.replicas = replicas
+    app.ctx.shard_router = shard_router
     _base_model_session_ctx: ContextVar = ContextVar("session")
 
+    def read_only(request: Request) -> bool:
+        return request.route is not None and getattr(
+            request.route.ctx, "read_only", False
+        )
+
     async def inject_session(request: Request) -> None:
-        request.ctx.session = Session()
+        if shard_router:
+            # Сессия по умолчанию — шард пользователя из токена, остальные
+            # шарды открываются обработчиками по мере надобности
+            claims = request.ctx.claims
+            shard = shard_router.shard_for(claims["user_id"]) if claims else 0
+            request.ctx.shard_sessions = {}
+            request.ctx.session_factory = shard_router.factories[shard]
+            request.ctx.session = LazySession(partial(shard_session, request, shard))
+            request.ctx.session_ctx_token = _base_model_session_ctx.set(
+                request.ctx.session
+            )
+            return
+        # Обработчики с ctx_read_only читают с реплики, кроме клиентов, которые
+        # недавно сами что-то записали, и чтений пользователя /users/<id>,
+        # данные которого недавно изменились
+        factory = Session
+        if replicas and read_only(request):
+            claims = request.ctx.claims
+            user_ids = [claims["user_id"]] if claims else []
+            if "id" in request.match_info:
+                user_ids.append(request.match_info["id"])
+            if not any(replicas.recently_wrote(user_id) for user_id in user_ids):
+                factory = replicas.session_factory() or Session
+        request.ctx.session_factory = factory
+        request.ctx.from_replica = factory is not Session
+        request.ctx.session = LazySession(factory)
         request.ctx.session_ctx_token = _base_model_session_ctx.set(request.ctx.session)
 
+    # Метрики первыми: во время запроса входит и проверка токена
+    app.register_middleware(track_request, "request")
+    app.register_middleware(record_request, "response")
+    if config.ADMISSION:
+        admission = app.ctx.admission = AdmissionControl()
+        app.register_middleware(admission.admit, "request")
+        app.register_middleware(admission.release, "response")
+
+        async def share_token_buckets(app: Sanic) -> None:
+            app.shared_ctx.token_buckets = token_buckets.shared_values(
+                config.ADMISSION_RATE_SLOTS
+            )
+
+        async def bind_token_buckets(app: Sanic) -> None:
+            if hasattr(app.shared_ctx, "token_buckets"):
+                token_buckets.bind(app.shared_ctx.token_buckets)
+
+        app.register_listener(share_token_buckets, "main_process_start")
+        app.register_listener(bind_token_buckets, "before_server_start")
+    app.register_middleware(authenticate, "request")
     app.register_middleware(inject_session, "request")
 
     async def close_session(request: Request, response: Any) -> None:
         if hasattr(request.ctx, "session_ctx_token"):
             _base_model_session_ctx.reset(request.ctx.session_ctx_token)
-            request.ctx.session.close()
+            await request.ctx.session.close()
+            for session in getattr(request.ctx, "shard_sessions", {}).values():
+                await session.close()
+        if replicas and request.route is not None and not read_only(request):
+            claims = getattr(request.ctx, "claims", None)
+            if claims and response is not None and response.status < 400:
+                replicas.wrote(claims["user_id"])
 
     app.register_middleware(close_session, "response")
 
+    async def dispose_engine(app: Sanic) -> None:
+        for engine in request_engines:
+            if isinstance(engine, AsyncEngine):
+                await engine.dispose()
+            else:
+                engine.dispose()
+
+    app.register_listener(dispose_engine, "after_server_stop")
+
+    if replicas:
+
+        async def share_replica_writes(app: Sanic) -> None:
+            app.shared_ctx.replica_writes = ReplicaRouter.shared_writes(
+                config.READ_YOUR_WRITES_SLOTS
+            )
+
+        async def start_replica_checks(app: Sanic) -> None:
+            if hasattr(app.shared_ctx, "replica_writes"):
+                app.ctx.replicas.bind(app.shared_ctx.replica_writes)
+            await app.ctx.replicas.start()
+
+        async def stop_replica_checks(app: Sanic) -> None:
+            await app.ctx.replicas.stop()
+            await app.ctx.replicas.dispose()
+
+        app.register_listener(share_replica_writes, "main_process_start")
+        app.register_listener(start_replica_checks, "before_server_start")
+        app.register_listener(stop_replica_checks, "after_server_stop")
+
+    async def shutdown_password_hasher(app: Sanic) -> None:
+        password_hasher.shutdown()
+
+    app.register_listener(shutdown_password_hasher, "after_server_stop")
+
+    async def share_role_versions(app: Sanic) -> None:
+        app.shared_ctx.role_versions = role_cache.shared_versions(
+            config.ROLE_CACHE_SLOTS
+        )
+
+    async def bind_role_versions(app: Sanic) -> None:
+        if hasattr(app.shared_ctx, "role_versions"):
+            role_cache.bind(app.shared_ctx.role_versions)
+
+    app.register_listener(share_role_versions, "main_process_start")
+    app.register_listener(bind_role_versions, "before_server_start")
+
+    async def share_data_versions(app: Sanic) -> None:
+        app.shared_ctx.data_versions = data_versions.shared_versions(
+            config.DATA_VERSION_SLOTS
+        )
+
+    async def bind_data_versions(app: Sanic) -> None:
+        if hasattr(app.shared_ctx, "data_versions"):
+            data_versions.bind(app.shared_ctx.data_versions)
+
+    if config.ETAGS:
+        app.register_listener(share_data_versions, "main_process_start")
+        app.register_listener(bind_data_versions, "before_server_start")
+
+    if config.WEBHOOK_IDEMPOTENCY_CACHE:
+        # Фильтр Блума заполняется один раз в главном процессе и наследуется
+        # воркерами через разделяемую память; LRU у каждого воркера свой
+        async def share_idempotency_cache(app: Sanic) -> None:
+            app.shared_ctx.idempotency_bits = BloomFilter.shared_array(
+                config.WEBHOOK_IDEMPOTENCY_BLOOM_BITS
+            )
+            app.shared_ctx.idempotency_counters = IdempotencyCache.shared_counters()
+            idempotency_cache.bind(
+                app.shared_ctx.idempotency_bits, app.shared_ctx.idempotency_counters
+            )
+            warmed = 0
+            for engine in create_database_engines():
+                try:
+                    warmed += idempotency_cache.warm_bloom(engine)
+                finally:
+                    engine.dispose()
+            logger.info(f"Idempotency filter warmed with {warmed} transactions")
+
+        async def bind_idempotency_cache(app: Sanic) -> None:
+            if hasattr(app.shared_ctx, "idempotency_bits"):
+                idempotency_cache.bind(
+                    app.shared_ctx.idempotency_bits,
+                    app.shared_ctx.idempotency_counters,
+                )
+            for factory in factories:
+                session = factory()
+                try:
+                    await idempotency_cache.warm_recent(session)
+                finally:
+                    await session.close()
+
+        app.register_listener(share_idempotency_cache, "main_process_start")
+        app.register_listener(bind_idempotency_cache, "before_server_start")
+
+    app.ctx.group_committer = None
+    if config.WEBHOOK_GROUP_COMMIT:
+        committers = [
+            GroupCommitter(
+                factory,
+                window_ms=config.WEBHOOK_GROUP_COMMIT_WINDOW_MS,
+                max_events=config.WEBHOOK_GROUP_COMMIT_MAX_EVENTS,
+            )
+            for factory in factories
+        ]
+        app.ctx.group_committer = (
+            ShardedCommitter(committers, shard_router.shard_for)
+            if shard_router
+            else committers[0]
+        )
+
+        async def start_group_committer(app: Sanic) -> None:
+            app.ctx.group_committer.start()
+
+        async def stop_group_committer(app: Sanic) -> None:
+            await app.ctx.group_committer.stop()
+
+        app.register_listener(start_group_committer, "after_server_start")
+        app.register_listener(stop_group_committer, "before_server_stop")
+
+    app.ctx.ledger_compactors = []
+    if ledger_mode():
+        # Каждый воркер периодически сжимает журнал каждого шарда; SKIP LOCKED
+        # не даёт им учесть одну запись дважды
+        app.ctx.ledger_compactors = [
+            LedgerCompactor(
+                factory,
+                interval=config.LEDGER_COMPACT_INTERVAL,
+                batch=config.LEDGER_COMPACT_BATCH,
+            )
+            for factory in factories
+        ]
+
+        async def start_ledger_compactor(app: Sanic) -> None:
+            for compactor in app.ctx.ledger_compactors:
+                compactor.start()
+
+        async def stop_ledger_compactor(app: Sanic) -> None:
+            for compactor in app.ctx.ledger_compactors:
+                await compactor.stop()
+
+        app.register_listener(start_ledger_compactor, "after_server_start")
+        app.register_listener(stop_ledger_compactor, "before_server_stop")
+
+    timer.mark("middleware")
+
     attach_endpoints(app)
     setup_routes(app)
-    migrate_test_data(engine=engine)
+    timer.mark("routes")
+
+    # Раскладка метрик строится по маршрутам и базам одинаково в главном
+    # процессе и в каждом воркере, затем воркеры подключают общий массив
+    metrics.allocate(
+        {
+            "route": route_names(app),
+            "status": STATUS_CLASSES,
+            "database": database_names(),
+            "outcome": OUTCOMES,
+            "result": DECODE_RESULTS,
+            "cache": CACHE_RESULTS,
+            "group": GROUPS,
+            "reason": SHED_REASONS,
+        }
+    )
+    if config.WEBHOOK_IDEMPOTENCY_CACHE:
+        metrics.collect(idempotency_samples)
+    if replicas:
+        metrics.collect(partial(replica_samples, replicas))
+
+    async def share_metrics(app: Sanic) -> None:
+        app.shared_ctx.metrics = metrics.shared_values()
+
+    async def bind_metrics(app: Sanic) -> None:
+        if hasattr(app.shared_ctx, "metrics"):
+            metrics.bind(app.shared_ctx.metrics)
+
+    app.register_listener(share_metrics, "main_process_start")
+    app.register_listener(bind_metrics, "before_server_start")
+
+    app.ctx.boot_timings = timer.phases
+    logger.info(f"Worker boot: {timer.summary()}")
     return app
 
 
-def migrate_test_data(engine: Optional[Engine] = None) -> None:
+def migrate_test_data(
+    engine: Optional[Engine] = None, ids: Optional[Dict[str, int]] = None
+) -> None:
+    # ids — user_id из справочника шардов; тогда создаются только
+    # пользователи, которые принадлежат этой базе
     logger.info("Migrating started")
     Session = sessionmaker(bind=engine)
     session = Session()
 
     try:
-        # Создание тестового администратора
-        admin = User(
-            email=config.TEST_ADMIN_EMAIL,
-            password=hash_password(config.SECRET_KEY, config.TEST_ADMIN_PASSWORD),
-            full_name="Test Admin",
-            is_admin=True,
+        existing = set(
+            session.scalars(
+                select(User.email).where(
+                    User.email.in_([config.TEST_ADMIN_EMAIL, config.TEST_USER_EMAIL])
+                )
+            )
         )
 
-        # Создание тестового пользователя
-        user = User(
-            email=config.TEST_USER_EMAIL,
-            password=hash_password(config.SECRET_KEY, config.TEST_USER_PASSWORD),
-            full_name="Test User",
-        )
+        # Создание тестового администратора
+        if config.TEST_ADMIN_EMAIL not in existing and (
+            ids is None or config.TEST_ADMIN_EMAIL in ids
+        ):
+            admin = User(
+                id=ids[config.TEST_ADMIN_EMAIL] if ids else None,
+                email=config.TEST_ADMIN_EMAIL,
+                password=make_password_hash(config.TEST_ADMIN_PASSWORD),
+                full_name="Test Admin",
+                is_admin=True,
+            )
+            session.add(admin)
 
-        # Создание счета для тестового пользователя
-        account = Account(user=user, balance=100.0)
+        # Создание тестового пользователя и счета для него
+        if config.TEST_USER_EMAIL not in existing and (
+            ids is None or config.TEST_USER_EMAIL in ids
+        ):
+            user = User(
+                id=ids[config.TEST_USER_EMAIL] if ids else None,
+                email=config.TEST_USER_EMAIL,
+                password=make_password_hash(config.TEST_USER_PASSWORD),
+                full_name="Test User",
+            )
+            # account_id явно: SQLite не заполняет колонку из Sequence
+            account = Account(
+                user=user, account_id=1, balance=100.0, balance_minor=10000
+            )
+            session.add(user)
+            session.add(account)
 
-        session.add(user)
-        session.add(admin)
-        session.add(account)
         session.commit()
 
         logger.info("Test data migrated successfully")
@@ -119,12 +560,36 @@ def migrate_test_data(engine: Optional[Engine] = None) -> None:
     except Exception as e:
         session.rollback()
         logger.error(f"Error during test data migration: {str(e)}")
+        raise
     finally:
         session.close()
 
 
-if __name__ == "__main__":
-    load_dotenv(".env")
+def seed_shards() -> None:
+    engines = create_database_engines()
+    ring = HashRing(len(engines), config.DB_SHARD_VNODES)
+    ids, created = register_emails(
+        engines[0], [config.TEST_ADMIN_EMAIL, config.TEST_USER_EMAIL]
+    )
+    for index, engine in enumerate(engines):
+        shard_ids = {
+            email: user_id
+            for email, user_id in ids.items()
+            if ring.shard_for(user_id) == index
+        }
+        try:
+            migrate_test_data(engine, shard_ids)
+        except Exception:
+            # Иначе email останется в справочнике без пользователя ни в одном
+            # шарде, и /users/add будет отвечать, что он уже занят
+            unregister_ids(
+                engines[0],
+                [user_id for email, user_id in shard_ids.items() if email in created],
+            )
+            raise
+
+
+def serve() -> None:
     app_name = "PAYMENTS_APP"
     loader = AppLoader(factory=partial(create_app, app_name))
     app = loader.load()
@@ -138,3 +603,113 @@ if __name__ == "__main__":
         auto_reload=config.AUTO_RELOAD,
     )
     Sanic.serve(primary=app, app_loader=loader)
+
+
+if __name__ == "__main__":
+    load_dotenv(".env")
+    parser = argparse.ArgumentParser(description="Payments API")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="serve",
+        choices=["serve", "migrate", "seed", "compact", "export"],
+        help="serve: run the API (default), migrate: apply schema migrations "
+        "(--status and --check only report), "
+        "seed: create test users, compact: fold the ledger into account balances, "
+        "export: write payments to a CSV or NDJSON file",
+    )
+    migrate_args = parser.add_argument_group("migrate")
+    migrate_args.add_argument(
+        "--status", action="store_true", help="list migrations and their state"
+    )
+    migrate_args.add_argument(
+        "--check",
+        action="store_true",
+        help="fail if a lookup made by the handlers has no index",
+    )
+    export_args = parser.add_argument_group("export")
+    export_args.add_argument("--format", choices=FORMATS, default="ndjson")
+    export_args.add_argument(
+        "--output", default="-", help="file path, - for stdout (default)"
+    )
+    export_args.add_argument(
+        "--gzip", action="store_true", help="compress; implied by a .gz output"
+    )
+    export_args.add_argument("--user-id", type=int)
+    export_args.add_argument(
+        "--after", type=int, help="export payments with a greater id"
+    )
+    export_args.add_argument("--until", type=int, help="export payments up to this id")
+    export_args.add_argument("--shard", type=int, help="shard index when sharded")
+    export_args.add_argument(
+        "--resume",
+        action="store_true",
+        help="append to --output after the last exported id",
+    )
+    args = parser.parse_args()
+    command = args.command
+    if command != "serve":
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if command == "migrate":
+        # Все шарды или единственная база
+        missing = False
+        for engine in create_database_engines():
+            url = engine.url.render_as_string(hide_password=True)
+            if args.status:
+                done = applied_versions(engine)
+                logger.info(url)
+                for version, name, _ in MIGRATIONS:
+                    state = "applied" if version in done else "pending"
+                    logger.info(f"{version:>4} {name:<40} {state}")
+            elif args.check:
+                for table, columns, used_by in missing_indexes(engine):
+                    missing = True
+                    logger.info(
+                        f"{url}: missing index on {table}({', '.join(columns)}) "
+                        f"used by {used_by}"
+                    )
+            else:
+                applied = migrate(engine)
+                logger.info(f"Applied migrations on {url}: {applied or 'none'}")
+        if args.check:
+            if missing:
+                raise SystemExit(1)
+            logger.info("All lookups are covered by indexes")
+    elif command == "seed":
+        if config.DB_SHARD_URLS:
+            seed_shards()
+        else:
+            migrate_test_data(create_database_engine())
+    elif command == "compact":
+        for engine in create_database_engines():
+            compactor = LedgerCompactor(
+                create_session_factory(engine),
+                interval=config.LEDGER_COMPACT_INTERVAL,
+                batch=config.LEDGER_COMPACT_BATCH,
+            )
+            compacted = asyncio.run(compactor.compact())
+            logger.info(f"Compacted ledger entries: {compacted}")
+    elif command == "export":
+        engines = create_database_engines()
+        shard = args.shard or 0
+        if args.user_id is not None:
+            shard = HashRing(len(engines), config.DB_SHARD_VNODES).shard_for(
+                args.user_id
+            )
+        elif len(engines) > 1 and args.shard is None:
+            # id платежей уникальны только внутри шарда
+            parser.error("--user-id or --shard is required when sharded")
+        asyncio.run(
+            export_to_file(
+                create_session_factory(engines[shard]),
+                args.output,
+                args.format,
+                args.gzip or args.output.endswith(".gz"),
+                args.user_id,
+                args.after,
+                args.until,
+                args.resume,
+            )
+        )
+    else:
+        serve()
@@ -0,0 +1,362 @@
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from itertools import product
+from multiprocessing import Array
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    MutableSequence,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from sanic import Request, text
+from sanic.log import logger
+from sanic.response import HTTPResponse
+from sqlalchemy import Engine, event, exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, ConnectionPoolEntry, QueuePool
+
+from config import config
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+QUERY_BUCKETS = (0.0, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 50.0, 100.0)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+UNMATCHED = "unmatched"
+
+
+class Sample(NamedTuple):
+    name: str
+    kind: str
+    help: str
+    labels: Dict[str, str]
+    value: float
+
+
+class Family:
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        help: str,
+        labels: Sequence[str],
+        buckets: Sequence[float] = (),
+    ) -> None:
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple[str, ...], int] = {}
+
+    @property
+    def width(self) -> int:
+        # Гистограмма: корзины, +Inf, сумма и количество
+        return len(self.buckets) + 3 if self.kind == "histogram" else 1
+
+
+class Metrics:
+    # Значения всех серий лежат в одном массиве double. В воркерах это общий
+    # Array из main_process_start: каждый воркер прибавляет к общим ячейкам,
+    # поэтому /metrics любого воркера отдаёт сумму по всем процессам. Значения
+    # меток перечисляются заранее, чтобы раскладка совпадала во всех процессах.
+    def __init__(self) -> None:
+        self.families: Dict[str, Family] = {}
+        self.values: MutableSequence[float] = []
+        self.lock: Any = threading.Lock()
+        self.collectors: List[Callable[[], Iterable[Sample]]] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.families[name] = Family(name, "counter", help, labels)
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.families[name] = Family(name, "gauge", help, labels)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        self.families[name] = Family(name, "histogram", help, labels, buckets)
+
+    def allocate(self, label_values: Dict[str, Sequence[str]]) -> None:
+        # Сбрасывает значения и collect(): вызывается из create_app
+        size = 0
+        for family in self.families.values():
+            family.series = {}
+            for labels in product(*(label_values[name] for name in family.labels)):
+                family.series[labels] = size
+                size += family.width
+        self.values = [0.0] * size
+        self.lock = threading.Lock()
+        self.collectors = []
+
+    def shared_values(self) -> Any:
+        # Создаётся в main_process_start после allocate, как и другие Array
+        # с блокировкой
+        return Array("d", len(self.values))
+
+    def bind(self, values: Any) -> None:
+        self.values = values
+        self.lock = values.get_lock()
+
+    def collect(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        # Значения, которые уже где-то подсчитаны, читаются в момент запроса
+        self.collectors.append(collector)
+
+    def offset(self, family: Family, labels: Dict[str, str]) -> Optional[int]:
+        return family.series.get(tuple(labels.get(name, "") for name in family.labels))
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str) -> None:
+        # Серии вне раскладки (и всё до allocate) молча пропускаются
+        offset = self.offset(self.families[name], labels)
+        if offset is None:
+            return
+        with self.lock:
+            self.values[offset] += amount
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        family = self.families[name]
+        offset = self.offset(family, labels)
+        if offset is None:
+            return
+        bucket = bisect.bisect_left(family.buckets, value)
+        with self.lock:
+            self.values[offset + bucket] += 1
+            self.values[offset + len(family.buckets) + 1] += value
+            self.values[offset + len(family.buckets) + 2] += 1
+
+    def render(self) -> str:
+        with self.lock:
+            values = list(self.values[:])
+        lines: List[str] = []
+        for family in self.families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for labels, offset in family.series.items():
+                named = dict(zip(family.labels, labels))
+                if family.kind != "histogram":
+                    lines.append(sample_line(family.name, named, values[offset]))
+                    continue
+                cumulative = 0.0
+                bounds = [str(bound) for bound in family.buckets] + ["+Inf"]
+                for index, bound in enumerate(bounds):
+                    cumulative += values[offset + index]
+                    lines.append(
+                        sample_line(
+                            f"{family.name}_bucket", {**named, "le": bound}, cumulative
+                        )
+                    )
+                total = offset + len(family.buckets) + 1
+                lines.append(sample_line(f"{family.name}_sum", named, values[total]))
+                lines.append(
+                    sample_line(f"{family.name}_count", named, values[total + 1])
+                )
+        described = set(self.families)
+        for collector in self.collectors:
+            for sample in collector():
+                if sample.name not in described:
+                    described.add(sample.name)
+                    lines.append(f"# HELP {sample.name} {sample.help}")
+                    lines.append(f"# TYPE {sample.name} {sample.kind}")
+                lines.append(sample_line(sample.name, sample.labels, sample.value))
+        return "\n".join(lines) + "\n"
+
+
+def sample_line(name: str, labels: Dict[str, str], value: float) -> str:
+    if not labels:
+        return f"{name} {float(value)!r}"
+    escaped = ",".join(
+        '{}="{}"'.format(
+            key,
+            str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for key, label in labels.items()
+    )
+    return f"{name}{{{escaped}}} {float(value)!r}"
+
+
+metrics = Metrics()
+metrics.counter(
+    "http_requests_total", "HTTP requests by route and status", ["route", "status"]
+)
+metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ["route"]
+)
+metrics.histogram(
+    "http_request_db_queries",
+    "Database queries per HTTP request by route",
+    ["route"],
+    QUERY_BUCKETS,
+)
+metrics.histogram(
+    "http_request_db_seconds", "Database time per HTTP request by route", ["route"]
+)
+metrics.counter(
+    "http_request_query_budget_exceeded_total",
+    "HTTP requests over the database query budget by route",
+    ["route"],
+)
+metrics.counter("db_queries_total", "Database queries", ["database"])
+metrics.counter("db_query_seconds_total", "Database query time", ["database"])
+metrics.gauge("db_pool_connections_in_use", "Checked out connections", ["database"])
+metrics.histogram(
+    "db_pool_checkout_wait_seconds", "Time to get a pool connection", ["database"]
+)
+metrics.counter(
+    "db_pool_checkout_timeouts_total",
+    "Pool checkouts that gave up after pool_timeout",
+    ["database"],
+)
+metrics.counter("webhook_events_total", "Webhook events by outcome", ["outcome"])
+metrics.counter(
+    "response_cache_total", "Conditional GET results by cache outcome", ["cache"]
+)
+metrics.gauge("admission_in_flight", "Admitted requests in progress", ["group"])
+metrics.gauge("admission_queued", "Requests waiting for admission", ["group"])
+metrics.counter(
+    "admission_shed_total", "Requests rejected with 503 or 429", ["group", "reason"]
+)
+metrics.histogram("admission_wait_seconds", "Admission queue wait time", ["group"])
+metrics.counter("jwt_decode_total", "Bearer token checks by result", ["result"])
+metrics.histogram("jwt_decode_seconds", "JWT signature check time")
+metrics.gauge("password_hash_queued", "Password operations waiting for a thread")
+metrics.gauge("password_hash_running", "Password operations in progress")
+metrics.counter("password_hash_rejected_total", "Password operations rejected")
+metrics.histogram("password_hash_wait_seconds", "Password operation queue time")
+metrics.histogram("password_hash_seconds", "Password operation run time")
+
+# Счётчики запросов к базе текущего HTTP-запроса: [количество, секунды]
+request_usage: ContextVar[Optional[List[float]]] = ContextVar(
+    "request_usage", default=None
+)
+
+
+def route_name(request: Request) -> str:
+    # Имя обработчика без имени приложения: api.users_list
+    if request.route is None:
+        return UNMATCHED
+    return request.route.name.split(".", 1)[-1]
+
+
+def route_names(app: Any) -> List[str]:
+    return sorted({route.name.split(".", 1)[-1] for route in app.router.routes}) + [
+        UNMATCHED
+    ]
+
+
+async def track_request(request: Request) -> None:
+    request.ctx.metrics_started = time.perf_counter()
+    request.ctx.db_usage = [0.0, 0.0]
+    request_usage.set(request.ctx.db_usage)
+
+
+def query_budget(request: Request) -> int:
+    # Маршрут может задать свой предел: ctx_query_budget=N, 0 — без предела
+    if request.route is None:
+        return config.QUERY_BUDGET
+    return getattr(request.route.ctx, "query_budget", config.QUERY_BUDGET)
+
+
+async def record_request(request: Request, response: Any) -> Optional[HTTPResponse]:
+    # Для потоковых ответов время считается до отправки заголовков
+    if not hasattr(request.ctx, "metrics_started"):
+        return None
+    route = route_name(request)
+    status = getattr(response, "status", 500)
+    queries, db_seconds = request.ctx.db_usage
+    metrics.inc("http_requests_total", route=route, status=f"{status // 100}xx")
+    metrics.observe(
+        "http_request_duration_seconds",
+        time.perf_counter() - request.ctx.metrics_started,
+        route=route,
+    )
+    metrics.observe("http_request_db_queries", queries, route=route)
+    metrics.observe("http_request_db_seconds", db_seconds, route=route)
+
+    # Число запросов обычно растёт с данными из-за N+1 или запросов в цикле
+    budget = query_budget(request)
+    if budget and queries > budget:
+        metrics.inc("http_request_query_budget_exceeded_total", route=route)
+        message = f"{route} issued {queries:.0f} database queries, budget {budget}"
+        logger.warning(message)
+        if config.QUERY_BUDGET_STRICT:
+            return text(message, status=500)
+    return None
+
+
+class TimedQueuePool(QueuePool):
+    # Время ожидания соединения из пула, с меткой pool_logging_name движка
+    def _do_get(self) -> ConnectionPoolEntry:
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            metrics.inc(
+                "db_pool_checkout_timeouts_total", database=self.logging_name or ""
+            )
+            raise
+        finally:
+            metrics.observe(
+                "db_pool_checkout_wait_seconds",
+                time.perf_counter() - started,
+                database=self.logging_name or "",
+            )
+
+
+class TimedAsyncQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    pass
+
+
+def instrument_engine(engine: Engine, database: str) -> None:
+    # Для AsyncEngine передаётся его sync_engine
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn: Any, *args: Any) -> None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn: Any, *args: Any) -> None:
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        metrics.inc("db_queries_total", database=database)
+        metrics.inc("db_query_seconds_total", elapsed, database=database)
+        usage = request_usage.get()
+        if usage is not None:
+            usage[0] += 1
+            usage[1] += elapsed
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context: Any) -> None:
+        if context.connection is not None:
+            started = context.connection.info.get("query_started")
+            if started:
+                started.pop()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(*args: Any) -> None:
+        metrics.inc("db_pool_connections_in_use", database=database)
+
+    @event.listens_for(engine, "checkin")
+    def checkin(*args: Any) -> None:
+        metrics.inc("db_pool_connections_in_use", -1, database=database)
@@ -0,0 +1,434 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Iterator, List, Sequence, Set, Tuple
+
+from sanic.log import logger
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Engine,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy import Sequence as DbSequence
+
+from config import config
+
+MIGRATION_LOCK_ID = 7246351
+
+metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), nullable=False),
+)
+
+# Таблицы в том виде, в каком их создаёт миграция, а не текущие модели:
+# изменения моделей оформляются новыми миграциями, а эти описания не меняются.
+schema = MetaData()
+users_v1 = Table(
+    "users",
+    schema,
+    Column("id", Integer, primary_key=True),
+    Column("email", String, unique=True),
+    Column("password", String),
+    Column("full_name", String),
+    Column("is_admin", Boolean),
+)
+accounts_v1 = Table(
+    "accounts",
+    schema,
+    Column("id", Integer, primary_key=True),
+    Column(
+        "account_id",
+        Integer,
+        DbSequence("account_seq", start=1, increment=1),
+        nullable=False,
+    ),
+    Column("user_id", Integer, ForeignKey("users.id")),
+    Column("balance", Float, nullable=False),
+)
+payments_v1 = Table(
+    "payments",
+    schema,
+    Column("id", Integer, primary_key=True),
+    Column("transaction_id", String, unique=True),
+    Column("account_id", Integer),
+    Column("user_id", Integer, ForeignKey("users.id")),
+    Column("amount", Float, nullable=False),
+)
+ledger_v4 = Table(
+    "ledger",
+    schema,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True),
+    Column("transaction_id", String),
+    Column("user_id", Integer),
+    Column("account_id", Integer),
+    Column("amount_minor", BigInteger, nullable=False),
+    Column("compacted", Boolean, nullable=False),
+    Index(
+        "ix_ledger_pending",
+        "user_id",
+        "account_id",
+        postgresql_where=text("NOT compacted"),
+        sqlite_where=text("NOT compacted"),
+    ),
+)
+account_shards_v5 = Table(
+    "account_shards",
+    schema,
+    Column(
+        "account",
+        Integer,
+        ForeignKey("accounts.id", ondelete="CASCADE"),
+        primary_key=True,
+    ),
+    Column("shard", Integer, primary_key=True),
+    Column("balance", Float, nullable=False),
+    Column("balance_minor", BigInteger, nullable=False),
+)
+user_directory_v6 = Table(
+    "user_directory",
+    schema,
+    Column("id", Integer, primary_key=True),
+    Column("email", String, unique=True, nullable=False),
+)
+payment_daily_v7 = Table(
+    "payment_daily",
+    schema,
+    Column("user_id", Integer, primary_key=True),
+    Column("day", Date, primary_key=True),
+    Column("account_id", Integer, primary_key=True),
+    Column("amount_minor", BigInteger, nullable=False),
+    Column("count", Integer, nullable=False),
+)
+
+
+def create_index(
+    engine: Engine, name: str, table: str, columns: Sequence[str], unique: bool = False
+) -> None:
+    # На PostgreSQL индекс строится CONCURRENTLY, без блокировки записи в таблицу.
+    # Такой запрос нельзя выполнять в транзакции, а после сбоя он оставляет
+    # невалидный индекс, который нужно удалить перед повторной попыткой.
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    columns_sql = ", ".join(columns)
+    if engine.dialect.name == "postgresql":
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            valid = conn.scalar(
+                text(
+                    "SELECT i.indisvalid FROM pg_index i "
+                    "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+                ),
+                {"name": name},
+            )
+            if valid is False:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+            conn.execute(
+                text(
+                    f"CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} "
+                    f"ON {table} ({columns_sql})"
+                )
+            )
+    else:
+        with engine.begin() as conn:
+            conn.execute(
+                text(f"CREATE {kind} IF NOT EXISTS {name} ON {table} ({columns_sql})")
+            )
+
+
+def create_initial_schema(engine: Engine) -> None:
+    # Схема до первой миграции. В базах, где эта миграция ещё создавала схему
+    # по текущим моделям, столбцы миграций 4, 5 и 7 уже есть, поэтому те
+    # проверяют столбцы перед ALTER TABLE.
+    schema.create_all(bind=engine, tables=[users_v1, accounts_v1, payments_v1])
+
+
+def add_accounts_user_account_unique(engine: Engine) -> None:
+    # Дубликаты (user_id, account_id) могли появиться при гонке в старом
+    # process_webhook: балансы сливаются в счёт с наименьшим id.
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "UPDATE accounts SET balance = ("
+                " SELECT SUM(dup.balance) FROM accounts dup"
+                " WHERE dup.user_id = accounts.user_id"
+                " AND dup.account_id = accounts.account_id)"
+                " WHERE id IN ("
+                " SELECT MIN(id) FROM accounts WHERE user_id IS NOT NULL"
+                " GROUP BY user_id, account_id HAVING COUNT(*) > 1)"
+            )
+        )
+        conn.execute(
+            text(
+                "DELETE FROM accounts WHERE user_id IS NOT NULL AND id NOT IN ("
+                " SELECT MIN(id) FROM accounts WHERE user_id IS NOT NULL"
+                " GROUP BY user_id, account_id)"
+            )
+        )
+    create_index(
+        engine,
+        "uq_accounts_user_account",
+        "accounts",
+        ["user_id", "account_id"],
+        unique=True,
+    )
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            exists = conn.scalar(
+                text("SELECT 1 FROM pg_constraint WHERE conname = :name"),
+                {"name": "uq_accounts_user_account"},
+            )
+            if not exists:
+                conn.execute(
+                    text(
+                        "ALTER TABLE accounts ADD CONSTRAINT uq_accounts_user_account "
+                        "UNIQUE USING INDEX uq_accounts_user_account"
+                    )
+                )
+
+
+def add_payments_user_index(engine: Engine) -> None:
+    create_index(engine, "ix_payments_user_id_id", "payments", ["user_id", "id"])
+
+
+def add_ledger(engine: Engine) -> None:
+    # Журнал заполняется уже учтёнными в балансах платежами (compacted), а
+    # снимок balance_minor переносится из текущего balance.
+    ledger_v4.create(bind=engine, checkfirst=True)
+    units = config.LEDGER_MINOR_UNITS
+    columns = {column["name"] for column in inspect(engine).get_columns("accounts")}
+    with engine.begin() as conn:
+        if "balance_minor" not in columns:
+            conn.execute(
+                text(
+                    "ALTER TABLE accounts "
+                    "ADD COLUMN balance_minor BIGINT NOT NULL DEFAULT 0"
+                )
+            )
+        conn.execute(
+            text(
+                "UPDATE accounts SET balance_minor = "
+                "CAST(ROUND(balance * :units) AS BIGINT) "
+                "WHERE balance_minor = 0 AND balance IS NOT NULL AND balance <> 0"
+            ),
+            {"units": units},
+        )
+        conn.execute(
+            text(
+                "INSERT INTO ledger "
+                "(transaction_id, user_id, account_id, amount_minor, compacted) "
+                "SELECT transaction_id, user_id, account_id, "
+                "CAST(ROUND(amount * :units) AS BIGINT), :compacted "
+                "FROM payments WHERE NOT EXISTS (SELECT 1 FROM ledger) "
+                "ORDER BY id"
+            ),
+            {"units": units, "compacted": True},
+        )
+
+
+def add_account_shards(engine: Engine) -> None:
+    account_shards_v5.create(bind=engine, checkfirst=True)
+    columns = {column["name"] for column in inspect(engine).get_columns("accounts")}
+    if "shards" not in columns:
+        with engine.begin() as conn:
+            conn.execute(
+                text(
+                    "ALTER TABLE accounts ADD COLUMN shards INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+
+
+def add_user_directory(engine: Engine) -> None:
+    # Используется только первой базой при SANIC_DB_SHARD_URLS, но создаётся
+    # везде, чтобы любой шард мог стать первым
+    user_directory_v6.create(bind=engine, checkfirst=True)
+
+
+def add_payment_rollups(engine: Engine) -> None:
+    # Существующим платежам проставляется время миграции: настоящее время их
+    # приёма не сохранялось. Сводка заполняется по ним один раз, пока пуста;
+    # миграцию нужно применять до запуска новой версии приложения.
+    columns = {column["name"] for column in inspect(engine).get_columns("payments")}
+    with engine.begin() as conn:
+        if "created_at" not in columns:
+            if engine.dialect.name == "postgresql":
+                conn.execute(
+                    text(
+                        "ALTER TABLE payments ADD COLUMN created_at "
+                        "TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()"
+                    )
+                )
+            else:
+                # SQLite не добавляет столбец с невычислимым заранее DEFAULT
+                conn.execute(
+                    text("ALTER TABLE payments ADD COLUMN created_at DATETIME")
+                )
+                conn.execute(text("UPDATE payments SET created_at = CURRENT_TIMESTAMP"))
+    payment_daily_v7.create(bind=engine, checkfirst=True)
+    day = (
+        "CAST(created_at AT TIME ZONE 'UTC' AS DATE)"
+        if engine.dialect.name == "postgresql"
+        else "date(created_at)"
+    )
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "INSERT INTO payment_daily "
+                "(user_id, day, account_id, amount_minor, count) "
+                f"SELECT user_id, {day}, account_id, "
+                "SUM(CAST(ROUND(amount * :units) AS BIGINT)), COUNT(*) "
+                "FROM payments WHERE user_id IS NOT NULL "
+                "AND account_id IS NOT NULL AND amount IS NOT NULL "
+                "AND NOT EXISTS (SELECT 1 FROM payment_daily) "
+                f"GROUP BY user_id, {day}, account_id"
+            ),
+            {"units": config.LEDGER_MINOR_UNITS},
+        )
+
+
+def add_payment_daily_shards(engine: Engine) -> None:
+    # Строка сводки своя у каждого шарда баланса: столбец shard входит в
+    # первичный ключ. SQLite не меняет первичный ключ, таблица пересоздаётся.
+    columns = {
+        column["name"] for column in inspect(engine).get_columns("payment_daily")
+    }
+    if "shard" in columns:
+        return
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            primary_key = inspect(conn).get_pk_constraint("payment_daily")["name"]
+            conn.execute(
+                text(
+                    "ALTER TABLE payment_daily "
+                    "ADD COLUMN shard INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+            conn.execute(
+                text(
+                    f"ALTER TABLE payment_daily DROP CONSTRAINT {primary_key}, "
+                    "ADD PRIMARY KEY (user_id, day, account_id, shard)"
+                )
+            )
+            return
+        conn.execute(text("ALTER TABLE payment_daily RENAME TO payment_daily_v7"))
+        conn.execute(
+            text(
+                "CREATE TABLE payment_daily ("
+                "user_id INTEGER NOT NULL, day DATE NOT NULL, "
+                "account_id INTEGER NOT NULL, shard INTEGER DEFAULT 0 NOT NULL, "
+                "amount_minor BIGINT NOT NULL, count INTEGER NOT NULL, "
+                "PRIMARY KEY (user_id, day, account_id, shard))"
+            )
+        )
+        conn.execute(
+            text(
+                "INSERT INTO payment_daily "
+                "(user_id, day, account_id, shard, amount_minor, count) "
+                "SELECT user_id, day, account_id, 0, amount_minor, count "
+                "FROM payment_daily_v7"
+            )
+        )
+        conn.execute(text("DROP TABLE payment_daily_v7"))
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Engine], None]]] = [
+    (1, "initial_schema", create_initial_schema),
+    (2, "accounts_user_account_unique", add_accounts_user_account_unique),
+    (3, "payments_user_index", add_payments_user_index),
+    (4, "ledger", add_ledger),
+    (5, "account_shards", add_account_shards),
+    (6, "user_directory", add_user_directory),
+    (7, "payment_rollups", add_payment_rollups),
+    (8, "payment_daily_shards", add_payment_daily_shards),
+]
+
+# Поиски по равенству, которые выполняют обработчики routes.py и webhooks.py.
+# Для каждого нужен индекс, ведущие столбцы которого совпадают с набором.
+LOOKUPS: List[Tuple[str, Tuple[str, ...], str]] = [
+    ("users", ("id",), "is_admin, user_me, user_id, ingest_payment"),
+    ("users", ("email",), "auth"),
+    ("accounts", ("user_id",), "user_accounts, accounts_id"),
+    ("accounts", ("user_id", "account_id"), "ingest_payment, ingest_batch"),
+    ("payments", ("user_id",), "user_payments, payments_id"),
+    ("payments", ("transaction_id",), "ingest_payment, ingest_batch"),
+    ("ledger", ("user_id", "account_id"), "user_accounts, accounts_id"),
+    ("payment_daily", ("user_id",), "user_payments_summary, payments_summary_id"),
+]
+
+
+@contextmanager
+def migration_lock(engine: Engine) -> Iterator[None]:
+    # Несколько процессов могут запустить миграции одновременно
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        conn.commit()
+        try:
+            yield
+        finally:
+            conn.execute(
+                text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID}
+            )
+            conn.commit()
+
+
+def applied_versions(engine: Engine) -> Set[int]:
+    metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        return set(conn.scalars(select(schema_migrations.c.version)))
+
+
+def migrate(engine: Engine) -> List[int]:
+    applied: List[int] = []
+    with migration_lock(engine):
+        done = applied_versions(engine)
+        for version, name, upgrade in MIGRATIONS:
+            if version in done:
+                continue
+            logger.info(f"Applying migration {version} {name}")
+            upgrade(engine)
+            with engine.begin() as conn:
+                conn.execute(
+                    schema_migrations.insert().values(
+                        version=version,
+                        name=name,
+                        applied_at=datetime.now(timezone.utc),
+                    )
+                )
+            applied.append(version)
+    return applied
+
+
+def missing_indexes(engine: Engine) -> List[Tuple[str, Tuple[str, ...], str]]:
+    inspector = inspect(engine)
+    missing = []
+    for table, columns, used_by in LOOKUPS:
+        indexed: List[List[str]] = [
+            inspector.get_pk_constraint(table)["constrained_columns"]
+        ]
+        indexed += [
+            [column for column in index["column_names"] if column]
+            for index in inspector.get_indexes(table)
+        ]
+        indexed += [
+            constraint["column_names"]
+            for constraint in inspector.get_unique_constraints(table)
+        ]
+        if not any(set(index[: len(columns)]) == set(columns) for index in indexed):
+            missing.append((table, columns, used_by))
+    return missing
@@ -1,7 +1,28 @@
-from typing import List
+from typing import List, Optional
 
-from sqlalchemy import Boolean, Column, Float, ForeignKey, Integer, Sequence, String
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    Sequence,
+    String,
+    UniqueConstraint,
+    func,
+    text,
+)
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    Mapped,
+    mapped_column,
+    query_expression,
+    relationship,
+)
 
 
 class Base(DeclarativeBase):
@@ -15,13 +36,19 @@ class User(Base):
     password = Column(String)
     full_name = Column(String)
     is_admin = Column(Boolean, default=False)
-    accounts: Mapped[List["Account"]] = relationship("Account", back_populates="user")
-    accounts = relationship("Account", back_populates="user")
-    payments = relationship("Payment", back_populates="user")
+    # Связи не загружаются лениво: неявный запрос на каждый объект (N+1)
+    # падает сразу, коллекции подгружаются через selectinload
+    accounts: Mapped[List["Account"]] = relationship(
+        "Account", back_populates="user", lazy="raise_on_sql"
+    )
+    payments = relationship("Payment", back_populates="user", lazy="raise_on_sql")
 
 
 class Account(Base):
     __tablename__ = "accounts"
+    __table_args__ = (
+        UniqueConstraint("user_id", "account_id", name="uq_accounts_user_account"),
+    )
     id = Column(Integer, primary_key=True)
     account_id = Column(
         Integer,
@@ -31,15 +58,81 @@ class Account(Base):
         nullable=False,
     )
     user_id = Column(Integer, ForeignKey("users.id"))
-    user: Mapped["User"] = relationship("User", back_populates="accounts")
+    user: Mapped["User"] = relationship(
+        "User", back_populates="accounts", lazy="raise_on_sql"
+    )
     balance: Mapped[float] = mapped_column(Float, default=0.0)
+    # Баланс в минимальных единицах (копейках) на момент последнего сжатия журнала
+    balance_minor: Mapped[int] = mapped_column(
+        BigInteger, default=0, server_default="0", nullable=False
+    )
+    # Число строк-шардов в account_shards; 0 — баланс хранится только в этой строке
+    shards: Mapped[int] = mapped_column(
+        Integer, default=0, server_default="0", nullable=False
+    )
+    # Снимок, несжатый хвост журнала и шарды, загружается через with_expression
+    current_balance_minor: Mapped[Optional[int]] = query_expression()
 
 
 class Payment(Base):
     __tablename__ = "payments"
+    __table_args__ = (Index("ix_payments_user_id_id", "user_id", "id"),)
     id = Column(Integer, primary_key=True)
     transaction_id = Column(String, unique=True)
     account_id = Column(Integer, unique=False)
     user_id = Column(Integer, ForeignKey("users.id"))
     amount: Mapped[float] = mapped_column(Float)
-    user: Mapped["User"] = relationship("User", back_populates="payments")
+    # Время приёма вебхука; по нему платёж попадает в дневную сводку
+    created_at = Column(
+        DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+    user: Mapped["User"] = relationship(
+        "User", back_populates="payments", lazy="raise_on_sql"
+    )
+
+
+class AccountShard(Base):
+    # Части баланса горячего счёта: платёж увеличивает одну из строк, чтобы
+    # параллельные вебхуки не ждали блокировку одной строки accounts.
+    __tablename__ = "account_shards"
+    account = Column(
+        Integer, ForeignKey("accounts.id", ondelete="CASCADE"), primary_key=True
+    )
+    shard = Column(Integer, primary_key=True)
+    balance = Column(Float, nullable=False, default=0.0)
+    balance_minor = Column(BigInteger, nullable=False, default=0)
+
+
+class LedgerEntry(Base):
+    # Неизменяемые записи о движении средств. compacted означает, что сумма уже
+    # учтена в Account.balance_minor.
+    __tablename__ = "ledger"
+    __table_args__ = (
+        Index(
+            "ix_ledger_pending",
+            "user_id",
+            "account_id",
+            postgresql_where=text("NOT compacted"),
+            sqlite_where=text("NOT compacted"),
+        ),
+    )
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
+    transaction_id = Column(String)
+    user_id = Column(Integer)
+    account_id = Column(Integer)
+    amount_minor = Column(BigInteger, nullable=False)
+    compacted = Column(Boolean, nullable=False, default=False)
+
+
+class PaymentDaily(Base):
+    # Сводка платежей по счёту за день (UTC), поэтому сводки не читают таблицу
+    # payments. В режиме row обновляется в транзакции вебхука, у шардированного
+    # счёта — строкой того же шарда, что и баланс. В режиме ledger её
+    # пополняет сжатие журнала.
+    __tablename__ = "payment_daily"
+    user_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    account_id = Column(Integer, primary_key=True)
+    shard = Column(Integer, primary_key=True, default=0, server_default="0")
+    amount_minor = Column(BigInteger, nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
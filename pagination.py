@@ -0,0 +1,159 @@
+import heapq
+from datetime import date
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from sanic import Request
+from sanic.exceptions import BadRequest
+from sqlalchemy import Column, Select
+
+from config import config
+from database import DbSession
+from schemas import encoder
+
+NDJSON = "application/x-ndjson"
+
+
+def int_arg(request: Request, name: str) -> Optional[int]:
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer")
+    if number < 0:
+        raise BadRequest(f"{name} must not be negative")
+    return number
+
+
+def date_arg(request: Request, name: str) -> Optional[date]:
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(f"{name} must be a date (YYYY-MM-DD)")
+
+
+def wants_stream(request: Request) -> bool:
+    flag = request.args.get("stream", "").lower() in ("1", "true", "yes")
+    return flag or NDJSON in request.headers.get("accept", "")
+
+
+def keyset(statement: Select, key: Column[int], after: Optional[int]) -> Select:
+    if after is not None:
+        statement = statement.where(key > after)
+    return statement.order_by(key)
+
+
+async def fetch_page(
+    request: Request, session: DbSession, statement: Select, key: Column[int]
+) -> Tuple[List[Any], Dict[str, str]]:
+    # Страница по ключу id: без limit — SANIC_PAGE_DEFAULT_LIMIT строк, чтобы
+    # ответ не рос вместе с таблицей. Выборка колонками, строки — кортежи с
+    # атрибутами по именам колонок.
+    limit = page_limit(request)
+    statement = keyset(statement, key, int_arg(request, "after"))
+    rows = list(await session.execute(statement.limit(limit)))
+    return rows, next_cursor(rows, key, limit)
+
+
+def page_limit(request: Request) -> int:
+    limit = int_arg(request, "limit") or config.PAGE_DEFAULT_LIMIT
+    return min(limit, config.PAGE_MAX_LIMIT)
+
+
+def next_cursor(rows: List[Any], key: Column[int], limit: int) -> Dict[str, str]:
+    # Заголовок есть всегда; пустой — страница последняя
+    if len(rows) == limit:
+        return {"X-Next-Cursor": str(getattr(rows[-1], key.key))}
+    return {"X-Next-Cursor": ""}
+
+
+def merge_pages(
+    request: Request, pages: Sequence[List[Any]], key: Column[int]
+) -> Tuple[List[Any], Dict[str, str]]:
+    # Страницы шардов уже упорядочены по ключу: слияние и обрезка до limit
+    # дают ту же страницу, что и запрос к одной базе
+    rows = list(heapq.merge(*pages, key=lambda row: getattr(row, key.key)))
+    limit = page_limit(request)
+    rows = rows[:limit]
+    return rows, next_cursor(rows, key, limit)
+
+
+async def stream_ndjson(
+    request: Request,
+    statement: Select,
+    key: Column[int],
+    serialize: Callable[[Any], Any],
+    session_factories: Optional[Sequence[Callable[[], DbSession]]] = None,
+) -> None:
+    # Строки читаются серверным курсором порциями по STREAM_CHUNK_SIZE и сразу
+    # отправляются клиентом chunked-ответом, так что память воркера не растёт
+    # с размером выборки. Сессия своя: middleware закрывает request.ctx.session
+    # в момент request.respond(), до начала передачи. Ответ уже отправлен,
+    # поэтому обработчик ничего не возвращает.
+    size = config.STREAM_CHUNK_SIZE
+    statement = keyset(statement, key, int_arg(request, "after"))
+    statement = statement.execution_options(yield_per=size)
+
+    response = await request.respond(content_type=NDJSON)
+    factories = session_factories or [request.ctx.session_factory]
+    scans = [scan(factory, statement, size) for factory in factories]
+    rows = scans[0] if len(scans) == 1 else merge_sorted(scans, key)
+    items: List[Any] = []
+    try:
+        async for row in rows:
+            items.append(serialize(row))
+            if len(items) >= size:
+                await response.send(encoder.encode_lines(items))
+                items = []
+    finally:
+        for scanned in scans:
+            await scanned.aclose()
+    if items:
+        await response.send(encoder.encode_lines(items))
+    await response.eof()
+
+
+async def scan(
+    session_factory: Callable[[], DbSession], statement: Select, size: int
+) -> AsyncGenerator[Any, None]:
+    session = session_factory()
+    try:
+        result = await session.stream(statement)
+        partition: Sequence[Any]
+        async for partition in result.partitions(size):
+            for row in partition:
+                yield row
+    finally:
+        await session.close()
+
+
+async def merge_sorted(
+    scans: Sequence[AsyncIterator[Any]], key: Column[int]
+) -> AsyncIterator[Any]:
+    # Слияние упорядоченных потоков шардов по ключу
+    heap: List[Tuple[Any, int, Any]] = []
+    for index, rows in enumerate(scans):
+        row = await anext(rows, None)
+        if row is not None:
+            heap.append((getattr(row, key.key), index, row))
+    heapq.heapify(heap)
+    while heap:
+        _, index, row = heapq.heappop(heap)
+        yield row
+        following = await anext(scans[index], None)
+        if following is not None:
+            heapq.heappush(heap, (getattr(following, key.key), index, following))
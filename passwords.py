@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, TypeVar
+
+from sanic.exceptions import ServiceUnavailable
+
+from config import config
+from metrics import metrics
+from utils import hash_password
+
+T = TypeVar("T")
+
+SCHEME = "scrypt"
+
+
+def make_password_hash(password: str, n: Optional[int] = None) -> str:
+    # scrypt$n$r$p$соль$хеш, соль своя для каждого пароля
+    n, r, p = n or config.PASSWORD_SCRYPT_N, 8, 1
+    salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode("utf8"), salt=salt, n=n, r=r, p=p, dklen=32)
+    return f"{SCHEME}${n}${r}${p}${salt.hex()}${digest.hex()}"
+
+
+def check_password_hash(stored: str, password: str) -> bool:
+    if not stored:
+        return False
+    if not stored.startswith(f"{SCHEME}$"):
+        # Старый формат: sha512(пароль + SECRET_KEY)
+        legacy = hash_password(config.SECRET_KEY, password)
+        return hmac.compare_digest(legacy.encode("utf8"), stored.encode("utf8"))
+    # Испорченный хеш в базе — неверный пароль, а не 500 на входе
+    try:
+        _, n, r, p, salt, expected = stored.split("$")
+        digest = hashlib.scrypt(
+            password.encode("utf8"),
+            salt=bytes.fromhex(salt),
+            n=int(n),
+            r=int(r),
+            p=int(p),
+            dklen=len(expected) // 2,
+        )
+    except (TypeError, ValueError, OverflowError):
+        return False
+    return hmac.compare_digest(digest.hex().encode(), expected.encode("utf8"))
+
+
+def is_password_hash(value: str) -> bool:
+    # Готовый хеш в формате make_password_hash, например при переносе
+    # пользователей из другой системы
+    parts = value.split("$")
+    if len(parts) != 6 or parts[0] != SCHEME:
+        return False
+    try:
+        n, r, p = (int(part) for part in parts[1:4])
+        bytes.fromhex(parts[4])
+        bytes.fromhex(parts[5])
+    except ValueError:
+        return False
+    return n > 1 and n & (n - 1) == 0 and r > 0 and p > 0 and bool(parts[5])
+
+
+def password_needs_rehash(stored: str) -> bool:
+    if not stored.startswith(f"{SCHEME}$"):
+        return True
+    return int(stored.split("$")[1]) != config.PASSWORD_SCRYPT_N
+
+
+class PasswordHasher:
+    # Хеширование выполняется в отдельном пуле потоков (hashlib отпускает GIL),
+    # чтобы серия логинов не останавливала event loop. Число одновременных
+    # вычислений ограничено размером пула, очередь — max_queue.
+    def __init__(self, workers: int, max_queue: int) -> None:
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_seconds": self.wait_seconds,
+            "run_seconds": self.run_seconds,
+        }
+
+    async def submit(self, fn: Callable[..., T], *args: Any) -> T:
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            metrics.inc("password_hash_rejected_total")
+            raise ServiceUnavailable(
+                "Too many password operations", headers={"Retry-After": "1"}
+            )
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="password-hash"
+            )
+        submitted = time.perf_counter()
+        with self.lock:
+            self.queued += 1
+        metrics.inc("password_hash_queued")
+
+        def run() -> T:
+            started = time.perf_counter()
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_seconds += started - submitted
+            metrics.inc("password_hash_queued", -1)
+            metrics.inc("password_hash_running")
+            metrics.observe("password_hash_wait_seconds", started - submitted)
+            try:
+                return fn(*args)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.run_seconds += elapsed
+                metrics.inc("password_hash_running", -1)
+                metrics.observe("password_hash_seconds", elapsed)
+
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+    async def hash(self, password: str, n: Optional[int] = None) -> str:
+        return await self.submit(make_password_hash, password, n)
+
+    async def hash_many(
+        self, passwords: Sequence[str], n: Optional[int] = None
+    ) -> List[str]:
+        # Пачка занимает не больше workers - 1 потоков: очередь не переполняется,
+        # а входу пользователей остаётся свободный поток
+        semaphore = asyncio.Semaphore(max(1, self.workers - 1))
+
+        async def one(password: str) -> str:
+            async with semaphore:
+                return await self.hash(password, n)
+
+        return list(await asyncio.gather(*(one(password) for password in passwords)))
+
+    async def verify(self, stored: str, password: str) -> bool:
+        return await self.submit(check_password_hash, stored, password)
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+password_hasher = PasswordHasher(
+    config.PASSWORD_HASH_WORKERS, config.PASSWORD_HASH_MAX_QUEUE
+)
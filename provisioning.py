@@ -0,0 +1,291 @@
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+import msgspec
+from sanic import Request
+from sqlalchemy import select
+
+from config import config
+from database import DbSession, dialect_insert
+from models import Account, User
+from passwords import is_password_hash, password_hasher
+from sharding import (
+    ShardRouter,
+    register_email_batch,
+    unregister_many,
+    user_directory,
+)
+
+# Массовое заведение пользователей: NDJSON читается из тела запроса порциями,
+# пароли хешируются в пуле scrypt, пользователи и их счета вставляются
+# многострочными INSERT ... ON CONFLICT DO NOTHING, по транзакции на порцию.
+# Повтор той же выгрузки безопасен: уже заведённые email получают exists.
+
+CREATED = "created"
+EXISTS = "exists"
+INVALID = "invalid"
+ERROR = "error"
+
+
+class UserIn(msgspec.Struct):
+    email: str
+    full_name: Optional[str] = None
+    password: Optional[str] = None
+    # Готовый scrypt-хеш при переносе из другой системы, хешировать не нужно
+    password_hash: Optional[str] = None
+    is_admin: bool = False
+    accounts: List[int] = []
+
+
+class UserStatusOut(msgspec.Struct, omit_defaults=True):
+    line: int
+    email: Optional[str]
+    status: str
+    id: Optional[int] = None
+    error: Optional[str] = None
+
+
+decoder = msgspec.json.Decoder(UserIn)
+users_table: Any = User.__table__
+accounts_table: Any = Account.__table__
+
+
+async def read_lines(request: Request) -> AsyncIterator[bytes]:
+    # Тело читается по мере поступления, в памяти только неполная строка
+    stream: Any = request.stream
+    if stream is None:
+        # Маршрут без stream=True: тело уже прочитано целиком
+        for line in request.body.split(b"\n"):
+            yield line
+        return
+    buffer = b""
+    while True:
+        body = await stream.read()
+        if body is None:
+            break
+        *lines, buffer = (buffer + body).split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+
+def parse_user(line: bytes) -> UserIn:
+    try:
+        user = decoder.decode(line)
+    except msgspec.DecodeError as e:
+        raise ValueError(str(e))
+    user.email = user.email.strip()
+    return user
+
+
+def user_error(user: UserIn) -> Optional[str]:
+    if not user.email:
+        return "email is required"
+    if (user.password is None) == (user.password_hash is None):
+        return "either password or password_hash is required"
+    if user.password_hash is not None and not is_password_hash(user.password_hash):
+        return "password_hash is not a scrypt hash"
+    return None
+
+
+async def hash_passwords(users: Sequence[UserIn]) -> List[str]:
+    # Пароли пачки хешируются с меньшим N, вход пересчитает хеш с полным
+    plain = [user.password or "" for user in users if user.password_hash is None]
+    hashes = iter(await password_hasher.hash_many(plain, config.PASSWORD_BULK_SCRYPT_N))
+    return [user.password_hash or next(hashes) for user in users]
+
+
+async def insert_users(
+    session: DbSession,
+    users: Sequence[UserIn],
+    hashes: Sequence[str],
+    ids: Optional[Dict[str, int]] = None,
+) -> Dict[str, int]:
+    # Пользователи и счета новых пользователей в одной транзакции. ids — id из
+    # справочника при шардировании.
+    rows = [
+        {
+            "email": user.email,
+            "password": password,
+            "full_name": user.full_name,
+            "is_admin": user.is_admin,
+            **({"id": ids[user.email]} if ids else {}),
+        }
+        for user, password in zip(users, hashes)
+    ]
+    # Список параметров, а не values(rows): запрос компилируется один раз и
+    # кэшируется, а insertmanyvalues сам собирает многострочные INSERT
+    insert = dialect_insert(session)
+    result = await session.execute(
+        insert(users_table)
+        .on_conflict_do_nothing(index_elements=[users_table.c.email])
+        .returning(users_table.c.id, users_table.c.email),
+        rows,
+    )
+    created = {email: user_id for user_id, email in result}
+    accounts = [
+        {
+            "user_id": created[user.email],
+            "account_id": account_id,
+            "balance": 0.0,
+            "balance_minor": 0,
+            "shards": 0,
+        }
+        for user in users
+        if user.email in created
+        for account_id in dict.fromkeys(user.accounts)
+    ]
+    if accounts:
+        await session.execute(
+            insert(accounts_table).on_conflict_do_nothing(
+                index_elements=[accounts_table.c.user_id, accounts_table.c.account_id]
+            ),
+            accounts,
+        )
+    await session.commit()
+    return created
+
+
+async def create_users(
+    session_factory: Callable[[], DbSession], users: Sequence[UserIn]
+) -> Dict[str, int]:
+    session = session_factory()
+    try:
+        # Хешировать пароли уже заведённых пользователей незачем
+        emails = [user.email for user in users]
+        existing = set(
+            await session.scalars(select(User.email).where(User.email.in_(emails)))
+        )
+        users = [user for user in users if user.email not in existing]
+        if not users:
+            return {}
+        hashes = await hash_passwords(users)
+        return await insert_users(session, users, hashes)
+    finally:
+        await session.close()
+
+
+async def create_sharded_users(
+    router: ShardRouter, users: Sequence[UserIn]
+) -> Tuple[Dict[str, int], Dict[str, str]]:
+    # id выдаёт справочник после хеширования, чтобы медленный scrypt не держал
+    # зарегистрированные email без пользователей. Шарды пишутся параллельно;
+    # при ошибке шарда его email снимаются со справочника.
+    catalog = router.catalog()
+    try:
+        emails = [user.email for user in users]
+        existing = set(
+            await catalog.scalars(
+                select(user_directory.c.email).where(user_directory.c.email.in_(emails))
+            )
+        )
+        users = [user for user in users if user.email not in existing]
+        if not users:
+            return {}, {}
+        hashes = dict(zip((user.email for user in users), await hash_passwords(users)))
+        ids = await register_email_batch(catalog, [user.email for user in users])
+        groups = router.group(
+            [user for user in users if user.email in ids],
+            lambda user: ids[user.email],
+        )
+
+        async def write(shard: int, items: List[Tuple[int, UserIn]]) -> Dict[str, int]:
+            session = router.factories[shard]()
+            shard_users = [user for _, user in items]
+            try:
+                return await insert_users(
+                    session,
+                    shard_users,
+                    [hashes[user.email] for user in shard_users],
+                    ids,
+                )
+            except Exception:
+                await session.rollback()
+                directory = router.catalog()
+                try:
+                    await unregister_many(
+                        directory, [ids[user.email] for user in shard_users]
+                    )
+                finally:
+                    await directory.close()
+                raise
+            finally:
+                await session.close()
+
+        results = await asyncio.gather(
+            *(write(shard, items) for shard, items in groups.items()),
+            return_exceptions=True,
+        )
+    finally:
+        await catalog.close()
+    created: Dict[str, int] = {}
+    errors: Dict[str, str] = {}
+    for items, result in zip(groups.values(), results):
+        if isinstance(result, BaseException):
+            errors.update((user.email, str(result)) for _, user in items)
+        else:
+            created.update(result)
+    return created, errors
+
+
+async def provision_chunk(
+    request: Request, lines: Sequence[Tuple[int, bytes]]
+) -> List[UserStatusOut]:
+    report: List[UserStatusOut] = []
+    pending: Dict[str, UserStatusOut] = {}
+    users: List[UserIn] = []
+    for number, line in lines:
+        try:
+            user = parse_user(line)
+        except ValueError as e:
+            report.append(UserStatusOut(number, None, INVALID, error=str(e)))
+            continue
+        error = user_error(user)
+        if error:
+            report.append(UserStatusOut(number, user.email, INVALID, error=error))
+            continue
+        status = UserStatusOut(number, user.email, EXISTS)
+        report.append(status)
+        # Повтор email внутри выгрузки: заводится первая строка
+        if user.email not in pending:
+            pending[user.email] = status
+            users.append(user)
+    if not users:
+        return report
+
+    router: Optional[ShardRouter] = request.app.ctx.shard_router
+    errors: Dict[str, str] = {}
+    try:
+        if router is None:
+            created = await create_users(request.ctx.session_factory, users)
+        else:
+            created, errors = await create_sharded_users(router, users)
+    except Exception as e:
+        created = {}
+        errors = {user.email: str(e) for user in users}
+    for email, user_id in created.items():
+        pending[email].status = CREATED
+        pending[email].id = user_id
+    for email, error in errors.items():
+        pending[email].status = ERROR
+        pending[email].error = error
+    return report
+
+
+async def provision_users(
+    request: Request, lines: AsyncIterator[bytes]
+) -> AsyncIterator[List[UserStatusOut]]:
+    # Отчёт отдаётся по порциям, как только порция записана
+    chunk: List[Tuple[int, bytes]] = []
+    number = 0
+    async for line in lines:
+        number += 1
+        if not line.strip():
+            continue
+        chunk.append((number, line))
+        if len(chunk) >= config.USER_BULK_CHUNK_SIZE:
+            yield await provision_chunk(request, chunk)
+            chunk = []
+    if chunk:
+        yield await provision_chunk(request, chunk)
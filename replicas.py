@@ -0,0 +1,127 @@
+import asyncio
+import itertools
+import time
+from multiprocessing.sharedctypes import RawArray
+from typing import Any, Callable, Dict, List, MutableSequence, Optional, Sequence, Union
+
+from sanic.log import logger
+from sqlalchemy import Engine, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from database import DbSession, create_session_factory
+
+# На реплике PostgreSQL — отставание воспроизведения WAL в секундах; NULL на
+# основном сервере и на репликах без воспроизведённых транзакций. Время с
+# последней транзакции растёт и при простое основной базы, поэтому реплика,
+# воспроизведшая всё полученное, отстаёт на 0
+REPLICATION_LAG = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+    " ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class ReplicaRouter:
+    # Раздаёт сессии read-only обработчиков по здоровым репликам по кругу.
+    # Время последней записи клиента хранится в разделяемой памяти по слотам
+    # user_id, чтобы после своей записи клиент в течение window секунд читал с
+    # основной базы в любом воркере. Совпадение слотов лишь отправляет чтение
+    # на основную базу.
+    def __init__(
+        self,
+        engines: Sequence[Union[Engine, AsyncEngine]],
+        interval: float,
+        max_lag: float,
+        window: float,
+        slots: int,
+    ) -> None:
+        self.engines = list(engines)
+        self.factories = [create_session_factory(engine) for engine in engines]
+        self.healthy = [True] * len(self.engines)
+        self.interval = interval
+        self.max_lag = max_lag
+        self.window = window
+        self.writes: MutableSequence[float] = [0.0] * slots
+        self.counter = itertools.count()
+        self.task: Optional[asyncio.Task[None]] = None
+
+    @staticmethod
+    def shared_writes(slots: int) -> Any:
+        return RawArray("d", slots)
+
+    def bind(self, writes: MutableSequence[float]) -> None:
+        self.writes = writes
+
+    def wrote(self, user_id: int) -> None:
+        self.writes[user_id % len(self.writes)] = time.time()
+
+    def recently_wrote(self, user_id: int) -> bool:
+        return time.time() - self.writes[user_id % len(self.writes)] < self.window
+
+    def session_factory(self) -> Optional[Callable[[], DbSession]]:
+        factories = [
+            factory for factory, healthy in zip(self.factories, self.healthy) if healthy
+        ]
+        if not factories:
+            return None
+        return factories[next(self.counter) % len(factories)]
+
+    async def probe(self, engine: Union[Engine, AsyncEngine]) -> Optional[float]:
+        statement = REPLICATION_LAG if engine.dialect.name == "postgresql" else None
+        if isinstance(engine, AsyncEngine):
+            async with engine.connect() as conn:
+                if statement is None:
+                    await conn.execute(text("SELECT 1"))
+                    return None
+                return await conn.scalar(statement)
+        with engine.connect() as conn:
+            if statement is None:
+                conn.execute(text("SELECT 1"))
+                return None
+            return conn.scalar(statement)
+
+    async def check(self) -> None:
+        for index, engine in enumerate(self.engines):
+            try:
+                lag = await asyncio.wait_for(self.probe(engine), self.interval)
+                healthy = lag is None or float(lag) <= self.max_lag
+                reason = f"lag {lag}s"
+            except Exception as e:
+                healthy = False
+                reason = str(e)
+            if healthy != self.healthy[index]:
+                url = engine.url.render_as_string(hide_password=True)
+                state = "healthy" if healthy else f"unhealthy ({reason})"
+                logger.warning(f"Replica {url} is {state}")
+            self.healthy[index] = healthy
+
+    async def start(self) -> None:
+        # Первая проверка до приёма запросов, чтобы не читать с недоступной реплики
+        await self.check()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def dispose(self) -> None:
+        for engine in self.engines:
+            if isinstance(engine, AsyncEngine):
+                await engine.dispose()
+            else:
+                engine.dispose()
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {"url": engine.url.render_as_string(hide_password=True), "healthy": healthy}
+            for engine, healthy in zip(self.engines, self.healthy)
+        ]
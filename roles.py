@@ -0,0 +1,59 @@
+import time
+from collections import OrderedDict
+from multiprocessing.sharedctypes import RawArray
+from typing import Any, MutableSequence, Optional, Tuple
+
+from config import config
+
+
+class RoleCache:
+    # Кэш признака is_admin по user_id. Инвалидация между воркерами идёт через
+    # общий массив версий в разделяемой памяти: update_user/delete_user
+    # увеличивают версию слота пользователя, и записи со старой версией
+    # перестают считаться действительными во всех воркерах.
+    def __init__(self, max_size: int, ttl: int, slots: int) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.versions: MutableSequence[int] = [0] * slots
+        self.entries: OrderedDict[int, Tuple[bool, int, float]] = OrderedDict()
+
+    @staticmethod
+    def shared_versions(slots: int) -> Any:
+        return RawArray("q", slots)
+
+    def bind(self, versions: MutableSequence[int]) -> None:
+        self.versions = versions
+        self.entries.clear()
+
+    def version(self, user_id: int) -> int:
+        return self.versions[user_id % len(self.versions)]
+
+    def get(self, user_id: int) -> Optional[bool]:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        is_admin, version, expires_at = entry
+        if version != self.version(user_id) or expires_at <= time.time():
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return is_admin
+
+    def put(self, user_id: int, is_admin: bool, version: int) -> None:
+        # version нужно прочитать до запроса к базе, иначе можно пропустить
+        # инвалидацию, случившуюся между запросом и записью в кэш
+        if self.max_size <= 0:
+            return
+        self.entries[user_id] = (is_admin, version, time.time() + self.ttl)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self.versions[user_id % len(self.versions)] += 1
+        self.entries.pop(user_id, None)
+
+
+role_cache = RoleCache(
+    config.ROLE_CACHE_SIZE, config.ROLE_CACHE_TTL, config.ROLE_CACHE_SLOTS
+)
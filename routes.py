@@ -1,4 +1,4 @@
-import json as json_app
+import asyncio
 from functools import wraps
 from types import SimpleNamespace
 from typing import Any, Coroutine, Dict, List, Optional
@@ -6,26 +6,100 @@ from typing import Any, Coroutine, Dict, List, Optional
 import jwt
 from sanic import Blueprint, Request, Sanic, text
 from sanic import Config as Config
+from sanic.exceptions import SanicException
 from sanic.response import HTTPResponse, JSONResponse, json
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, select, update
 
+from admission import AUTH, WEBHOOK
 from config import config
-from models import Account, Payment, User
-from utils import hash_password, verify_signature
+from database import DbSession
+from etags import (
+    HIT,
+    MISS,
+    NOT_MODIFIED,
+    CachedResponse,
+    data_versions,
+    etag_matches,
+    make_etag,
+    response_cache,
+)
+from export import (
+    CONTENT_TYPES,
+    FORMATS,
+    PaymentExport,
+    accepts_gzip,
+    export_statement,
+    stream_export,
+)
+from idempotency import idempotency_cache
+from ledger import ledger_mode, pending_payments_query
+from metrics import metrics, route_name
+from models import Account, Payment, PaymentDaily, User
+from pagination import (
+    date_arg,
+    fetch_page,
+    int_arg,
+    merge_pages,
+    scan,
+    stream_ndjson,
+    wants_stream,
+)
+from passwords import password_hasher, password_needs_rehash
+from provisioning import CREATED, provision_users, read_lines
+from roles import role_cache
+from schemas import (
+    account_row,
+    accounts_query,
+    encoder,
+    full_user_query,
+    full_user_row,
+    payment_row,
+    payment_summary,
+    payment_summary_query,
+    payments_query,
+    profile_query,
+    profile_row,
+    recent_payments_query,
+    user_row,
+    users_query,
+)
+from sharding import (
+    ShardRouter,
+    factory_for,
+    register_email,
+    rename_email,
+    session_for,
+    session_for_email,
+    shard_session,
+    unregister,
+)
+from shards import set_shards
+from tokens import decode_token
+from utils import verify_signature, verify_signatures
+from webhooks import (
+    DUPLICATE,
+    ERROR,
+    INVALID,
+    INVALID_SIGNATURE,
+    SUCCESS,
+    USER_NOT_FOUND,
+    GroupCommitter,
+    ShardedCommitter,
+    ingest_batch,
+    ingest_payment,
+    is_valid_event,
+    parse_events,
+)
 
 api = Blueprint("api", url_prefix="/api")
 
 
-def check_token(request: Request) -> bool:
-    if not request.token:
-        return False
+async def authenticate(request: Request) -> None:
+    request.ctx.claims = decode_token(request.token)
 
-    try:
-        jwt.decode(request.token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-    except jwt.exceptions.InvalidTokenError:
-        return False
-    else:
-        return True
+
+def check_token(request: Request) -> bool:
+    return request.ctx.claims is not None
 
 
 def protected(wrapped: Any) -> Coroutine[Any, Any, Any]:
@@ -55,21 +129,23 @@ def is_admin(wrapped: Any) -> Coroutine[Any, Any, Any]:
         ) -> Any:
             if not request.token:
                 return text("Token error")
+            elif not check_token(request):
+                return text("You are unauthorized.", 401)
             else:
-                ans = json_app.dumps(
-                    jwt.decode(
-                        request.token, config.SECRET_KEY, algorithms=[config.ALGORITHM]
+                user_id: int = request.ctx.claims["user_id"]
+                admin = role_cache.get(user_id)
+                if admin is None:
+                    version = role_cache.version(user_id)
+                    session: DbSession = request.ctx.session
+                    admin = await session.scalar(
+                        select(User.is_admin).filter_by(id=user_id)
                     )
-                )
-                ans_d = json_app.loads(ans)
-                session: Session = request.ctx.session
-                user: Optional[User] = (
-                    session.query(User).filter_by(id=ans_d["user_id"]).first()
-                )
-                if not user:
+                    if admin is not None:
+                        role_cache.put(user_id, bool(admin), version)
+                if admin is None:
                     return text("You are unauthorized.", 401)
                 else:
-                    if bool(user.is_admin):
+                    if bool(admin):
                         response = await f(request, *args, **kwargs)
                         return response
                     else:
@@ -80,18 +156,96 @@ def is_admin(wrapped: Any) -> Coroutine[Any, Any, Any]:
     return decorator(wrapped)
 
 
-@api.route("/auth", methods=["POST"])
+def versioned(wrapped: Any) -> Coroutine[Any, Any, Any]:
+    # Условный GET по версии данных пользователя: совпавший If-None-Match
+    # получает 304 без обращения к базе, остальные ответы этой версии берутся
+    # из кэша воркера. Ставится после protected/is_admin.
+    def decorator(f: Any) -> Any:
+        @wraps(f)
+        async def decorated_function(
+            request: Request, *args: Any, **kwargs: Any
+        ) -> Any:
+            if not config.ETAGS or wants_stream(request):
+                return await f(request, *args, **kwargs)
+            user_id: int = kwargs.get("id", request.ctx.claims["user_id"])
+            version = data_versions.version(user_id)
+            headers = {
+                "ETag": make_etag(user_id, version),
+                "Cache-Control": "private, no-cache",
+            }
+            if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+                metrics.inc("response_cache_total", cache=NOT_MODIFIED)
+                return HTTPResponse(status=304, headers=headers)
+
+            key = (route_name(request), user_id, request.query_string)
+            cached = response_cache.get(key, version)
+            if cached is not None:
+                metrics.inc("response_cache_total", cache=HIT)
+                return HTTPResponse(
+                    cached.body,
+                    status=cached.status,
+                    headers={**cached.headers, **headers},
+                    content_type=cached.content_type,
+                )
+
+            metrics.inc("response_cache_total", cache=MISS)
+            response = await f(request, *args, **kwargs)
+            # Реплика может отставать от версии: её ответ не кэшируется и
+            # отдаётся без ETag
+            if getattr(request.ctx, "from_replica", False):
+                return response
+            if response is not None and response.status == 200:
+                response.headers.update(headers)
+                response_cache.put(
+                    key,
+                    CachedResponse(
+                        version,
+                        response.status,
+                        bytes(response.body or b""),
+                        dict(response.headers),
+                        response.content_type,
+                    ),
+                )
+            return response
+
+        return decorated_function
+
+    return decorator(wrapped)
+
+
+def data_changed(request: Request, user_id: int) -> None:
+    # Вызывается после коммита записи данных пользователя. Чтения этого
+    # пользователя, своих или через /users/<id>, на время окна реплик идут в
+    # основную базу.
+    data_versions.bump(user_id)
+    replicas = request.app.ctx.replicas
+    if replicas:
+        replicas.wrote(user_id)
+
+
+@api.route("/auth", methods=["POST"], ctx_admission=AUTH)
 async def auth(request: Request) -> JSONResponse:
     data: Dict[str, Any] = request.json
     email = data.get("email")
-    password = hash_password(config.SECRET_KEY, str(data.get("password")))
-
-    session: Session = request.ctx.session
-
-    user: Optional[User] = session.query(User).filter_by(email=email).first()
-    if not user or user.password != password:
+    password = str(data.get("password"))
+
+    session = await session_for_email(request, str(email))
+    user: Optional[User] = None
+    if session is not None:
+        user = await session.scalar(select(User).filter_by(email=email))
+    if (
+        session is None
+        or not user
+        or not await password_hasher.verify(str(user.password), password)
+    ):
         return json({"error": "Invalid credentials"}, status=401)
 
+    # Старые хеши заменяются на scrypt при первом успешном входе
+    if password_needs_rehash(str(user.password)):
+        new_hash: Any = await password_hasher.hash(password)
+        user.password = new_hash
+        await session.commit()
+
     token = jwt.encode(
         payload={"user_id": user.id},
         key=config.SECRET_KEY,
@@ -106,98 +260,120 @@ async def auth(request: Request) -> JSONResponse:
     )
 
 
-@api.route("/users/me", methods=["GET"])
+@api.route("/users/me", methods=["GET"], ctx_read_only=True)
 @protected
+@versioned
 async def user_me(request: Request) -> HTTPResponse | JSONResponse:
-    session: Session = request.ctx.session
+    session: DbSession = request.ctx.session
 
-    if not request.token:
-        return text("Token error")
+    user = (await session.execute(profile_query(request.ctx.claims["user_id"]))).first()
+    if not user:
+        return json({}, status=200)
     else:
-        ans = json_app.dumps(
-            jwt.decode(request.token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-        )
-        ans_d = json_app.loads(ans)
-        user: Optional[User] = (
-            session.query(User).filter_by(id=ans_d["user_id"]).first()
-        )
-        if not user:
-            return json({}, status=200)
-        else:
-            return json(
-                {"user_id": user.id, "full_name": user.full_name, "email": user.email},
-                status=200,
-            )
+        return json(profile_row(user), status=200)
 
 
-@api.route("/users/me/accounts", methods=["GET"])
+@api.route("/users/me/accounts", methods=["GET"], ctx_read_only=True)
 @protected
-async def user_accounts(request: Request) -> HTTPResponse | JSONResponse:
-    session: Session = request.ctx.session
+@versioned
+async def user_accounts(request: Request) -> Optional[HTTPResponse]:
+    return await list_accounts(request, request.ctx.claims["user_id"])
 
-    if not request.token:
-        return text("Token error")
-    else:
-        ans = json_app.dumps(
-            jwt.decode(request.token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-        )
-        ans_d = json_app.loads(ans)
-        accounts: List[Account] = (
-            session.query(Account).filter_by(user_id=ans_d["user_id"]).all()
-        )
-        if not accounts:
-            return json({}, status=200)
-        else:
-            return json(
-                [
-                    {"id": acc.id, "account_id": acc.account_id, "balance": acc.balance}
-                    for acc in accounts
-                ],
-                status=200,
-            )
+
+@api.route("/users/me/full", methods=["GET"], ctx_read_only=True)
+@protected
+@versioned
+async def user_me_full(request: Request) -> JSONResponse:
+    return await user_full(request, request.ctx.claims["user_id"])
 
 
 @api.route("/users/add", methods=["POST"])
 @is_admin
 async def create_user(request: Request) -> JSONResponse:
     data: Dict[str, Any] = request.json
-    session: Session = request.ctx.session
+    session: DbSession = request.ctx.session
+
+    # При шардировании id выдаёт справочник, он же проверяет уникальность email
+    user_id: Optional[int] = None
+    if request.app.ctx.shard_router:
+        user_id = await register_email(shard_session(request, 0), data["email"])
+        if user_id is None:
+            return json({"error": "User exists"}, status=401)
+        session = session_for(request, user_id)
 
     new_user = User(
+        id=user_id,
         email=data["email"],
-        password=hash_password(config.SECRET_KEY, data["password"]),
+        password=await password_hasher.hash(data["password"]),
         full_name=data["full_name"],
         is_admin=data.get("is_admin", False),
     )
     try:
         session.add(new_user)
-        session.commit()
+        await session.commit()
     except Exception:
+        if user_id is not None:
+            await unregister(shard_session(request, 0), user_id)
         return json({"error": "User exists"}, status=401)
+    # GET /users/<id> до создания мог закэшировать пустой ответ
+    data_changed(request, int(new_user.id))
     return json({"id": new_user.id}, status=201)
 
 
+@api.route("/users/bulk", methods=["POST"], stream=True)
+@is_admin
+async def bulk_users(request: Request) -> Optional[HTTPResponse]:
+    # NDJSON с пользователями в теле, в ответ — NDJSON со статусом каждой
+    # строки. Тело читается и отчёт отправляется по порциям.
+    response = await request.respond(content_type="application/x-ndjson")
+    async for report in provision_users(request, read_lines(request)):
+        for status in report:
+            if status.status == CREATED and status.id is not None:
+                data_changed(request, status.id)
+        await response.send(encoder.encode_lines(report))
+    await response.eof()
+    return None
+
+
 @api.route("/users/update", methods=["POST"])
 @is_admin
 async def update_user(request: Request) -> JSONResponse:
     data: Dict[str, Any] = request.json
-    session: Session = request.ctx.session
-    user: Optional[User] = session.query(User).filter_by(id=data["id"]).first()
+    # id может прийти строкой: версии в разделяемой памяти ищутся по числу
+    try:
+        user_id = int(data["id"])
+    except (KeyError, TypeError, ValueError):
+        return json({"error": "Invalid id"}, status=400)
+    session = session_for(request, user_id)
+    user: Optional[User] = await session.scalar(select(User).filter_by(id=user_id))
     if not user:
         json({"error": "User doesnt exists"}, status=401)
     else:
+        # Новый email сначала занимается в справочнике шардов
+        email = str(user.email)
+        renamed = False
+        if request.app.ctx.shard_router and data.get("email", email) != email:
+            if not await rename_email(
+                shard_session(request, 0), user_id, data["email"]
+            ):
+                return json({"error": "User exists"}, status=401)
+            renamed = True
         user.email = data.get("email", user.email)
         psw = str(data.get("password", ""))
         if psw != "":
-            new_psw: Any = hash_password(config.SECRET_KEY, psw)
-        user.password = new_psw
+            new_psw: Any = await password_hasher.hash(psw)
+            user.password = new_psw
         user.full_name = data.get("full_name", user.full_name)
         user.is_admin = data.get("is_admin", False)
 
         try:
-            session.commit()
+            await session.commit()
         except Exception:
+            if renamed:
+                await rename_email(shard_session(request, 0), user_id, email)
             return json({"error": "User exists"}, status=401)
+        role_cache.invalidate(user_id)
+        data_changed(request, user_id)
     return json({"success": "success"}, status=201)
 
 
@@ -205,166 +381,368 @@ async def update_user(request: Request) -> JSONResponse:
 @is_admin
 async def delete_user(request: Request) -> JSONResponse:
     data: Dict[str, Any] = request.json
-    session: Session = request.ctx.session
     try:
-        user: Optional[User] = session.query(User).filter_by(id=data["id"]).first()
+        user_id = int(data["id"])
+        session = session_for(request, user_id)
+        user: Optional[User] = await session.scalar(select(User).filter_by(id=user_id))
         if not user:
             json({"error": "User doesnt exists"}, status=401)
         else:
-            session.delete(user)
-            session.commit()
+            # Отвязываем счета и платежи одним запросом вместо ленивой загрузки
+            # коллекций, которая невозможна в AsyncSession
+            await session.execute(
+                update(Account).filter_by(user_id=user.id).values(user_id=None)
+            )
+            await session.execute(
+                update(Payment).filter_by(user_id=user.id).values(user_id=None)
+            )
+            await session.execute(delete(PaymentDaily).filter_by(user_id=user.id))
+            await session.execute(delete(User).filter_by(id=user.id))
+            await session.commit()
+            if request.app.ctx.shard_router:
+                await unregister(shard_session(request, 0), user_id)
+            role_cache.invalidate(user_id)
+            data_changed(request, user_id)
     except Exception:
         return json({"error": "User doesnt exists"}, status=401)
     return json({"success": "user deleted"}, status=201)
 
 
-@api.route("/users", methods=["GET"])
+@api.route("/users", methods=["GET"], ctx_read_only=True)
 @is_admin
-async def users_list(request: Request) -> JSONResponse:
-    session: Session = request.ctx.session
+async def users_list(request: Request) -> Optional[HTTPResponse]:
+    session: DbSession = request.ctx.session
+    router: Optional[ShardRouter] = request.app.ctx.shard_router
+    statement = users_query()
+    if wants_stream(request):
+        await stream_ndjson(
+            request,
+            statement,
+            User.id,
+            user_row,
+            router.factories if router else None,
+        )
+        return None
 
-    users: List[User] = session.query(User).all()
-    return json(
-        [
-            {"id": user.id, "email": user.email, "full_name": user.full_name}
-            for user in users
-        ],
-        status=201,
-    )
+    if router:
+        # Каждый шард отдаёт свою страницу, из них собирается общая
+        pages = await router.fan_out(
+            lambda shard: fetch_page(request, shard, statement, User.id)
+        )
+        users, headers = merge_pages(request, [rows for rows, _ in pages], User.id)
+    else:
+        users, headers = await fetch_page(request, session, statement, User.id)
+    return json([user_row(user) for user in users], status=201, headers=headers)
 
 
-@api.route("/users/<id:int>", methods=["GET"])
+@api.route("/users/<id:int>", methods=["GET"], ctx_read_only=True)
 @is_admin
+@versioned
 async def user_id(request: Request, id: int) -> JSONResponse:
-    session: Session = request.ctx.session
+    session = session_for(request, id)
 
-    user: Optional[User] = session.query(User).filter_by(id=id).first()
+    user = (await session.execute(profile_query(id))).first()
     if not user:
         return json({}, status=200)
     else:
-        return json(
-            {"user_id": user.id, "full_name": user.full_name, "email": user.email},
-            status=200,
-        )
+        return json(profile_row(user), status=200)
 
 
-@api.route("/users/<id:int>/payments", methods=["GET"])
+@api.route("/users/<id:int>/payments", methods=["GET"], ctx_read_only=True)
 @is_admin
-async def payments_id(request: Request, id: int) -> JSONResponse:
-    session: Session = request.ctx.session
+@versioned
+async def payments_id(request: Request, id: int) -> Optional[HTTPResponse]:
+    return await list_payments(request, id)
 
-    payments: List[Payment] = session.query(Payment).filter_by(user_id=id).all()
-    if not payments:
-        return json({}, status=200)
-    else:
-        return json(
-            [
-                {
-                    "transaction_id": payment.transaction_id,
-                    "account_id": payment.account_id,
-                    "payment": payment.amount,
-                }
-                for payment in payments
-            ],
-            status=200,
-        )
+
+@api.route("/users/<id:int>/accounts", methods=["GET"], ctx_read_only=True)
+@is_admin
+@versioned
+async def accounts_id(request: Request, id: int) -> Optional[HTTPResponse]:
+    return await list_accounts(request, id)
 
 
-@api.route("/users/<id:int>/accounts", methods=["GET"])
+@api.route("/users/<id:int>/full", methods=["GET"], ctx_read_only=True)
 @is_admin
-async def accounts_id(request: Request, id: int) -> JSONResponse:
-    session: Session = request.ctx.session
+@versioned
+async def user_id_full(request: Request, id: int) -> JSONResponse:
+    return await user_full(request, id)
 
-    accounts: List[Account] = session.query(Account).filter_by(user_id=id).all()
-    if not accounts:
+
+async def user_full(request: Request, user_id: int) -> JSONResponse:
+    # Профиль, счета и последние платежи одним ответом вместо трёх запросов
+    # клиента. Запросов к базе всегда три, сколько бы ни было счетов.
+    limit = min(
+        int_arg(request, "limit") or config.USER_FULL_PAYMENTS, config.PAGE_MAX_LIMIT
+    )
+    session = session_for(request, user_id)
+    user = await session.scalar(full_user_query(user_id))
+    if user is None:
         return json({}, status=200)
+    payments = await session.execute(recent_payments_query(user_id, limit))
+    return json(full_user_row(user, payments), status=200)
+
+
+@api.route("/users/<id:int>/accounts/<account_id:int>/shards", methods=["POST"])
+@is_admin
+async def account_shards(request: Request, id: int, account_id: int) -> JSONResponse:
+    data: Dict[str, Any] = request.json
+    shards = data.get("shards")
+    if (
+        not isinstance(shards, int)
+        or isinstance(shards, bool)
+        or not 0 <= shards <= config.BALANCE_SHARD_MAX
+    ):
+        return json({"error": "Invalid shards"}, status=400)
+    session = session_for(request, id)
+    account = await set_shards(session, id, account_id, shards)
+    if account is None:
+        return json({"error": "Account not found"}, status=404)
+    return json({"account_id": account.account_id, "shards": account.shards})
+
+
+@api.route("/users/me/payments", methods=["GET"], ctx_read_only=True)
+@protected
+@versioned
+async def user_payments(request: Request) -> Optional[HTTPResponse]:
+    return await list_payments(request, request.ctx.claims["user_id"])
+
+
+@api.route("/users/me/payments/summary", methods=["GET"], ctx_read_only=True)
+@protected
+@versioned
+async def user_payments_summary(request: Request) -> JSONResponse:
+    return await summarize_payments(request, request.ctx.claims["user_id"])
+
+
+@api.route("/users/<id:int>/payments/summary", methods=["GET"], ctx_read_only=True)
+@is_admin
+@versioned
+async def payments_summary_id(request: Request, id: int) -> JSONResponse:
+    return await summarize_payments(request, id)
+
+
+async def summarize_payments(request: Request, user_id: int) -> JSONResponse:
+    # Итоги за период from..to включительно (даты UTC) из дневной сводки
+    start = date_arg(request, "from")
+    end = date_arg(request, "to")
+    session = session_for(request, user_id)
+    rows = await session.execute(payment_summary_query(user_id, start, end))
+    pending = (
+        await session.execute(pending_payments_query(user_id)) if ledger_mode() else ()
+    )
+    return json(payment_summary(rows, start, end, pending), status=200)
+
+
+async def list_payments(request: Request, user_id: int) -> Optional[HTTPResponse]:
+    session = session_for(request, user_id)
+    statement = payments_query(user_id)
+    if wants_stream(request):
+        await stream_ndjson(
+            request,
+            statement,
+            Payment.id,
+            payment_row,
+            [factory_for(request, user_id)],
+        )
+        return None
+
+    payments, headers = await fetch_page(request, session, statement, Payment.id)
+    if not payments:
+        return json({}, status=200, headers=headers)
     else:
         return json(
-            [
-                {"id": acc.id, "account_id": acc.account_id, "balance": acc.balance}
-                for acc in accounts
-            ],
+            [payment_row(payment) for payment in payments],
             status=200,
+            headers=headers,
         )
 
 
-@api.route("/users/me/payments", methods=["GET"])
-@protected
-async def user_payments(request: Request) -> HTTPResponse | JSONResponse:
-    session: Session = request.ctx.session
+async def list_accounts(request: Request, user_id: int) -> Optional[HTTPResponse]:
+    session = session_for(request, user_id)
+    statement = accounts_query(user_id)
+    if wants_stream(request):
+        await stream_ndjson(
+            request,
+            statement,
+            Account.id,
+            account_row,
+            [factory_for(request, user_id)],
+        )
+        return None
 
-    if not request.token:
-        return text("Token error")
+    accounts, headers = await fetch_page(request, session, statement, Account.id)
+    if not accounts:
+        return json({}, status=200, headers=headers)
     else:
-        ans = json_app.dumps(
-            jwt.decode(request.token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
-        )
-        ans_d = json_app.loads(ans)
-        payments: List[Payment] = (
-            session.query(Payment).filter_by(user_id=ans_d["user_id"]).all()
-        )
-        if not payments:
-            return json({}, status=200)
-        else:
-            return json(
-                [
-                    {
-                        "transaction_id": payment.transaction_id,
-                        "account_id": payment.account_id,
-                        "payment": payment.amount,
-                    }
-                    for payment in payments
-                ],
-                status=200,
-            )
+        return json([account_row(acc) for acc in accounts], status=200, headers=headers)
+
+
+@api.route("/payments/export", methods=["GET"], ctx_read_only=True)
+@is_admin
+async def export_payments(request: Request) -> Optional[HTTPResponse]:
+    # Все платежи (или платежи user_id) по возрастанию id, с after — после
+    # последнего полученного id. Строки читаются серверным курсором и сразу
+    # отправляются, при Accept-Encoding: gzip — сжатыми.
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in FORMATS:
+        return json({"error": f"format must be one of {', '.join(FORMATS)}"}, 400)
+    user_id = int_arg(request, "user_id")
+    router: Optional[ShardRouter] = request.app.ctx.shard_router
+    factory = request.ctx.session_factory
+    if user_id is not None:
+        factory = factory_for(request, user_id)
+    elif router:
+        # id платежей уникальны только внутри шарда
+        shard = int_arg(request, "shard")
+        if shard is None or shard >= len(router.factories):
+            return json({"error": "user_id or a valid shard is required"}, 400)
+        factory = router.factories[shard]
+
+    compress = accepts_gzip(request.headers.get("accept-encoding", ""))
+    headers = {
+        "Content-Disposition": f'attachment; filename="payments.{fmt}"',
+        "Vary": "Accept-Encoding",
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    statement = export_statement(
+        user_id, int_arg(request, "after"), int_arg(request, "until")
+    )
+    response = await request.respond(content_type=CONTENT_TYPES[fmt], headers=headers)
+    rows = scan(factory, statement, config.STREAM_CHUNK_SIZE)
+    try:
+        await stream_export(PaymentExport(fmt, compress), rows, response.send)
+    finally:
+        await rows.aclose()
+    await response.eof()
+    return None
 
 
-@api.route("/webhook", methods=["POST"])
+@api.route("/webhook", methods=["POST"], ctx_admission=WEBHOOK)
 async def process_webhook(request: Request) -> JSONResponse:
     data = request.json
-    session: Session = request.ctx.session
+    # Поля проверяются до подписи и записи, как в пачке: в group commit одно
+    # испорченное событие иначе попало бы в общую транзакцию окна
+    if not is_valid_event(data):
+        metrics.inc("webhook_events_total", outcome=INVALID)
+        return json({"error": "Invalid event"}, status=400)
     if not verify_signature(data, config.SECRET_KEY):
+        metrics.inc("webhook_events_total", outcome=INVALID_SIGNATURE)
         return json({"error": "Invalid signature"}, status=400)
+    session = session_for(request, data["user_id"])
+    committer: Optional[GroupCommitter | ShardedCommitter] = (
+        request.app.ctx.group_committer
+    )
     try:
-        user: Optional[User] = session.query(User).filter_by(id=data["user_id"]).first()
-        if not user:
-            return json({"error": "User not found"}, status=201)
+        if committer:
+            result = await committer.submit(data)
         else:
-            account: Optional[Account] = (
-                session.query(Account)
-                .filter_by(account_id=data["account_id"], user_id=data["user_id"])
-                .first()
-            )
-            if not account:
-                account = Account(
-                    user_id=data["user_id"], account_id=data["account_id"], balance=0.0
-                )
-                session.add(account)
-                session.commit()
-            if (
-                session.query(Payment)
-                .filter_by(transaction_id=data["transaction_id"])
-                .first()
-            ):
-                return json({"error": "Transaction already processed"}, status=400)
-            payment = Payment(
-                transaction_id=data["transaction_id"],
-                user_id=data["user_id"],
-                account_id=data["account_id"],
-                amount=data["amount"],
-            )
+            result = await ingest_payment(session, data)
+    except Exception as e:
+        # Часть записи могла дойти до базы
+        await session.rollback()
+        data_changed(request, data["user_id"])
+        metrics.inc("webhook_events_total", outcome=ERROR)
+        return json({"error": str(e)}, status=500)
+    metrics.inc("webhook_events_total", outcome=result)
+    if result == SUCCESS:
+        data_changed(request, data["user_id"])
+    if result == USER_NOT_FOUND:
+        return json({"error": "User not found"}, status=201)
+    if result == DUPLICATE:
+        return json({"error": "Transaction already processed"}, status=400)
+    return json({"status": "success"}, status=201)
+
+
+async def ingest_events(request: Request, events: List[Dict[str, Any]]) -> List[str]:
+    router: Optional[ShardRouter] = request.app.ctx.shard_router
+    if router is None:
+        return await ingest_batch(request.ctx.session, events)
+    # Пачка делится по шардам, части записываются параллельно и независимо:
+    # при ошибке повтор всей пачки безопасен благодаря идемпотентности
+    groups = router.group(events, lambda event: event["user_id"])
+    results = await asyncio.gather(
+        *(
+            ingest_batch(shard_session(request, shard), [event for _, event in items])
+            for shard, items in groups.items()
+        )
+    )
+    statuses = [INVALID] * len(events)
+    for items, shard_statuses in zip(groups.values(), results):
+        for (position, _), status in zip(items, shard_statuses):
+            statuses[position] = status
+    return statuses
+
+
+@api.route(
+    "/webhook/batch", methods=["POST"], ctx_admission=WEBHOOK, ctx_query_budget=0
+)
+async def process_webhook_batch(request: Request) -> JSONResponse:
+    session: DbSession = request.ctx.session
+    try:
+        events = parse_events(request.body)
+    except ValueError:
+        return json({"error": "Invalid batch"}, status=400)
+    if len(events) > config.WEBHOOK_BATCH_MAX_EVENTS:
+        return json({"error": "Batch too large"}, status=413)
+
+    statuses: List[str] = [INVALID] * len(events)
+    parsed = [(index, event) for index, event in enumerate(events) if event]
+    signatures = verify_signatures([event for _, event in parsed], config.SECRET_KEY)
+    accepted = []
+    for (index, event), valid in zip(parsed, signatures):
+        if valid:
+            accepted.append((index, event))
+        else:
+            statuses[index] = INVALID_SIGNATURE
 
-            account.balance += data["amount"]
-            session.add(payment)
-            session.commit()
-            return json({"status": "success"}, status=201)
+    try:
+        results = await ingest_events(request, [event for _, event in accepted])
     except Exception as e:
-        session.rollback()
+        # Части пачки по шардам и чанкам могли успеть закоммититься
+        await session.rollback()
+        for user_id in {event["user_id"] for _, event in accepted}:
+            data_changed(request, user_id)
+        metrics.inc("webhook_events_total", len(events), outcome=ERROR)
         return json({"error": str(e)}, status=500)
+    for (index, _), result in zip(accepted, results):
+        statuses[index] = result
+    for user_id in {
+        event["user_id"]
+        for (_, event), result in zip(accepted, results)
+        if result == SUCCESS
+    }:
+        data_changed(request, user_id)
+    for status in statuses:
+        metrics.inc("webhook_events_total", outcome=status)
+
+    return json(
+        [
+            {
+                "transaction_id": event.get("transaction_id") if event else None,
+                "status": status,
+            }
+            for event, status in zip(events, statuses)
+        ],
+        status=200,
+    )
+
+
+@api.route("/webhook/idempotency", methods=["GET"])
+@is_admin
+async def webhook_idempotency(request: Request) -> JSONResponse:
+    return json(idempotency_cache.stats(), status=200)
 
 
 @api.exception(Exception)  # Handle exceptions globally
 async def handle_exception(request: Request, exception: Exception) -> JSONResponse:
+    if isinstance(exception, SanicException):
+        return json(
+            {"error": str(exception)},
+            status=exception.status_code,
+            headers=exception.headers,
+        )
     return json({"error": str(exception)}, status=500)
 
 
@@ -0,0 +1,236 @@
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+import msgspec
+from sqlalchemy import Float, Select, cast, func, select
+from sqlalchemy.orm import selectinload, with_expression
+
+from config import config
+from ledger import account_balance, current_balance_minor, from_minor, utc_day
+from models import Account, Payment, PaymentDaily, User
+
+# Типизированные схемы ответов: msgspec кодирует их сразу в bytes без
+# промежуточных словарей. Порядок полей совпадает с прежними ответами.
+
+
+class UserOut(msgspec.Struct):
+    id: int
+    email: Optional[str]
+    full_name: Optional[str]
+
+
+class ProfileOut(msgspec.Struct):
+    user_id: int
+    full_name: Optional[str]
+    email: Optional[str]
+
+
+class AccountOut(msgspec.Struct):
+    id: int
+    account_id: Optional[int]
+    balance: Optional[float]
+
+
+class PaymentOut(msgspec.Struct):
+    transaction_id: Optional[str]
+    account_id: Optional[int]
+    payment: Optional[float]
+
+
+class PaymentExportOut(msgspec.Struct):
+    id: int
+    transaction_id: Optional[str]
+    user_id: Optional[int]
+    account_id: Optional[int]
+    amount: Optional[float]
+    created_at: Optional[datetime]
+
+
+class AccountTotalOut(msgspec.Struct):
+    account_id: int
+    total: float
+    count: int
+
+
+class DayTotalOut(msgspec.Struct):
+    day: date
+    total: float
+    count: int
+
+
+class PaymentSummaryOut(msgspec.Struct):
+    start: Optional[date] = msgspec.field(name="from")
+    end: Optional[date] = msgspec.field(name="to")
+    total: float = 0.0
+    count: int = 0
+    accounts: List[AccountTotalOut] = []
+    days: List[DayTotalOut] = []
+
+
+class UserFullOut(msgspec.Struct):
+    user_id: int
+    full_name: Optional[str]
+    email: Optional[str]
+    accounts: List[AccountOut]
+    payments: List[PaymentOut]
+
+
+encoder = msgspec.json.Encoder()
+
+
+def dumps(body: Any, **kwargs: Any) -> bytes:
+    # Кодировщик по умолчанию для sanic.response.json
+    return encoder.encode(body)
+
+
+# Выборки колонками: строки приходят кортежами, без сборки ORM-объектов и
+# карты идентичности. id нужен для курсора постраничной выдачи.
+def users_query() -> Select:
+    return select(User.id, User.email, User.full_name)
+
+
+def profile_query(user_id: int) -> Select:
+    return select(User.id, User.full_name, User.email).where(User.id == user_id)
+
+
+def payments_query(user_id: int) -> Select:
+    return select(
+        Payment.id, Payment.transaction_id, Payment.account_id, Payment.amount
+    ).where(Payment.user_id == user_id)
+
+
+def accounts_query(user_id: int) -> Select:
+    # Из копеек во всех режимах, как account_balance; деление в базе даёт тот
+    # же float, что и from_minor
+    balance = cast(current_balance_minor(), Float) / config.LEDGER_MINOR_UNITS
+    return select(Account.id, Account.account_id, balance.label("balance")).where(
+        Account.user_id == user_id
+    )
+
+
+def full_user_query(user_id: int) -> Select:
+    # Пользователь и все его счета за два запроса: счета грузятся одним
+    # SELECT ... WHERE user_id IN (...), баланс — тем же выражением, что и в
+    # accounts_query
+    accounts = selectinload(User.accounts).options(
+        with_expression(Account.current_balance_minor, current_balance_minor())
+    )
+    return select(User).where(User.id == user_id).options(accounts)
+
+
+def recent_payments_query(user_id: int, limit: int) -> Select:
+    # selectinload не ограничивает коллекцию, поэтому последние платежи —
+    # отдельным запросом по индексу (user_id, id)
+    return payments_query(user_id).order_by(Payment.id.desc()).limit(limit)
+
+
+def export_query(user_id: Optional[int], until: Optional[int]) -> Select:
+    # Нижняя граница (after) добавляется через keyset вместе с сортировкой
+    statement = select(
+        Payment.id,
+        Payment.transaction_id,
+        Payment.user_id,
+        Payment.account_id,
+        Payment.amount,
+        Payment.created_at,
+    )
+    if user_id is not None:
+        statement = statement.where(Payment.user_id == user_id)
+    if until is not None:
+        statement = statement.where(Payment.id <= until)
+    return statement
+
+
+def payment_summary_query(
+    user_id: int, start: Optional[date], end: Optional[date]
+) -> Select:
+    # Строк не больше, чем счетов на дни периода
+    statement = (
+        select(
+            PaymentDaily.account_id,
+            PaymentDaily.day,
+            func.sum(PaymentDaily.amount_minor).label("amount_minor"),
+            func.sum(PaymentDaily.count).label("count"),
+        )
+        .where(PaymentDaily.user_id == user_id)
+        .group_by(PaymentDaily.account_id, PaymentDaily.day)
+    )
+    if start is not None:
+        statement = statement.where(PaymentDaily.day >= start)
+    if end is not None:
+        statement = statement.where(PaymentDaily.day <= end)
+    return statement
+
+
+def payment_summary(
+    rows: Iterable[Any],
+    start: Optional[date],
+    end: Optional[date],
+    pending: Iterable[Any] = (),
+) -> PaymentSummaryOut:
+    # Суммы складываются в копейках и переводятся в float в конце. pending —
+    # несжатый хвост журнала в режиме ledger, ещё не попавший в сводку
+    accounts: Dict[int, List[int]] = {}
+    days: Dict[date, List[int]] = {}
+    totals_by_day = [
+        (row.account_id, row.day, int(row.amount_minor), int(row.count)) for row in rows
+    ]
+    for row in pending:
+        day = utc_day(row.created_at)
+        if (start is None or day >= start) and (end is None or day <= end):
+            totals_by_day.append((row.account_id, day, int(row.amount_minor), 1))
+    for account_id, day, amount_minor, count in totals_by_day:
+        for totals in (
+            accounts.setdefault(account_id, [0, 0]),
+            days.setdefault(day, [0, 0]),
+        ):
+            totals[0] += amount_minor
+            totals[1] += count
+    return PaymentSummaryOut(
+        start,
+        end,
+        from_minor(sum(minor for minor, _ in accounts.values())),
+        sum(count for _, count in accounts.values()),
+        [
+            AccountTotalOut(account_id, from_minor(minor), count)
+            for account_id, (minor, count) in sorted(accounts.items())
+        ],
+        [
+            DayTotalOut(day, from_minor(minor), count)
+            for day, (minor, count) in sorted(days.items())
+        ],
+    )
+
+
+def user_row(row: Any) -> UserOut:
+    return UserOut(row.id, row.email, row.full_name)
+
+
+def profile_row(row: Any) -> ProfileOut:
+    return ProfileOut(row.id, row.full_name, row.email)
+
+
+def export_row(row: Any) -> PaymentExportOut:
+    return PaymentExportOut(*row)
+
+
+def account_row(row: Any) -> AccountOut:
+    return AccountOut(row.id, row.account_id, row.balance)
+
+
+def payment_row(row: Any) -> PaymentOut:
+    return PaymentOut(row.transaction_id, row.account_id, row.amount)
+
+
+def full_user_row(user: Any, payments: Iterable[Any]) -> UserFullOut:
+    accounts = sorted(user.accounts, key=lambda account: account.id)
+    return UserFullOut(
+        user.id,
+        user.full_name,
+        user.email,
+        [
+            AccountOut(account.id, account.account_id, account_balance(account))
+            for account in accounts
+        ],
+        [payment_row(payment) for payment in payments],
+    )
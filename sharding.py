@@ -0,0 +1,212 @@
+import asyncio
+import bisect
+import hashlib
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from sanic import Request
+from sqlalchemy import Column, Engine, Integer, MetaData, String, Table, select
+from sqlalchemy.exc import IntegrityError
+
+from database import DbSession, dialect_insert
+
+T = TypeVar("T")
+
+# Справочник пользователей в первом шарде: выдаёт глобальные user_id (по ним
+# выбирается шард) и обеспечивает уникальность email между шардами
+metadata = MetaData()
+user_directory = Table(
+    "user_directory",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("email", String, unique=True, nullable=False),
+)
+
+
+def ring_point(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    # Консистентное хеширование user_id на кольце: у каждого шарда vnodes точек,
+    # пользователь принадлежит шарду первой точки после своего хеша. Точки
+    # зависят только от номера шарда, поэтому новый шард нужно добавлять в
+    # конец списка — тогда переезжает примерно 1/N пользователей.
+    def __init__(self, shards: int, vnodes: int) -> None:
+        self.ring = sorted(
+            (ring_point(f"shard-{index}-{vnode}"), index)
+            for index in range(shards)
+            for vnode in range(vnodes)
+        )
+        self.points = [point for point, _ in self.ring]
+
+    def shard_for(self, user_id: int) -> int:
+        position = bisect.bisect(self.points, ring_point(str(user_id)))
+        return self.ring[position % len(self.ring)][1]
+
+
+class ShardRouter:
+    def __init__(
+        self, factories: Sequence[Callable[[], DbSession]], vnodes: int
+    ) -> None:
+        self.factories = list(factories)
+        self.ring = HashRing(len(self.factories), vnodes)
+
+    def shard_for(self, user_id: int) -> int:
+        return self.ring.shard_for(user_id)
+
+    @property
+    def catalog(self) -> Callable[[], DbSession]:
+        return self.factories[0]
+
+    def group(
+        self, items: Sequence[T], user_id: Callable[[T], int]
+    ) -> Dict[int, List[Tuple[int, T]]]:
+        # Раскладывает элементы по шардам, сохраняя их исходные позиции
+        groups: Dict[int, List[Tuple[int, T]]] = {}
+        for position, item in enumerate(items):
+            shard = self.shard_for(user_id(item))
+            groups.setdefault(shard, []).append((position, item))
+        return groups
+
+    async def fan_out(self, fn: Callable[[DbSession], Awaitable[T]]) -> List[T]:
+        # Один и тот же запрос параллельно во всех шардах, у каждого своя сессия
+        async def run(factory: Callable[[], DbSession]) -> T:
+            session = factory()
+            try:
+                return await fn(session)
+            finally:
+                await session.close()
+
+        return list(await asyncio.gather(*(run(f) for f in self.factories)))
+
+
+def session_for(request: Request, user_id: int) -> DbSession:
+    # Сессия шарда пользователя; сессии создаются один раз на запрос и
+    # закрываются middleware close_session
+    router: Optional[ShardRouter] = request.app.ctx.shard_router
+    if router is None:
+        return request.ctx.session
+    return shard_session(request, router.shard_for(user_id))
+
+
+def shard_session(request: Request, shard: int) -> DbSession:
+    sessions: Dict[int, DbSession] = request.ctx.shard_sessions
+    if shard not in sessions:
+        sessions[shard] = request.app.ctx.shard_router.factories[shard]()
+    return sessions[shard]
+
+
+async def session_for_email(request: Request, email: str) -> Optional[DbSession]:
+    # Вход по email: шард находится через справочник в первой базе
+    router: Optional[ShardRouter] = request.app.ctx.shard_router
+    if router is None:
+        return request.ctx.session
+    user_id = await lookup_email(shard_session(request, 0), email)
+    if user_id is None:
+        return None
+    return session_for(request, user_id)
+
+
+def factory_for(request: Request, user_id: int) -> Callable[[], DbSession]:
+    router: Optional[ShardRouter] = request.app.ctx.shard_router
+    if router is None:
+        return request.ctx.session_factory
+    return router.factories[router.shard_for(user_id)]
+
+
+async def register_email(session: DbSession, email: str) -> Optional[int]:
+    try:
+        user_id = await session.scalar(
+            user_directory.insert().values(email=email).returning(user_directory.c.id)
+        )
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        return None
+    return user_id
+
+
+async def register_email_batch(
+    session: DbSession, emails: Sequence[str]
+) -> Dict[str, int]:
+    # Многострочная регистрация; уже занятые email в результат не попадают
+    rows = await session.execute(
+        dialect_insert(session)(user_directory)
+        .on_conflict_do_nothing(index_elements=[user_directory.c.email])
+        .returning(user_directory.c.id, user_directory.c.email),
+        [{"email": email} for email in emails],
+    )
+    registered = {email: user_id for user_id, email in rows}
+    await session.commit()
+    return registered
+
+
+async def lookup_email(session: DbSession, email: str) -> Optional[int]:
+    return await session.scalar(
+        select(user_directory.c.id).where(user_directory.c.email == email)
+    )
+
+
+async def rename_email(session: DbSession, user_id: int, email: str) -> bool:
+    try:
+        await session.execute(
+            user_directory.update()
+            .where(user_directory.c.id == user_id)
+            .values(email=email)
+        )
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        return False
+    return True
+
+
+async def unregister(session: DbSession, user_id: int) -> None:
+    await session.execute(user_directory.delete().where(user_directory.c.id == user_id))
+    await session.commit()
+
+
+async def unregister_many(session: DbSession, user_ids: Sequence[int]) -> None:
+    await session.execute(
+        user_directory.delete().where(user_directory.c.id.in_(user_ids))
+    )
+    await session.commit()
+
+
+def register_emails(
+    engine: Engine, emails: Sequence[str]
+) -> Tuple[Dict[str, int], Set[str]]:
+    # Для seed: регистрирует email в справочнике и возвращает их user_id и
+    # email, зарегистрированные этим вызовом
+    ids: Dict[str, int] = {}
+    created: Set[str] = set()
+    with engine.begin() as conn:
+        for email in emails:
+            user_id: Optional[int] = conn.scalar(
+                select(user_directory.c.id).where(user_directory.c.email == email)
+            )
+            if user_id is None:
+                user_id = conn.scalar(
+                    user_directory.insert()
+                    .values(email=email)
+                    .returning(user_directory.c.id)
+                )
+                created.add(email)
+            if user_id is not None:
+                ids[email] = user_id
+    return ids, created
+
+
+def unregister_ids(engine: Engine, user_ids: Sequence[int]) -> None:
+    with engine.begin() as conn:
+        conn.execute(user_directory.delete().where(user_directory.c.id.in_(user_ids)))
@@ -0,0 +1,137 @@
+import itertools
+import random
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from sqlalchemy import delete, select, update
+
+from config import config
+from database import DbSession
+from models import Account, AccountShard
+
+
+class ShardDirectory:
+    # Кэш числа шардов по (user_id, account_id) в воркере. Устаревшее значение
+    # безопасно: строка accounts всегда входит в баланс, а запись в удалённый
+    # шард не найдёт строку и уйдёт в строку счёта.
+    def __init__(self, max_size: int, ttl: int) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[Tuple[int, int], Tuple[int, float]] = OrderedDict()
+        self.counter = itertools.count()
+
+    async def shards(self, session: DbSession, user_id: int, account_id: int) -> int:
+        key = (user_id, account_id)
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            self.entries.move_to_end(key)
+            return entry[0]
+        count = await session.scalar(
+            select(Account.shards).filter_by(user_id=user_id, account_id=account_id)
+        )
+        self.put(key, count or 0)
+        return count or 0
+
+    def put(self, key: Tuple[int, int], count: int) -> None:
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (count, time.time() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int, account_id: int) -> None:
+        self.entries.pop((user_id, account_id), None)
+
+    def pick(self, shards: int) -> int:
+        if config.BALANCE_SHARD_PICK == "round_robin":
+            return next(self.counter) % shards
+        return random.randrange(shards)
+
+
+shard_directory = ShardDirectory(
+    config.BALANCE_SHARD_CACHE_SIZE, config.BALANCE_SHARD_CACHE_TTL
+)
+
+
+async def account_sharded(session: DbSession, user_id: int, account_id: int) -> bool:
+    if not config.BALANCE_SHARDING:
+        return False
+    return await shard_directory.shards(session, user_id, account_id) > 0
+
+
+async def add_to_shard(
+    session: DbSession,
+    user_id: int,
+    account_id: int,
+    amount: float,
+    amount_minor: int,
+) -> Optional[int]:
+    # Номер шарда, в который записана сумма. None, если счёт не шардирован или
+    # выбранный шард удалён при понижении: тогда сумма записывается в строку
+    # accounts.
+    if not config.BALANCE_SHARDING:
+        return None
+    shards = await shard_directory.shards(session, user_id, account_id)
+    if not shards:
+        return None
+    account = (
+        select(Account.id)
+        .filter_by(user_id=user_id, account_id=account_id)
+        .scalar_subquery()
+    )
+    statement = (
+        update(AccountShard)
+        .where(
+            AccountShard.account == account,
+            AccountShard.shard == shard_directory.pick(shards),
+        )
+        .values(
+            balance=AccountShard.balance + amount,
+            balance_minor=AccountShard.balance_minor + amount_minor,
+        )
+        .returning(AccountShard.shard)
+    )
+    shard: Optional[int] = await session.scalar(statement)
+    return shard
+
+
+async def set_shards(
+    session: DbSession, user_id: int, account_id: int, count: int
+) -> Optional[Account]:
+    # Повышение создаёт пустые шарды, понижение переносит их суммы в строку
+    # счёта. Строка accounts блокируется на время изменения, а пишущие в
+    # удаляемый шард дождутся коммита и перейдут на строку счёта.
+    account: Optional[Account] = await session.scalar(
+        select(Account)
+        .filter_by(user_id=user_id, account_id=account_id)
+        .with_for_update()
+    )
+    if account is None:
+        await session.rollback()
+        return None
+
+    current = account.shards
+    if count > current:
+        session.add_all(
+            [
+                AccountShard(account=account.id, shard=shard)
+                for shard in range(current, count)
+            ]
+        )
+    elif count < current:
+        # DELETE ... RETURNING отдаёт суммы с учётом платежей, закоммиченных
+        # в эти шарды до удаления
+        removed = await session.execute(
+            delete(AccountShard)
+            .where(AccountShard.account == account.id, AccountShard.shard >= count)
+            .returning(AccountShard.balance, AccountShard.balance_minor)
+        )
+        for balance, balance_minor in removed.tuples():
+            account.balance += balance
+            account.balance_minor += balance_minor
+    account.shards = count
+    await session.commit()
+    shard_directory.invalidate(user_id, account_id)
+    return account
@@ -0,0 +1,112 @@
+# Общие фикстуры: приложение на отдельной базе SQLite для каждого теста.
+#
+#   python -m pytest
+#
+# Схема создаётся миграциями, пользователи — командой seed (migrate_test_data):
+# администратор id 1 и пользователь id 2 со счётом 1 и балансом 100.
+
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pytest
+from sanic import Sanic
+from sanic_testing.testing import SanicASGITestClient
+
+from config import DatabaseConfig, config
+from etags import response_cache
+from main import create_app, create_database_engine, migrate_test_data
+from migrations import migrate
+from roles import role_cache
+from shards import shard_directory
+from tokens import token_cache
+from utils import sign_payload
+
+USER_ID = 2
+ACCOUNT_ID = 1
+
+
+@pytest.fixture
+def balance_mode() -> str:
+    return "row"
+
+
+@pytest.fixture
+def balance_sharding() -> bool:
+    return False
+
+
+@pytest.fixture
+def app(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    balance_mode: str,
+    balance_sharding: bool,
+) -> Sanic:
+    url = f"sqlite:///{tmp_path / 'payments.db'}"
+    monkeypatch.setattr(DatabaseConfig, "database_url", property(lambda self: url))
+    monkeypatch.setattr(config.app, "DEBUG", False)
+    monkeypatch.setattr(config.ledger, "BALANCE_MODE", balance_mode)
+    monkeypatch.setattr(config.ledger, "SHARDING", balance_sharding)
+    # Кэши воркера живут в модулях и не должны переживать базу прошлого теста
+    for cache in (response_cache, role_cache, token_cache, shard_directory):
+        monkeypatch.setattr(cache, "entries", OrderedDict())
+
+    engine = create_database_engine()
+    migrate(engine)
+    migrate_test_data(engine)
+    engine.dispose()
+    # Имя приложения уникально: Sanic хранит созданные приложения в реестре
+    return create_app(f"PAYMENTS_TEST_{uuid.uuid4().hex}")
+
+
+@pytest.fixture
+def client(app: Sanic) -> SanicASGITestClient:
+    # Клиент запускает и останавливает сервер на каждый запрос, движки базы
+    # закрываются слушателем after_server_stop
+    return SanicASGITestClient(app)
+
+
+async def login(
+    client: SanicASGITestClient, email: str, password: str
+) -> Dict[str, str]:
+    _, response = await client.post(
+        "/api/auth", json={"email": email, "password": password}
+    )
+    assert response.status == 200
+    return {"Authorization": f"Bearer {response.json['token']}"}
+
+
+@pytest.fixture
+async def admin_headers(client: SanicASGITestClient) -> Dict[str, str]:
+    return await login(client, config.TEST_ADMIN_EMAIL, config.TEST_ADMIN_PASSWORD)
+
+
+@pytest.fixture
+async def user_headers(client: SanicASGITestClient) -> Dict[str, str]:
+    return await login(client, config.TEST_USER_EMAIL, config.TEST_USER_PASSWORD)
+
+
+def make_event(amount: float, transaction_id: str = "") -> Dict[str, Any]:
+    event: Dict[str, Any] = {
+        "transaction_id": transaction_id or uuid.uuid4().hex,
+        "user_id": USER_ID,
+        "account_id": ACCOUNT_ID,
+        "amount": amount,
+    }
+    event["signature"] = sign_payload(event, config.SECRET_KEY)
+    return event
+
+
+async def account_balance(
+    client: SanicASGITestClient, headers: Dict[str, str]
+) -> float:
+    _, response = await client.get("/api/users/me/accounts", headers=headers)
+    assert response.status == 200
+    accounts: List[Dict[str, Any]] = response.json
+    return next(
+        account["balance"]
+        for account in accounts
+        if account["account_id"] == ACCOUNT_ID
+    )
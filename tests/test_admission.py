@@ -0,0 +1,113 @@
+import asyncio
+from typing import Dict
+
+import pytest
+from sanic import Sanic
+from sanic_testing.testing import SanicASGITestClient
+
+import admission
+from admission import (
+    AUTH,
+    DEFAULT,
+    QUEUE_FULL,
+    TIMEOUT,
+    WEBHOOK,
+    ConcurrencyLimiter,
+    TokenBuckets,
+    group_limits,
+)
+from config import config
+from conftest import make_event
+
+
+@pytest.fixture(autouse=True)
+def admission_enabled(monkeypatch: pytest.MonkeyPatch) -> None:
+    # До создания приложения: middleware регистрируется в create_app
+    monkeypatch.setattr(config.admission, "ENABLED", True)
+    monkeypatch.setattr(config.admission, "POOL_CONNECTIONS", 4)
+    monkeypatch.setattr(config.admission, "QUEUE_SIZE", 0)
+    monkeypatch.setattr(admission, "token_buckets", TokenBuckets(64))
+
+
+def test_group_limits_share_the_pool() -> None:
+    assert group_limits(20) == {WEBHOOK: 5, AUTH: 5, DEFAULT: 10}
+    assert group_limits(2) == {WEBHOOK: 1, AUTH: 1, DEFAULT: 1}
+
+
+def test_group_limits_scale_down_to_the_pool(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config.admission, "CONCURRENCY", 20)
+    monkeypatch.setattr(config.admission, "WEBHOOK_CONCURRENCY", 10)
+    monkeypatch.setattr(config.admission, "AUTH_CONCURRENCY", 10)
+
+    limits = group_limits(20)
+    assert limits == {WEBHOOK: 5, AUTH: 5, DEFAULT: 10}
+    assert sum(limits.values()) <= 20
+
+
+async def test_limiter_sheds_when_queue_is_full_or_times_out() -> None:
+    full = ConcurrencyLimiter(DEFAULT, 1, 0, 1.0)
+    permit, _ = await full.acquire()
+    assert permit is not None
+    assert await full.acquire() == (None, QUEUE_FULL)
+
+    waiting = ConcurrencyLimiter(DEFAULT, 1, 1, 0.01)
+    await waiting.acquire()
+    assert await waiting.acquire() == (None, TIMEOUT)
+
+
+async def test_limiter_hands_off_to_waiter() -> None:
+    limiter = ConcurrencyLimiter(DEFAULT, 1, 1, 1.0)
+    permit, _ = await limiter.acquire()
+    assert permit is not None
+    waiter = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+
+    permit.release()
+    permit.release()
+    second, reason = await waiter
+    assert second is not None and reason is None
+    assert limiter.in_flight == 1
+
+
+async def test_busy_group_gets_503(
+    app: Sanic, client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    # Все места default заняты, очередь нулевая: отказ без ожидания
+    limiter = app.ctx.admission.limiters[DEFAULT]
+    permits = [limiter.admit() for _ in range(limiter.limit)]
+    _, busy = await client.get("/api/users/me", headers=user_headers)
+    for permit in permits:
+        permit.release()
+    _, free = await client.get("/api/users/me", headers=user_headers)
+
+    assert busy.status == 503
+    assert busy.json == {"error": "Server is busy"}
+    assert busy.headers["retry-after"] == "1"
+    assert free.status == 200
+
+
+async def test_auth_rate_limit_gets_429(
+    monkeypatch: pytest.MonkeyPatch, client: SanicASGITestClient
+) -> None:
+    monkeypatch.setattr(config.admission, "AUTH_RATE", 0.5)
+    monkeypatch.setattr(config.admission, "AUTH_BURST", 1)
+    credentials = {"email": config.TEST_USER_EMAIL, "password": "wrong"}
+
+    _, first = await client.post("/api/auth", json=credentials)
+    _, second = await client.post("/api/auth", json=credentials)
+    assert first.status != 429
+    assert second.status == 429
+    assert second.json == {"error": "Too many requests"}
+    assert second.headers["retry-after"] == "2"
+
+
+async def test_webhooks_are_not_limited_by_auth_rate(
+    monkeypatch: pytest.MonkeyPatch,
+    client: SanicASGITestClient,
+    user_headers: Dict[str, str],
+) -> None:
+    monkeypatch.setattr(config.admission, "AUTH_RATE", 0.5)
+    monkeypatch.setattr(config.admission, "AUTH_BURST", 1)
+    for _ in range(3):
+        _, response = await client.post("/api/webhook", json=make_event(1.0))
+        assert response.status == 201
@@ -0,0 +1,65 @@
+import json
+from typing import Dict
+
+import pytest
+from sanic import Sanic
+from sanic_testing.testing import SanicASGITestClient
+
+from conftest import ACCOUNT_ID, USER_ID, account_balance, make_event
+
+# Все режимы SANIC_BALANCE_MODE, с шардами счёта и без них
+pytestmark = pytest.mark.parametrize(
+    ("balance_mode", "balance_sharding"),
+    [("row", False), ("ledger", False), ("row", True), ("ledger", True)],
+)
+
+
+@pytest.fixture
+async def sharded_account(
+    client: SanicASGITestClient, admin_headers: Dict[str, str], balance_sharding: bool
+) -> None:
+    if balance_sharding:
+        _, response = await client.post(
+            f"/api/users/{USER_ID}/accounts/{ACCOUNT_ID}/shards",
+            json={"shards": 4},
+            headers=admin_headers,
+        )
+        assert response.status == 200
+
+
+@pytest.mark.usefixtures("sharded_account")
+async def test_single_events_sum_exactly(
+    app: Sanic,
+    client: SanicASGITestClient,
+    user_headers: Dict[str, str],
+    admin_headers: Dict[str, str],
+) -> None:
+    # Закэшированный ответ до записи не должен пережить вебхуки
+    assert await account_balance(client, user_headers) == 100.0
+    for _ in range(10):
+        _, response = await client.post("/api/webhook", json=make_event(0.1))
+        assert response.status == 201
+
+    assert await account_balance(client, user_headers) == 101.0
+    _, full = await client.get("/api/users/me/full", headers=user_headers)
+    assert full.json["accounts"][0]["balance"] == 101.0
+
+    # После сжатия журнала баланс тот же
+    for compactor in app.ctx.ledger_compactors:
+        await compactor.compact()
+    _, accounts = await client.get(
+        f"/api/users/{USER_ID}/accounts", headers=admin_headers
+    )
+    assert accounts.json[0]["balance"] == 101.0
+
+
+@pytest.mark.usefixtures("sharded_account")
+async def test_batch_sums_exactly(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    assert await account_balance(client, user_headers) == 100.0
+    events = [make_event(0.1) for _ in range(10)] + [make_event(0.2), make_event(0.7)]
+    _, response = await client.post("/api/webhook/batch", content=json.dumps(events))
+
+    assert response.status == 200
+    assert await account_balance(client, user_headers) == 101.9
@@ -0,0 +1,36 @@
+import json
+from typing import Dict
+
+from sanic_testing.testing import SanicASGITestClient
+
+from conftest import account_balance, make_event
+from webhooks import DUPLICATE, SUCCESS
+
+
+async def test_batch_is_idempotent(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    # Повтор внутри пачки, повтор всей пачки и одиночный повтор после неё
+    events = [make_event(1.0, "b-1"), make_event(2.0, "b-2"), make_event(1.0, "b-1")]
+    _, first = await client.post("/api/webhook/batch", content=json.dumps(events))
+    _, retry = await client.post("/api/webhook/batch", content=json.dumps(events))
+    _, single = await client.post("/api/webhook", json=events[1])
+
+    assert first.status == 200
+    assert [item["status"] for item in first.json] == [SUCCESS, SUCCESS, DUPLICATE]
+    assert [item["status"] for item in retry.json] == [DUPLICATE] * 3
+    assert single.status == 400
+    assert await account_balance(client, user_headers) == 103.0
+
+
+async def test_ndjson_batch_matches_single_events(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    await client.post("/api/webhook", json=make_event(5.0, "n-1"))
+    body = "\n".join(
+        json.dumps(event) for event in (make_event(5.0, "n-1"), make_event(7.0, "n-2"))
+    )
+    _, response = await client.post("/api/webhook/batch", content=body)
+
+    assert [item["status"] for item in response.json] == [DUPLICATE, SUCCESS]
+    assert await account_balance(client, user_headers) == 112.0
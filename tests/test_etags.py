@@ -0,0 +1,94 @@
+import json
+from typing import Dict
+
+from sanic_testing.testing import SanicASGITestClient
+
+from conftest import USER_ID
+
+
+async def cached_etag(
+    client: SanicASGITestClient, headers: Dict[str, str], path: str
+) -> str:
+    # Первый запрос кладёт ответ в кэш воркера, второй должен получить 304
+    _, response = await client.get(path, headers=headers)
+    etag = response.headers["etag"]
+    _, repeated = await client.get(path, headers={**headers, "If-None-Match": etag})
+    assert repeated.status == 304
+    return etag
+
+
+async def test_create_invalidates_cached_user(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    etag = await cached_etag(client, admin_headers, "/api/users/3")
+
+    _, created = await client.post(
+        "/api/users/add",
+        json={"email": "new@test.com", "password": "new123", "full_name": "New"},
+        headers=admin_headers,
+    )
+    assert created.json["id"] == 3
+    _, response = await client.get(
+        "/api/users/3", headers={**admin_headers, "If-None-Match": etag}
+    )
+
+    assert response.status == 200
+    assert response.headers["etag"] != etag
+    assert response.json["email"] == "new@test.com"
+
+
+async def test_bulk_create_invalidates_cached_user(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    etag = await cached_etag(client, admin_headers, "/api/users/3")
+
+    line = {"email": "bulk@test.com", "password": "bulk123", "full_name": "Bulk"}
+    await client.post(
+        "/api/users/bulk", content=json.dumps(line), headers=admin_headers
+    )
+    _, response = await client.get(
+        "/api/users/3", headers={**admin_headers, "If-None-Match": etag}
+    )
+
+    assert response.status == 200
+    assert response.json["email"] == "bulk@test.com"
+
+
+async def test_update_invalidates_cached_user(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    path = f"/api/users/{USER_ID}"
+    etag = await cached_etag(client, admin_headers, path)
+
+    _, updated = await client.post(
+        "/api/users/update",
+        json={"id": USER_ID, "full_name": "Renamed"},
+        headers=admin_headers,
+    )
+    assert updated.status == 201
+    _, conditional = await client.get(
+        path, headers={**admin_headers, "If-None-Match": etag}
+    )
+    _, plain = await client.get(path, headers=admin_headers)
+
+    assert conditional.status == 200
+    assert conditional.json["full_name"] == "Renamed"
+    assert plain.json["full_name"] == "Renamed"
+
+
+async def test_delete_invalidates_cached_user(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    path = f"/api/users/{USER_ID}"
+    etag = await cached_etag(client, admin_headers, path)
+
+    _, deleted = await client.post(
+        "/api/users/delete", json={"id": USER_ID}, headers=admin_headers
+    )
+    assert deleted.status == 201
+    _, response = await client.get(
+        path, headers={**admin_headers, "If-None-Match": etag}
+    )
+
+    assert response.status == 200
+    assert response.json == {}
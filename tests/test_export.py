@@ -0,0 +1,119 @@
+import gzip
+import json
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pytest
+from sanic_testing.testing import SanicASGITestClient
+
+from conftest import make_event
+from database import create_session_factory
+from export import accepts_gzip, export_to_file
+from main import create_database_engine
+
+PAYMENTS = [f"tx-{number}" for number in range(4)]
+
+
+@pytest.fixture
+async def payments(client: SanicASGITestClient) -> None:
+    for transaction_id in PAYMENTS:
+        _, response = await client.post(
+            "/api/webhook", json=make_event(1.0, transaction_id)
+        )
+        assert response.status == 201
+
+
+def ndjson_ids(data: bytes) -> List[str]:
+    return [json.loads(line)["transaction_id"] for line in data.splitlines()]
+
+
+async def export_file(
+    path: Path,
+    fmt: str,
+    compress: bool,
+    until: Optional[int] = None,
+    resume: bool = False,
+) -> None:
+    engine = create_database_engine()
+    try:
+        await export_to_file(
+            create_session_factory(engine),
+            str(path),
+            fmt,
+            compress,
+            until=until,
+            resume=resume,
+        )
+    finally:
+        engine.dispose()
+
+
+@pytest.mark.parametrize(
+    ("header", "expected"),
+    [
+        ("gzip, deflate", True),
+        ("deflate, gzip;q=0.5", True),
+        ("gzip;q=0", False),
+        ("*", True),
+        ("*;q=0", False),
+        ("gzip;q=0, *", False),
+        ("identity", False),
+        ("", False),
+    ],
+)
+def test_accepts_gzip(header: str, expected: bool) -> None:
+    assert accepts_gzip(header) is expected
+
+
+@pytest.mark.usefixtures("payments")
+@pytest.mark.parametrize("encoding", ["gzip", "gzip;q=0"])
+async def test_export_streams_payments_after_cursor(
+    client: SanicASGITestClient, admin_headers: Dict[str, str], encoding: str
+) -> None:
+    headers = {**admin_headers, "Accept-Encoding": encoding}
+    _, everything = await client.get("/api/payments/export", headers=headers)
+    first = json.loads(everything.text.splitlines()[0])
+    _, rest = await client.get(
+        f"/api/payments/export?after={first['id']}", headers=headers
+    )
+
+    compressed = encoding == "gzip"
+    assert (everything.headers.get("content-encoding") == "gzip") is compressed
+    assert ndjson_ids(everything.content) == PAYMENTS
+    assert ndjson_ids(rest.content) == PAYMENTS[1:]
+
+
+@pytest.mark.usefixtures("payments")
+async def test_export_csv(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    _, response = await client.get(
+        "/api/payments/export?format=csv", headers=admin_headers
+    )
+    lines = response.text.splitlines()
+
+    assert lines[0].startswith("id,transaction_id,")
+    assert [line.split(",")[1] for line in lines[1:]] == PAYMENTS
+
+
+@pytest.mark.usefixtures("payments")
+async def test_gzip_file_resumes_without_duplicates(tmp_path: Path) -> None:
+    path = tmp_path / "payments.csv.gz"
+    await export_file(path, "csv", True, until=2)
+    await export_file(path, "csv", True, resume=True)
+
+    with gzip.open(path, "rt") as file:
+        lines = file.read().splitlines()
+    assert lines[0].startswith("id,")
+    assert [line.split(",")[1] for line in lines[1:]] == PAYMENTS
+
+
+@pytest.mark.usefixtures("payments")
+async def test_resume_cuts_partial_line(tmp_path: Path) -> None:
+    path = tmp_path / "payments.ndjson"
+    await export_file(path, "ndjson", False, until=2)
+    # Процесс убит посреди строки
+    path.write_bytes(path.read_bytes() + b'{"id": 3, "transac')
+    await export_file(path, "ndjson", False, resume=True)
+
+    assert ndjson_ids(path.read_bytes()) == PAYMENTS
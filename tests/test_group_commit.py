@@ -0,0 +1,76 @@
+import asyncio
+from typing import Any, Dict, List
+
+from sanic_testing.testing import SanicASGITestClient
+
+from conftest import account_balance, make_event
+from database import DbSession, create_session_factory
+from main import create_async_database_engine
+from webhooks import SUCCESS, GroupCommitter
+
+
+async def submit_all(
+    committer: GroupCommitter, events: List[Dict[str, Any]]
+) -> List[Any]:
+    committer.start()
+    try:
+        return list(
+            await asyncio.wait_for(
+                asyncio.gather(
+                    *(committer.submit(event) for event in events),
+                    return_exceptions=True,
+                ),
+                5,
+            )
+        )
+    finally:
+        await committer.stop()
+
+
+async def test_bad_event_fails_alone(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    # Испорченные события в одном окне с верными: пачка откатывается, верные
+    # события записываются повтором по одному
+    engine = create_async_database_engine()
+    committer = GroupCommitter(create_session_factory(engine), 50, 100)
+    bad = {**make_event(1.0), "amount": "x"}
+    missing = make_event(1.0)
+    del missing["amount"]
+    results = await submit_all(
+        committer, [make_event(2.0), bad, missing, make_event(3.0)]
+    )
+    await engine.dispose()
+
+    assert results[0] == SUCCESS
+    assert results[3] == SUCCESS
+    assert isinstance(results[1], Exception)
+    assert isinstance(results[2], KeyError)
+    assert await account_balance(client, user_headers) == 105.0
+
+
+async def test_failed_rollback_still_answers(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    engine = create_async_database_engine()
+    factory = create_session_factory(engine)
+
+    def broken_rollback() -> DbSession:
+        session: Any = factory()
+
+        async def rollback() -> None:
+            raise RuntimeError("connection lost")
+
+        session.rollback = rollback
+        return session
+
+    committer = GroupCommitter(broken_rollback, 50, 100)
+    results = await submit_all(
+        committer, [make_event(2.0), {**make_event(1.0), "amount": "x"}]
+    )
+    await engine.dispose()
+
+    assert results[0] == SUCCESS
+    assert not isinstance(results[1], RuntimeError)
+    assert isinstance(results[1], Exception)
+    assert await account_balance(client, user_headers) == 102.0
@@ -0,0 +1,86 @@
+import json
+from typing import Dict, List
+
+import pytest
+from sanic_testing.testing import SanicASGITestClient
+
+from config import config
+from conftest import make_event
+
+PAYMENTS = [f"tx-{number}" for number in range(5)]
+
+
+@pytest.fixture
+async def payments(client: SanicASGITestClient) -> None:
+    for transaction_id in PAYMENTS:
+        _, response = await client.post(
+            "/api/webhook", json=make_event(1.0, transaction_id)
+        )
+        assert response.status == 201
+
+
+@pytest.mark.usefixtures("payments")
+@pytest.mark.parametrize("limit", [1, 2, 5])
+async def test_cursor_walks_all_pages(
+    client: SanicASGITestClient, user_headers: Dict[str, str], limit: int
+) -> None:
+    seen: List[str] = []
+    cursors: List[str] = []
+    query = f"?limit={limit}"
+    while True:
+        _, response = await client.get(
+            f"/api/users/me/payments{query}", headers=user_headers
+        )
+        assert response.status == 200
+        assert len(response.json) <= limit
+        seen += [payment["transaction_id"] for payment in response.json]
+        cursor = response.headers["x-next-cursor"]
+        cursors.append(cursor)
+        if not cursor:
+            break
+        query = f"?limit={limit}&after={cursor}"
+
+    assert seen == PAYMENTS
+    # Полная последняя страница ещё не знает, что она последняя
+    assert len(cursors) == len(PAYMENTS) // limit + 1
+
+
+@pytest.mark.usefixtures("payments")
+async def test_limit_is_capped(
+    monkeypatch: pytest.MonkeyPatch,
+    client: SanicASGITestClient,
+    user_headers: Dict[str, str],
+) -> None:
+    monkeypatch.setattr(config.app, "PAGE_MAX_LIMIT", 3)
+    _, response = await client.get(
+        "/api/users/me/payments?limit=100", headers=user_headers
+    )
+
+    assert len(response.json) == 3
+    assert response.headers["x-next-cursor"] != ""
+
+
+@pytest.mark.parametrize("query", ["?limit=abc", "?after=-1"])
+async def test_invalid_cursor_is_rejected(
+    client: SanicASGITestClient, user_headers: Dict[str, str], query: str
+) -> None:
+    _, response = await client.get(
+        f"/api/users/me/payments{query}", headers=user_headers
+    )
+
+    assert response.status == 400
+
+
+@pytest.mark.usefixtures("payments")
+async def test_stream_returns_every_row_after_cursor(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    _, page = await client.get("/api/users/me/payments?limit=2", headers=user_headers)
+    cursor = page.headers["x-next-cursor"]
+    _, response = await client.get(
+        f"/api/users/me/payments?stream=1&after={cursor}", headers=user_headers
+    )
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row["transaction_id"] for row in rows] == PAYMENTS[2:]
@@ -0,0 +1,77 @@
+from typing import Dict
+
+import pytest
+from sanic_testing.testing import SanicASGITestClient
+from sqlalchemy import select, update
+
+from config import config
+from conftest import USER_ID, login
+from main import create_database_engine
+from models import User
+from passwords import check_password_hash, make_password_hash
+from utils import hash_password
+
+
+def stored_hash() -> str:
+    engine = create_database_engine()
+    try:
+        with engine.connect() as connection:
+            return str(
+                connection.scalar(select(User.password).where(User.id == USER_ID))
+            )
+    finally:
+        engine.dispose()
+
+
+def set_stored_hash(value: str) -> None:
+    engine = create_database_engine()
+    try:
+        with engine.begin() as connection:
+            connection.execute(
+                update(User).where(User.id == USER_ID).values(password=value)
+            )
+    finally:
+        engine.dispose()
+
+
+@pytest.fixture
+def weak_hash(monkeypatch: pytest.MonkeyPatch) -> str:
+    with monkeypatch.context() as patch:
+        patch.setattr(config.security, "PASSWORD_SCRYPT_N", 2**4)
+        return make_password_hash(config.TEST_USER_PASSWORD)
+
+
+@pytest.mark.parametrize("kind", ["legacy", "weak"])
+async def test_login_rehashes_old_password(
+    client: SanicASGITestClient, weak_hash: str, kind: str
+) -> None:
+    legacy = hash_password(config.SECRET_KEY, config.TEST_USER_PASSWORD)
+    set_stored_hash(legacy if kind == "legacy" else weak_hash)
+
+    await login(client, config.TEST_USER_EMAIL, config.TEST_USER_PASSWORD)
+
+    stored = stored_hash()
+    assert stored.startswith(f"scrypt${config.PASSWORD_SCRYPT_N}$")
+    assert check_password_hash(stored, config.TEST_USER_PASSWORD)
+    # Новый хеш действует при следующем входе
+    await login(client, config.TEST_USER_EMAIL, config.TEST_USER_PASSWORD)
+
+
+async def test_failed_login_keeps_old_hash(client: SanicASGITestClient) -> None:
+    legacy = hash_password(config.SECRET_KEY, config.TEST_USER_PASSWORD)
+    set_stored_hash(legacy)
+    _, response = await client.post(
+        "/api/auth", json={"email": config.TEST_USER_EMAIL, "password": "wrong"}
+    )
+
+    assert response.status == 401
+    assert stored_hash() == legacy
+
+
+async def test_current_hash_is_not_rewritten(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    stored = stored_hash()
+    await login(client, config.TEST_USER_EMAIL, config.TEST_USER_PASSWORD)
+
+    assert stored_hash() == stored
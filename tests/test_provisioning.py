@@ -0,0 +1,114 @@
+import json
+from typing import Any, Dict, List
+
+from sanic_testing.testing import SanicASGITestClient
+from sqlalchemy import select
+
+from config import config
+from conftest import login
+from main import create_database_engine
+from models import Account, User
+from passwords import make_password_hash
+from provisioning import CREATED, EXISTS, INVALID
+
+
+async def bulk(
+    client: SanicASGITestClient, headers: Dict[str, str], lines: List[Any]
+) -> List[Dict[str, Any]]:
+    body = "\n".join(
+        line if isinstance(line, str) else json.dumps(line) for line in lines
+    )
+    _, response = await client.post("/api/users/bulk", content=body, headers=headers)
+    assert response.status == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def stored_hash(email: str) -> str:
+    engine = create_database_engine()
+    try:
+        with engine.connect() as connection:
+            return str(
+                connection.scalar(select(User.password).where(User.email == email))
+            )
+    finally:
+        engine.dispose()
+
+
+def account_ids(user_id: int) -> List[int]:
+    engine = create_database_engine()
+    try:
+        with engine.connect() as connection:
+            return list(
+                connection.scalars(
+                    select(Account.account_id)
+                    .where(Account.user_id == user_id)
+                    .order_by(Account.account_id)
+                )
+            )
+    finally:
+        engine.dispose()
+
+
+async def test_bulk_reports_status_per_line(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    report = await bulk(
+        client,
+        admin_headers,
+        [
+            {"email": "a@test.com", "password": "a123", "accounts": [1, 2]},
+            {"email": config.TEST_USER_EMAIL, "password": "x"},
+            {"email": "a@test.com", "password": "again"},
+            {"email": "b@test.com"},
+            {"email": "c@test.com", "password_hash": "scrypt$bad"},
+            "not json",
+        ],
+    )
+
+    assert [(item["line"], item["status"]) for item in report] == [
+        (1, CREATED),
+        (2, EXISTS),
+        (3, EXISTS),
+        (4, INVALID),
+        (5, INVALID),
+        (6, INVALID),
+    ]
+    assert all(item.get("error") for item in report[3:])
+    assert account_ids(report[0]["id"]) == [1, 2]
+
+
+async def test_bulk_is_safe_to_repeat(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    lines = [{"email": f"u{number}@test.com", "password": "p"} for number in range(3)]
+    first = await bulk(client, admin_headers, lines)
+    second = await bulk(client, admin_headers, lines)
+
+    assert [item["status"] for item in first] == [CREATED] * 3
+    assert [item["status"] for item in second] == [EXISTS] * 3
+
+
+async def test_bulk_password_is_upgraded_on_login(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    await bulk(client, admin_headers, [{"email": "a@test.com", "password": "a123"}])
+    assert stored_hash("a@test.com").startswith(
+        f"scrypt${config.PASSWORD_BULK_SCRYPT_N}$"
+    )
+
+    await login(client, "a@test.com", "a123")
+    assert stored_hash("a@test.com").startswith(f"scrypt${config.PASSWORD_SCRYPT_N}$")
+
+
+async def test_bulk_keeps_ready_password_hash(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    ready = make_password_hash("b123")
+    report = await bulk(
+        client, admin_headers, [{"email": "b@test.com", "password_hash": ready}]
+    )
+
+    assert report[0]["status"] == CREATED
+    assert stored_hash("b@test.com") == ready
+    await login(client, "b@test.com", "b123")
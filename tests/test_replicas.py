@@ -0,0 +1,94 @@
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import pytest
+from sanic import Sanic
+from sanic_testing.testing import SanicASGITestClient
+from sqlalchemy import Engine, create_engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from config import config
+from conftest import USER_ID, make_event
+from replicas import ReplicaRouter
+
+
+@pytest.fixture(autouse=True)
+def replica_url(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # До создания приложения: реплики заводятся в create_app
+    url = f"sqlite:///{tmp_path / 'replica.db'}"
+    monkeypatch.setattr(config.database, "REPLICA_URLS", [url])
+
+
+@pytest.fixture
+def replica(app: Sanic, tmp_path: Path) -> None:
+    # Копия основной базы, которая дальше не обновляется: отставшая реплика
+    shutil.copy(tmp_path / "payments.db", tmp_path / "replica.db")
+
+
+async def payment_ids(
+    client: SanicASGITestClient, headers: Dict[str, str]
+) -> List[str]:
+    _, response = await client.get(f"/api/users/{USER_ID}/payments", headers=headers)
+    assert response.status == 200
+    return [payment["transaction_id"] for payment in response.json]
+
+
+@pytest.mark.usefixtures("replica")
+async def test_reads_follow_recent_writes_to_primary(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    _, response = await client.post("/api/webhook", json=make_event(1.0, "tx-1"))
+    assert response.status == 201
+
+    assert await payment_ids(client, admin_headers) == ["tx-1"]
+
+
+@pytest.mark.usefixtures("replica")
+async def test_reads_go_to_replica_outside_window(
+    app: Sanic, client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    app.ctx.replicas.window = 0
+    _, response = await client.post("/api/webhook", json=make_event(1.0, "tx-1"))
+    assert response.status == 201
+
+    # Реплика ещё не видит платёж, а её ответ не попадает в кэш с ETag
+    _, stale = await client.get(f"/api/users/{USER_ID}/payments", headers=admin_headers)
+    assert stale.json == {}
+    assert "etag" not in stale.headers
+
+
+class LaggingRouter(ReplicaRouter):
+    lag: Union[Optional[float], Exception] = None
+
+    async def probe(self, engine: Union[Engine, AsyncEngine]) -> Optional[float]:
+        if isinstance(self.lag, Exception):
+            raise self.lag
+        return self.lag
+
+
+@pytest.mark.parametrize(
+    ("lag", "healthy"),
+    [(None, True), (0.0, True), (5.0, True), (30.0, False), (OSError("down"), False)],
+)
+async def test_lagging_replica_is_skipped(
+    lag: Union[Optional[float], Exception], healthy: bool
+) -> None:
+    engine = create_engine("sqlite://")
+    router = LaggingRouter([engine], interval=1, max_lag=10, window=10, slots=16)
+    router.lag = lag
+    await router.check()
+
+    assert router.healthy == [healthy]
+    assert (router.session_factory() is not None) == healthy
+    engine.dispose()
+
+
+def test_recent_write_is_remembered_per_user() -> None:
+    engine = create_engine("sqlite://")
+    router = ReplicaRouter([engine], interval=1, max_lag=10, window=10, slots=16)
+    router.wrote(USER_ID)
+
+    assert router.recently_wrote(USER_ID)
+    assert not router.recently_wrote(USER_ID + 1)
+    engine.dispose()
@@ -0,0 +1,55 @@
+from typing import Dict
+
+from sanic_testing.testing import SanicASGITestClient
+
+from conftest import USER_ID
+
+
+async def test_promotion_reaches_cached_role(
+    client: SanicASGITestClient,
+    admin_headers: Dict[str, str],
+    user_headers: Dict[str, str],
+) -> None:
+    # Роль из кэша воркера сбрасывается изменением пользователя, id — строкой
+    _, before = await client.get("/api/users", headers=user_headers)
+    _, updated = await client.post(
+        "/api/users/update",
+        json={"id": str(USER_ID), "is_admin": True},
+        headers=admin_headers,
+    )
+    _, after = await client.get("/api/users", headers=user_headers)
+
+    assert before.status == 401
+    assert updated.status == 201
+    assert after.status == 201
+
+
+async def test_deleted_user_loses_access(
+    client: SanicASGITestClient,
+    admin_headers: Dict[str, str],
+    user_headers: Dict[str, str],
+) -> None:
+    await client.post(
+        "/api/users/update",
+        json={"id": USER_ID, "is_admin": True},
+        headers=admin_headers,
+    )
+    _, before = await client.get("/api/users", headers=user_headers)
+    _, deleted = await client.post(
+        "/api/users/delete", json={"id": str(USER_ID)}, headers=admin_headers
+    )
+    _, after = await client.get("/api/users", headers=user_headers)
+
+    assert before.status == 201
+    assert deleted.status == 201
+    assert after.status != 201
+
+
+async def test_invalid_id_is_rejected(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    _, response = await client.post(
+        "/api/users/update", json={"id": "abc"}, headers=admin_headers
+    )
+
+    assert response.status == 400
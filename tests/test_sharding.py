@@ -0,0 +1,133 @@
+import json
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+from sanic import Sanic
+from sanic_testing.testing import SanicASGITestClient
+from sqlalchemy import select
+
+from config import config
+from conftest import USER_ID, account_balance, make_event
+from main import create_database_engines, seed_shards
+from migrations import migrate
+from models import Payment, User
+from sharding import HashRing
+
+SHARDS = 2
+
+
+@pytest.fixture(autouse=True)
+def shards(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # До создания приложения: роутер шардов заводится в create_app
+    urls = [f"sqlite:///{tmp_path / f'shard{index}.db'}" for index in range(SHARDS)]
+    monkeypatch.setattr(config.database, "SHARD_URLS", urls)
+    engines = create_database_engines()
+    for engine in engines:
+        migrate(engine)
+    seed_shards()
+    for engine in engines:
+        engine.dispose()
+
+
+def shard_user_ids() -> List[List[int]]:
+    users = []
+    for engine in create_database_engines():
+        with engine.connect() as connection:
+            users.append(list(connection.scalars(select(User.id).order_by(User.id))))
+        engine.dispose()
+    return users
+
+
+def shard_payments(shard: int) -> List[str]:
+    engine = create_database_engines()[shard]
+    try:
+        with engine.connect() as connection:
+            return [
+                str(transaction_id)
+                for transaction_id in connection.scalars(select(Payment.transaction_id))
+            ]
+    finally:
+        engine.dispose()
+
+
+def test_ring_moves_few_users_when_shard_is_added() -> None:
+    before, after = HashRing(4, 64), HashRing(5, 64)
+    users = range(1, 10001)
+    moved = [user for user in users if before.shard_for(user) != after.shard_for(user)]
+
+    assert {before.shard_for(user) for user in users} == {0, 1, 2, 3}
+    # Переезжают только пользователи нового шарда, около 1/5
+    assert all(after.shard_for(user) == 4 for user in moved)
+    assert 1000 < len(moved) < 3000
+
+
+async def test_users_are_created_in_their_shard(
+    app: Sanic, client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    created = []
+    for number in range(6):
+        _, response = await client.post(
+            "/api/users/add",
+            json={
+                "email": f"user{number}@test.com",
+                "password": "secret",
+                "full_name": f"User {number}",
+            },
+            headers=admin_headers,
+        )
+        assert response.status == 201
+        created.append(response.json["id"])
+    _, duplicate = await client.post(
+        "/api/users/add",
+        json={"email": "user0@test.com", "password": "secret", "full_name": "Again"},
+        headers=admin_headers,
+    )
+
+    assert duplicate.status == 401
+    router = app.ctx.shard_router
+    for shard, user_ids in enumerate(shard_user_ids()):
+        assert all(router.shard_for(user_id) == shard for user_id in user_ids)
+    assert sorted(sum(shard_user_ids(), [])) == [1, 2, *created]
+
+
+async def test_user_list_fans_out_across_shards(
+    client: SanicASGITestClient, admin_headers: Dict[str, str]
+) -> None:
+    for number in range(4):
+        await client.post(
+            "/api/users/add",
+            json={"email": f"u{number}@test.com", "password": "x", "full_name": "U"},
+            headers=admin_headers,
+        )
+    all_ids = sorted(sum(shard_user_ids(), []))
+    assert all(shard_user_ids())
+
+    seen: List[int] = []
+    query = "?limit=2"
+    while True:
+        _, response = await client.get(f"/api/users{query}", headers=admin_headers)
+        seen += [user["id"] for user in response.json]
+        cursor = response.headers["x-next-cursor"]
+        if not cursor:
+            break
+        query = f"?limit=2&after={cursor}"
+    _, stream = await client.get("/api/users?stream=1", headers=admin_headers)
+
+    assert seen == all_ids
+    assert [json.loads(line)["id"] for line in stream.text.splitlines()] == all_ids
+
+
+async def test_webhooks_go_to_user_shard(
+    app: Sanic, client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    shard = app.ctx.shard_router.shard_for(USER_ID)
+    _, single = await client.post("/api/webhook", json=make_event(1.0, "tx-1"))
+    events = [make_event(2.0, "tx-2"), make_event(3.0, "tx-3")]
+    _, batch = await client.post("/api/webhook/batch", content=json.dumps(events))
+
+    assert single.status == 201
+    assert batch.status == 200
+    assert sorted(shard_payments(shard)) == ["tx-1", "tx-2", "tx-3"]
+    assert shard_payments(1 - shard) == []
+    assert await account_balance(client, user_headers) == 106.0
@@ -0,0 +1,119 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+import pytest
+from sanic import Sanic
+from sanic_testing.testing import SanicASGITestClient
+from sqlalchemy import select
+
+from conftest import ACCOUNT_ID, USER_ID, make_event
+from main import create_database_engine
+from models import PaymentDaily
+
+TODAY = datetime.now(timezone.utc).date().isoformat()
+
+
+def rollup_rows() -> List[Tuple[int, int, int]]:
+    engine = create_database_engine()
+    try:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                select(
+                    PaymentDaily.shard, PaymentDaily.count, PaymentDaily.amount_minor
+                )
+                .where(PaymentDaily.user_id == USER_ID)
+                .order_by(PaymentDaily.shard)
+            )
+            return [tuple(row) for row in rows]
+    finally:
+        engine.dispose()
+
+
+async def summary(
+    client: SanicASGITestClient, headers: Dict[str, str], query: str = ""
+) -> Dict:
+    _, response = await client.get(
+        f"/api/users/me/payments/summary{query}", headers=headers
+    )
+    assert response.status == 200
+    return response.json
+
+
+async def send_payments(client: SanicASGITestClient, *amounts: float) -> None:
+    for amount in amounts:
+        _, response = await client.post("/api/webhook", json=make_event(amount))
+        assert response.status == 201
+
+
+async def compact(app: Sanic) -> None:
+    for compactor in app.ctx.ledger_compactors:
+        await compactor.compact()
+
+
+async def test_row_mode_updates_rollup_inline(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    await send_payments(client, 1.5, 2.25)
+
+    result = await summary(client, user_headers)
+    assert (result["total"], result["count"]) == (3.75, 2)
+    assert result["accounts"] == [{"account_id": ACCOUNT_ID, "total": 3.75, "count": 2}]
+    assert result["days"] == [{"day": TODAY, "total": 3.75, "count": 2}]
+    assert rollup_rows() == [(0, 2, 375)]
+
+
+async def test_date_filters_bound_the_period(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    await send_payments(client, 1.0)
+
+    inside = await summary(client, user_headers, f"?from={TODAY}&to={TODAY}")
+    before = await summary(client, user_headers, "?to=2000-01-01")
+    assert (inside["total"], inside["count"]) == (1.0, 1)
+    assert (before["total"], before["count"], before["days"]) == (0.0, 0, [])
+
+
+@pytest.mark.parametrize("balance_mode", ["ledger"])
+async def test_ledger_mode_rolls_up_on_compaction(
+    app: Sanic, client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    # До сжатия сводка пуста, итоги считаются по хвосту журнала
+    await send_payments(client, 1.5, 2.25)
+    assert rollup_rows() == []
+    pending = await summary(client, user_headers)
+    assert (pending["total"], pending["count"]) == (3.75, 2)
+
+    await compact(app)
+    await send_payments(client, 0.25)
+
+    assert rollup_rows() == [(0, 2, 375)]
+    result = await summary(client, user_headers)
+    assert (result["total"], result["count"]) == (4.0, 3)
+    assert result["days"] == [{"day": TODAY, "total": 4.0, "count": 3}]
+
+
+@pytest.mark.parametrize("balance_sharding", [True])
+async def test_sharded_account_rolls_up_per_shard(
+    client: SanicASGITestClient,
+    admin_headers: Dict[str, str],
+    user_headers: Dict[str, str],
+) -> None:
+    _, response = await client.post(
+        f"/api/users/{USER_ID}/accounts/{ACCOUNT_ID}/shards",
+        json={"shards": 4},
+        headers=admin_headers,
+    )
+    assert response.status == 200
+    await send_payments(client, *[0.5] * 20)
+
+    rows = rollup_rows()
+    # Строка сводки на каждый задетый шард счёта, а не одна горячая строка
+    assert len(rows) > 1
+    assert {shard for shard, _, _ in rows} <= {0, 1, 2, 3}
+    assert sum(count for _, count, _ in rows) == 20
+    assert sum(amount for _, _, amount in rows) == 1000
+    result = await summary(client, user_headers)
+    assert (result["total"], result["count"]) == (10.0, 20)
+    assert result["accounts"] == [
+        {"account_id": ACCOUNT_ID, "total": 10.0, "count": 20}
+    ]
@@ -0,0 +1,50 @@
+from typing import Any, Dict
+
+import pytest
+from sanic_testing.testing import SanicASGITestClient
+
+from config import config
+from conftest import account_balance, make_event
+from utils import sign_payload
+
+
+async def test_repeated_event_is_applied_once(
+    client: SanicASGITestClient, user_headers: Dict[str, str]
+) -> None:
+    event = make_event(10.5, "tx-1")
+    _, first = await client.post("/api/webhook", json=event)
+    _, second = await client.post("/api/webhook", json=event)
+
+    assert first.status == 201
+    assert second.status == 400
+    assert second.json == {"error": "Transaction already processed"}
+    assert await account_balance(client, user_headers) == 110.5
+    _, payments = await client.get("/api/users/me/payments", headers=user_headers)
+    assert [payment["transaction_id"] for payment in payments.json] == ["tx-1"]
+
+
+@pytest.mark.parametrize(
+    "changes", [{"amount": "abc"}, {"amount": None}, {"user_id": "2"}, {"amount": True}]
+)
+async def test_invalid_event_is_rejected(
+    client: SanicASGITestClient,
+    user_headers: Dict[str, str],
+    changes: Dict[str, Any],
+) -> None:
+    # Подпись верна, но поле неверного типа или пустое
+    event = {**make_event(1.0), **changes}
+    event["signature"] = sign_payload(event, config.SECRET_KEY)
+    _, response = await client.post("/api/webhook", json=event)
+
+    assert response.status == 400
+    assert response.json == {"error": "Invalid event"}
+    assert await account_balance(client, user_headers) == 100.0
+
+
+async def test_event_without_amount_is_rejected(client: SanicASGITestClient) -> None:
+    event = make_event(1.0)
+    del event["amount"]
+    event["signature"] = sign_payload(event, config.SECRET_KEY)
+    _, response = await client.post("/api/webhook", json=event)
+
+    assert response.status == 400
@@ -0,0 +1,73 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import jwt
+
+from config import config
+from metrics import metrics
+
+DECODE_RESULTS = ("cached", "valid", "invalid")
+
+
+class TokenCache:
+    # LRU проверенных токенов: ключ — sha256 токена, значение — claims и момент,
+    # после которого запись недействительна (exp токена или ttl кэша).
+    def __init__(self, max_size: int, ttl: int) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[bytes, Tuple[Dict[str, Any], float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        key = self.key(token)
+        entry = self.entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, token: str, claims: Dict[str, Any]) -> None:
+        if self.max_size <= 0:
+            return
+        expires_at = time.time() + self.ttl
+        if isinstance(claims.get("exp"), (int, float)):
+            expires_at = min(expires_at, claims["exp"])
+        key = self.key(token)
+        self.entries[key] = (claims, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+token_cache = TokenCache(config.TOKEN_CACHE_SIZE, config.TOKEN_CACHE_TTL)
+
+
+def decode_token(token: Optional[str]) -> Optional[Dict[str, Any]]:
+    if not token:
+        return None
+    claims = token_cache.get(token)
+    if claims is not None:
+        metrics.inc("jwt_decode_total", result="cached")
+        return claims
+    started = time.perf_counter()
+    try:
+        claims = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
+    except jwt.exceptions.InvalidTokenError:
+        metrics.inc("jwt_decode_total", result="invalid")
+        return None
+    finally:
+        metrics.observe("jwt_decode_seconds", time.perf_counter() - started)
+    metrics.inc("jwt_decode_total", result="valid")
+    token_cache.put(token, claims)
+    return claims
@@ -1,6 +1,7 @@
 import hashlib
 import hmac
-from typing import Any, Dict
+import time
+from typing import Any, Dict, Iterable, List
 
 from sanic.log import logger
 
@@ -17,6 +18,40 @@ def verify_signature(data: Dict[str, "Any"], secret_key: str) -> bool:
     return hmac.compare_digest(expected_signature, data["signature"])
 
 
+def sign_payload(data: Dict[str, Any], secret_key: str) -> str:
+    # Подпись платёжной системы: значения по отсортированным ключам + секрет
+    message = "".join(f"{data[key]}" for key in sorted(data) if key != "signature")
+    return hashlib.sha256((message + secret_key).encode()).hexdigest()
+
+
+def verify_signatures(events: Iterable[Dict[str, Any]], secret_key: str) -> List[bool]:
+    results = []
+    for data in events:
+        signature = data.get("signature")
+        if not isinstance(signature, str):
+            results.append(False)
+            continue
+        expected = sign_payload(data, secret_key)
+        results.append(hmac.compare_digest(expected, signature))
+    return results
+
+
 def hash_password(salt: str, password: str) -> str:
     salted = password + salt
     return hashlib.sha512(salted.encode("utf8")).hexdigest()
+
+
+class BootTimer:
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.last = started
+        self.phases: Dict[str, float] = {}
+
+    def mark(self, phase: str) -> None:
+        now = time.perf_counter()
+        self.phases[phase] = (now - self.last) * 1000
+        self.last = now
+
+    def summary(self) -> str:
+        phases = " ".join(f"{name}={ms:.1f}ms" for name, ms in self.phases.items())
+        return f"{phases} total={(self.last - self.started) * 1000:.1f}ms"
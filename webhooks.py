@@ -0,0 +1,512 @@
+import asyncio
+import json
+from datetime import date, datetime, timezone
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from sanic.log import logger
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    DateTime,
+    Float,
+    Integer,
+    String,
+    exists,
+    literal,
+    select,
+)
+
+from config import config
+from database import DbSession, dialect_insert
+from idempotency import idempotency_cache
+from ledger import apply_rollups, ledger_mode, to_minor
+from models import Account, LedgerEntry, Payment, User
+from shards import account_sharded, add_to_shard
+
+SUCCESS = "success"
+DUPLICATE = "duplicate"
+USER_NOT_FOUND = "user_not_found"
+INVALID_SIGNATURE = "invalid_signature"
+INVALID = "invalid"
+ERROR = "error"
+OUTCOMES = (SUCCESS, DUPLICATE, USER_NOT_FOUND, INVALID_SIGNATURE, INVALID, ERROR)
+
+EVENT_FIELDS = {
+    "transaction_id": (str,),
+    "user_id": (int,),
+    "account_id": (int,),
+    "amount": (int, float),
+    "signature": (str,),
+}
+
+
+def apply_to_account(statement: Any) -> Any:
+    # В режиме row баланс увеличивается на месте. В режиме ledger счёт только
+    # создаётся с нулевым снимком, а сумма остаётся в журнале до сжатия.
+    index_elements = [Account.user_id, Account.account_id]
+    if ledger_mode():
+        return statement.on_conflict_do_nothing(index_elements=index_elements)
+    return statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={
+            "balance": Account.balance + statement.excluded.balance,
+            "balance_minor": Account.balance_minor + statement.excluded.balance_minor,
+        },
+    )
+
+
+def received_at() -> Tuple[datetime, date]:
+    # Время приёма и день сводки считаются в UTC одним значением
+    now = datetime.now(timezone.utc)
+    return now, now.date()
+
+
+async def known_transaction(session: DbSession, transaction_id: str) -> bool:
+    # Повторные доставки отсекаются без попытки вставки: по LRU без запроса,
+    # при положительном ответе фильтра Блума — одним чтением по индексу
+    if not config.WEBHOOK_IDEMPOTENCY_CACHE:
+        return False
+    seen = idempotency_cache.seen(transaction_id)
+    if seen is None:
+        exists = await session.scalar(
+            select(Payment.id).filter_by(transaction_id=transaction_id)
+        )
+        seen = exists is not None
+        idempotency_cache.confirm(transaction_id, seen)
+    return seen
+
+
+def remember_transactions(transaction_ids: Iterable[str]) -> None:
+    if config.WEBHOOK_IDEMPOTENCY_CACHE:
+        for transaction_id in transaction_ids:
+            idempotency_cache.add(transaction_id)
+
+
+async def ingest_payment(session: DbSession, data: Dict[str, Any]) -> str:
+    # Проверка пользователя, идемпотентность по transaction_id, вставка платежа
+    # и атомарное увеличение баланса выполняются в одной транзакции.
+    if await known_transaction(session, data["transaction_id"]):
+        await session.rollback()
+        return DUPLICATE
+    insert = dialect_insert(session)
+    created_at, day = received_at()
+
+    source = select(
+        literal(data["transaction_id"], String),
+        literal(data["user_id"], Integer),
+        literal(data["account_id"], Integer),
+        literal(data["amount"], Float),
+        literal(created_at, DateTime(timezone=True)),
+    ).where(exists().where(User.id == data["user_id"]))
+    new_payment = (
+        insert(Payment)
+        .from_select(
+            ["transaction_id", "user_id", "account_id", "amount", "created_at"],
+            source,
+        )
+        .on_conflict_do_nothing(index_elements=[Payment.transaction_id])
+        .returning(
+            Payment.transaction_id,
+            Payment.user_id,
+            Payment.account_id,
+            Payment.amount,
+        )
+    )
+
+    amount_minor = to_minor(data["amount"])
+    compacted = not ledger_mode()
+    amount = literal(data["amount"] if compacted else 0.0, Float)
+    delta = literal(amount_minor if compacted else 0, BigInteger)
+    # Шардированный счёт пишется отдельными запросами: сумма уходит в один из
+    # шардов, а не в общую строку accounts
+    sharded = compacted and await account_sharded(
+        session, data["user_id"], data["account_id"]
+    )
+
+    shard: Optional[int] = None
+    if session.get_bind().dialect.name == "postgresql" and not sharded:
+        # Один запрос: вставка платежа в CTE, запись в журнал и upsert счета по
+        # её результату
+        payment_cte = new_payment.cte("new_payment")
+        entry = insert(LedgerEntry).from_select(
+            ["transaction_id", "user_id", "account_id", "amount_minor", "compacted"],
+            select(
+                payment_cte.c.transaction_id,
+                payment_cte.c.user_id,
+                payment_cte.c.account_id,
+                literal(amount_minor, BigInteger),
+                literal(compacted, Boolean),
+            ),
+        )
+        upsert = apply_to_account(
+            insert(Account).from_select(
+                ["user_id", "account_id", "balance", "balance_minor"],
+                select(payment_cte.c.user_id, payment_cte.c.account_id, amount, delta),
+                include_defaults=False,
+            )
+        )
+        if compacted:
+            entry_cte = entry.cte("new_entry")
+            statement = upsert.returning(Account.id)
+        else:
+            # Горячая строка счета не обновляется: только вставка в журнал
+            entry_cte = upsert.cte("new_account")
+            statement = entry.returning(LedgerEntry.id)
+        statement = statement.add_cte(payment_cte, nest_here=True).add_cte(
+            entry_cte, nest_here=True
+        )
+        applied = (await session.execute(statement)).first()
+    else:
+        applied = (await session.execute(new_payment)).first()
+        if applied:
+            await session.execute(
+                insert(LedgerEntry).values(
+                    transaction_id=data["transaction_id"],
+                    user_id=data["user_id"],
+                    account_id=data["account_id"],
+                    amount_minor=amount_minor,
+                    compacted=compacted,
+                )
+            )
+            if sharded:
+                shard = await add_to_shard(
+                    session,
+                    data["user_id"],
+                    data["account_id"],
+                    data["amount"],
+                    amount_minor,
+                )
+            if shard is None:
+                upsert = insert(Account).values(
+                    user_id=data["user_id"],
+                    account_id=data["account_id"],
+                    balance=amount,
+                    balance_minor=delta,
+                )
+                await session.execute(apply_to_account(upsert))
+
+    if applied:
+        if compacted:
+            # Сводка отдельным запросом после счёта: порядок выполнения
+            # изменяющих CTE в PostgreSQL не определён, а блокировки строк
+            # счёта и сводки берутся в том же порядке, что и в ingest_batch.
+            # У шардированного счёта строка сводки своя у каждого шарда
+            # баланса; в режиме ledger сводку пополняет сжатие журнала.
+            key = (data["user_id"], day, data["account_id"], shard or 0)
+            await apply_rollups(session, {key: (1, amount_minor)})
+        await session.commit()
+        remember_transactions([data["transaction_id"]])
+        return SUCCESS
+
+    await session.rollback()
+    if await session.scalar(select(User.id).filter_by(id=data["user_id"])) is None:
+        return USER_NOT_FOUND
+    remember_transactions([data["transaction_id"]])
+    return DUPLICATE
+
+
+def parse_events(body: bytes) -> List[Optional[Dict[str, Any]]]:
+    # Принимает JSON-массив или NDJSON (по событию в строке, как requests.jsonl).
+    # Неразобранные и неполные события возвращаются как None.
+    text = body.decode("utf8").strip()
+    if text.startswith("["):
+        raw: List[Any] = json.loads(text)
+    else:
+        raw = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                raw.append(json.loads(line))
+            except ValueError:
+                raw.append(None)
+    return [event if is_valid_event(event) else None for event in raw]
+
+
+def is_valid_event(event: Any) -> bool:
+    if not isinstance(event, dict):
+        return False
+    for field, types in EVENT_FIELDS.items():
+        value = event.get(field)
+        if not isinstance(value, types) or isinstance(value, bool):
+            return False
+    return True
+
+
+def chunks(items: Sequence[Any], size: int) -> Iterator[Sequence[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+async def ingest_batch(session: DbSession, events: List[Dict[str, Any]]) -> List[str]:
+    # События уже проверены (подпись, поля). Дубликаты отсекаются внутри пачки и
+    # одним запросом к базе, платежи вставляются многострочным INSERT, а суммы
+    # по счетам применяются одним upsert. Всё в одной транзакции.
+    insert = dialect_insert(session)
+    chunk_size = config.WEBHOOK_BATCH_CHUNK_SIZE
+    results: List[str] = [SUCCESS] * len(events)
+
+    first_seen: Dict[str, int] = {}
+    for index, event in enumerate(events):
+        if event["transaction_id"] in first_seen:
+            results[index] = DUPLICATE
+        else:
+            first_seen[event["transaction_id"]] = index
+
+    known: set[str] = set()
+    lookups = list(first_seen)
+    if config.WEBHOOK_IDEMPOTENCY_CACHE:
+        # В базе проверяются только id, о которых кэш не может ответить сам
+        lookups = []
+        for transaction_id in first_seen:
+            seen = idempotency_cache.seen(transaction_id)
+            if seen:
+                known.add(transaction_id)
+            elif seen is None:
+                lookups.append(transaction_id)
+    found: set[str] = set()
+    for part in chunks(lookups, chunk_size):
+        found.update(
+            await session.scalars(
+                select(Payment.transaction_id).where(Payment.transaction_id.in_(part))
+            )
+        )
+    known.update(found)
+    if config.WEBHOOK_IDEMPOTENCY_CACHE:
+        for transaction_id in lookups:
+            idempotency_cache.confirm(transaction_id, transaction_id in found)
+    user_ids = {event["user_id"] for event in events}
+    existing_users: set[int] = set()
+    for part in chunks(list(user_ids), chunk_size):
+        existing_users.update(
+            await session.scalars(select(User.id).where(User.id.in_(part)))
+        )
+
+    pending: List[int] = []
+    for transaction_id, index in first_seen.items():
+        if transaction_id in known:
+            results[index] = DUPLICATE
+        elif events[index]["user_id"] not in existing_users:
+            results[index] = USER_NOT_FOUND
+        else:
+            pending.append(index)
+
+    created_at, day = received_at()
+    inserted: set[str] = set()
+    for part in chunks(pending, chunk_size):
+        rows = [
+            {
+                "transaction_id": events[index]["transaction_id"],
+                "user_id": events[index]["user_id"],
+                "account_id": events[index]["account_id"],
+                "amount": events[index]["amount"],
+                "created_at": created_at,
+            }
+            for index in part
+        ]
+        statement = (
+            insert(Payment)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=[Payment.transaction_id])
+            .returning(Payment.transaction_id)
+        )
+        inserted.update(await session.scalars(statement))
+
+    compacted = not ledger_mode()
+    entries: List[Dict[str, Any]] = []
+    deltas: Dict[Tuple[int, int], Tuple[float, int]] = {}
+    rollups: Dict[Tuple[int, int], Tuple[int, int]] = {}
+    for index in pending:
+        event = events[index]
+        if event["transaction_id"] not in inserted:
+            # Вставлен параллельным запросом между проверкой и INSERT
+            results[index] = DUPLICATE
+            continue
+        amount_minor = to_minor(event["amount"])
+        entries.append(
+            {
+                "transaction_id": event["transaction_id"],
+                "user_id": event["user_id"],
+                "account_id": event["account_id"],
+                "amount_minor": amount_minor,
+                "compacted": compacted,
+            }
+        )
+        key = (event["user_id"], event["account_id"])
+        amount, minor = deltas.get(key, (0.0, 0))
+        if compacted:
+            deltas[key] = (amount + event["amount"], minor + amount_minor)
+        else:
+            deltas[key] = (amount, minor)
+        count, total = rollups.get(key, (0, 0))
+        rollups[key] = (count + 1, total + amount_minor)
+
+    for part in chunks(entries, chunk_size):
+        await session.execute(insert(LedgerEntry).values(list(part)))
+
+    shards: Dict[Tuple[int, int], int] = {}
+    unsharded: List[Tuple[Tuple[int, int], Tuple[float, int]]] = []
+    for (user_id, account_id), (amount, minor) in sorted(deltas.items()):
+        shard = (
+            await add_to_shard(session, user_id, account_id, amount, minor)
+            if compacted
+            else None
+        )
+        if shard is not None:
+            shards[user_id, account_id] = shard
+            continue
+        unsharded.append(((user_id, account_id), (amount, minor)))
+
+    for part in chunks(unsharded, chunk_size):
+        upsert = insert(Account).values(
+            [
+                {
+                    "user_id": user_id,
+                    "account_id": account_id,
+                    "balance": amount,
+                    "balance_minor": minor,
+                }
+                for (user_id, account_id), (amount, minor) in part
+            ]
+        )
+        await session.execute(apply_to_account(upsert))
+
+    if compacted:
+        # Как в ingest_payment: в режиме ledger сводку пополняет сжатие журнала
+        await apply_rollups(
+            session,
+            {
+                (user_id, day, account_id, shards.get((user_id, account_id), 0)): totals
+                for (user_id, account_id), totals in rollups.items()
+            },
+        )
+
+    await session.commit()
+    remember_transactions(inserted)
+    return results
+
+
+class GroupCommitter:
+    # Собирает одиночные события вебхука в очередь и записывает их пачками через
+    # ingest_batch: одна транзакция на окно window_ms или на max_events событий.
+    # Каждый запрос получает свой результат только после общего коммита.
+    def __init__(
+        self,
+        session_factory: Callable[[], DbSession],
+        window_ms: int,
+        max_events: int,
+    ) -> None:
+        self.session_factory = session_factory
+        self.window = window_ms / 1000
+        self.max_events = max_events
+        self.queue: asyncio.Queue[
+            Optional[Tuple[Dict[str, Any], asyncio.Future[str]]]
+        ] = asyncio.Queue()
+        self.task: Optional[asyncio.Task[None]] = None
+
+    def start(self) -> None:
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    async def submit(self, event: Dict[str, Any]) -> str:
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        await self.queue.put((event, future))
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_events:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self.flush(batch)
+
+    async def flush(
+        self, batch: List[Tuple[Dict[str, Any], asyncio.Future[str]]]
+    ) -> None:
+        try:
+            results = await self.ingest([event for event, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # Одно испорченное событие откатывает всё окно: события
+                # повторяются по одному, и ошибку получает только оно.
+                # Повтор безопасен, в базе ничего не закоммичено.
+                for item in batch:
+                    await self.flush([item])
+                return
+            _, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def ingest(self, events: List[Dict[str, Any]]) -> List[str]:
+        session = self.session_factory()
+        try:
+            return await ingest_batch(session, events)
+        except Exception:
+            # Ошибка отката не должна заменить исходную: иначе запросы окна
+            # остались бы без ответа, а задача run завершилась бы
+            try:
+                await session.rollback()
+            except Exception as e:
+                logger.warning(f"Group commit rollback failed: {e}")
+            raise
+        finally:
+            try:
+                await session.close()
+            except Exception as e:
+                logger.warning(f"Group commit session close failed: {e}")
+
+
+class ShardedCommitter:
+    # Отдельная очередь на каждый шард: пачка коммитится в базе своих
+    # пользователей
+    def __init__(
+        self, committers: Sequence[GroupCommitter], shard_for: Callable[[int], int]
+    ) -> None:
+        self.committers = list(committers)
+        self.shard_for = shard_for
+
+    def start(self) -> None:
+        for committer in self.committers:
+            committer.start()
+
+    async def stop(self) -> None:
+        for committer in self.committers:
+            await committer.stop()
+
+    async def submit(self, event: Dict[str, Any]) -> str:
+        return await self.committers[self.shard_for(event["user_id"])].submit(event)